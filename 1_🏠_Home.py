@@ -1,12 +1,16 @@
-import pandas as pd
-import mysql.connector
 import streamlit as st
 import time
+from library_sim import circulation, render, tracing
+from library_sim.search import fetch_books, get_search_index
+from library_sim.users import create_user, login_user
+from library_sim.trace_panel import sidebar_panel
 
 st.set_page_config(page_title="Library Simulation",
                    page_icon=r"./data/closed_book.png",
                    layout="wide")
 
+run_started = tracing.mark()
+
 
 st.sidebar.markdown("""
         <style>
@@ -20,127 +24,23 @@ st.sidebar.markdown("""
         """, unsafe_allow_html=True)
 
 
-@st.cache_resource
-def init_connection():
-    conn = mysql.connector.connect(**st.secrets["db_credentials"])
-    return conn
-
-
-book_db = init_connection()
-book_cursor = book_db.cursor()
-
 if 'active_user' not in st.session_state:
     st.session_state['active_user'] = 'no_user'
 
 active_user = st.session_state['active_user']
 
 
-@st.cache_data(ttl=600)
-def search_books(term, kind):
-
-    def search_books_by_author(author):
-        book_cursor.execute(f"""SELECT inventory.book_id, metadata.title, 
-                           metadata.author, inventory.total_copies, 
-                           inventory.available,metadata.desc, 
-                           metadata.cover_link
-                           FROM inventory
-                           LEFT JOIN metadata
-                           ON inventory.book_id = metadata.unique_id
-                           WHERE metadata.author LIKE '%{author}%';""")
-        results = book_cursor.fetchall()
-        return [results[0:][x] for x in range(len(results))]
-
-    def search_books_by_title(title):
-        book_cursor.execute(f"""SELECT inventory.book_id, metadata.title, 
-                           metadata.author, inventory.total_copies, 
-                           inventory.available,metadata.desc, 
-                           metadata.cover_link
-                           FROM inventory
-                           LEFT JOIN metadata
-                           ON inventory.book_id = metadata.unique_id
-                           WHERE metadata.title LIKE '%{title}%';""")
-        results = book_cursor.fetchall()
-        return [results[0:][x] for x in range(len(results))]
-
-    if "title" == kind:
-        return search_books_by_title(term)
-    else:
-        return search_books_by_author(term)
-
-
-def create_user(new_user_name, new_user_pass):
-    try:
-        book_cursor.execute(f"""INSERT INTO users (user_name, user_pass)
-                           VALUES ('{new_user_name}', 
-                           SHA2('{new_user_pass}',256));""")
-        book_db.commit()
-        print("New User Added to Database")
-        return True
-    except mysql.connector.Error as err:
-        print("{}".format(err))
-        return False   
-
-
-def login_user(user_name, user_pass):
-
-    book_cursor.execute(f"""SELECT user_name FROM users
-                       WHERE user_name ='{user_name}' 
-                       AND user_pass = SHA2('{user_pass}', 256)""")
-                   
-    results = book_cursor.fetchall()
-    if user_name == results[0][0]:
-        print('login success')
-        return results
-    else:
-        print('failure')
-        return results
-
-
-def html_image(image_link):
-    return f"<img align='right' width='130' height='200' src='{image_link}'>"
-
-
-def user_book_checkout(user_id, book_id):
-
-    def check_available(value):
-        try:
-            book_cursor.execute(f"""SELECT  inventory.total_copies, 
-                                    inventory.available
-                                    FROM inventory
-                                    WHERE inventory.book_id ={value};""")
-            check_avail = book_cursor.fetchall()
-
-            if check_avail[0][1] >= 0:
-                return True
-            else:
-                return False
-        except mysql.connector.Error as err:
-            print("{}".format(err))
-            return False
-
-    def check_out_inventory(value):
-        book_cursor.execute(f"""SELECT  inventory.total_copies, 
-                            inventory.available
-                            FROM inventory
-                            WHERE inventory.book_id ={value};""")
-        results = book_cursor.fetchall()
-        update_value = results[0][1] - 1
-        book_cursor.execute(f"""UPDATE inventory
-                           SET available = {update_value}
-                           WHERE book_id = {value};""")
-
-    def insert_to_circulation(user, value):
-
-        book_cursor.execute(f"""INSERT INTO circulation (user_id, book_id)
-                           VALUES ('{user}', {value});""")
-
-    if not check_available(book_id):
-        return False
-    else:
-        check_out_inventory(book_id)
-        insert_to_circulation(user_id, book_id)
-        book_db.commit()
-        return True
+def search_books(term, kind, page=0, page_size=5):
+    """One page of search results and the total number of matches"""
+    # matches come from the in-memory index and the rows of the requested
+    # page from the metadata and availability caches
+    book_ids, total = get_search_index().search_page(
+        term, kind, offset=page * page_size, limit=page_size)
+    return fetch_books(book_ids), total
+
+
+def change_search_page(step):
+    st.session_state['search_page'] += step
 
 
 # sidebar login/signup layout
@@ -174,7 +74,6 @@ if 'no_user' == active_user:
                 st.sidebar.success('New User Created')
                 time.sleep(2)
                 st.experimental_rerun()
-                init_connection.clear()
             else:
                 st.sidebar.warning('Username Already Exists')
 else:
@@ -185,16 +84,24 @@ else:
         st.experimental_rerun()
 
     st.sidebar.subheader(f'Hello *{active_user}*!')
-    st.sidebar.markdown("Input a Book ID to add to 'My Books'")
-    check_out_id = st.sidebar.text_input('#', label_visibility="collapsed")
+    st.sidebar.markdown("Input one or more Book IDs to add to 'My Books'")
+    check_out_ids = st.sidebar.text_area('#', label_visibility="collapsed",
+                                         placeholder="e.g. 12, 40, 41")
 
     if st.sidebar.button('Add to My Books'):
-        result = user_book_checkout(active_user, check_out_id)
-        if not result:
-            st.sidebar.warning('Book Not Found or Not Available')
-        else:
-            st.sidebar.success('Success!')
+        results = circulation.checkout_many(
+            active_user, circulation.parse_book_ids(check_out_ids))
+        failed = [f'{book_id} ({status})' for book_id, status in results
+                  if status != circulation.OK]
+        if len(results) > len(failed):
+            st.sidebar.success(f'Checked out {len(results) - len(failed)} '
+                               f'of {len(results)}!')
+        if failed or not results:
+            st.sidebar.warning('Book Not Found or Not Available: ' +
+                               ', '.join(failed))
+
 
+results_per_page = 5
 
 # main page layout
 st.title('Simple Library Simulation', anchor=None)
@@ -207,26 +114,36 @@ search_type = st.radio('Search Type', ('title', 'author'), horizontal=True)
 search_term = st.text_input('#', placeholder="search",
                             label_visibility="collapsed")
 
-display_df = pd.DataFrame(search_books(search_term, search_type),
-                          columns=['Book ID', 'Title', 'Author', 'Total Copies',
-                                   'Available', 'Description', 'Cover'])
-display_df = display_df.iloc[:5]
-display_df = display_df[['Book ID', 'Cover', 'Title', 'Author',
-                         'Description', 'Available']]
-
-display_df['Description'] = display_df['Description'].str.replace("###",
-                                                                  "<br />",
-                                                                  regex=False)
-display_df['Description'] = display_df['Description'].str.replace("#",
-                                                                  "",
-                                                                  regex=False)
-
-display_df['Cover'] = display_df['Cover'].apply(html_image)
-book_display_html = display_df.to_html(escape=False, index=False,
-                                       justify='center')
+# a new search starts again from the first page
+if st.session_state.get('search_key') != (search_term, search_type):
+    st.session_state['search_key'] = (search_term, search_type)
+    st.session_state['search_page'] = 0
+
+search_page = st.session_state['search_page']
+search_results, search_total = search_books(search_term, search_type,
+                                            page=search_page,
+                                            page_size=results_per_page)
+last_page = max(0, (search_total - 1) // results_per_page)
+
+display_rows = [(book_id, cover, title, author, desc, available)
+                for (book_id, title, author, total_copies, available, desc,
+                     cover) in search_results]
+book_display_html = render.render_table(['Book ID', 'Cover', 'Title',
+                                         'Author', 'Description',
+                                         'Available'], display_rows)
 st.markdown(book_display_html, unsafe_allow_html=True)
 
+prev_col, page_col, next_col = st.columns([1, 4, 1])
+prev_col.button('Previous', on_click=change_search_page, args=(-1,),
+                disabled=search_page <= 0)
+first_shown = min(search_page * results_per_page + 1, search_total)
+last_shown = min((search_page + 1) * results_per_page, search_total)
+page_col.markdown(f"Showing {first_shown}-{last_shown} of {search_total} "
+                  f"results")
+next_col.button('Next', on_click=change_search_page, args=(1,),
+                disabled=search_page >= last_page)
+
+sidebar_panel(run_started)
+
 
-# book_cursor.close()
-# book_db.close()
 # streamlit run 1_🏠_Home.py
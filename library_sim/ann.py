@@ -0,0 +1,175 @@
+"""Approximate neighbor lists for very large catalogs.
+
+``build_neighbor_index`` compares every book with every other book, which
+is quadratic in the catalog size. ``build_ann_neighbor_index`` builds the
+same ``NeighborIndex`` from an inverted-file (IVF) index instead:
+
+* the TF-IDF rows are reduced to ``dim``-dimensional float32 embeddings
+  with truncated SVD;
+* the embeddings are clustered into ``n_lists`` k-means lists (about
+  ``sqrt(N)`` by default);
+* every book is compared, with its exact TF-IDF cosine similarity, only
+  with the books of the ``nprobe`` lists whose centroids are nearest to
+  its own embedding.
+
+With ``n_lists ~ sqrt(N)`` every book is compared with about
+``nprobe * sqrt(N)`` others, so the build is O(N^1.5) rather than O(N^2).
+The stored scores are exact cosines, so ``book_rec`` and the filters use
+the result unchanged; only a neighbor outside the probed lists can be
+missing. Raising ``nprobe`` trades build time for recall, which
+``recall_at_k`` measures against the exact path.
+"""
+import numpy as np
+from sklearn.cluster import MiniBatchKMeans
+from sklearn.decomposition import TruncatedSVD
+from sklearn.preprocessing import normalize
+
+from library_sim.neighbors import (BLOCK_CELLS, DEFAULT_K, NeighborIndex,
+                                  merge_neighbors, query_rows, top_k)
+
+DEFAULT_DIM = 128
+DEFAULT_NPROBE = 8
+# rows used to fit the k-means centroids
+KMEANS_SAMPLE = 100000
+
+
+def embed(desc_matrix, dim=DEFAULT_DIM, random_state=0):
+    """L2-normalized float32 SVD embeddings of the TF-IDF rows"""
+    dim = max(1, min(dim, desc_matrix.shape[1] - 1, desc_matrix.shape[0]))
+    svd = TruncatedSVD(n_components=dim, random_state=random_state)
+    return normalize(svd.fit_transform(desc_matrix).astype(np.float32))
+
+
+class IVFIndex:
+    """Catalog rows bucketed by their nearest k-means centroid"""
+
+    def __init__(self, centroids, assignments):
+        self.centroids = centroids
+        self.assignments = assignments
+        self.order = np.argsort(assignments, kind='stable')
+        self.bounds = np.searchsorted(assignments[self.order],
+                                      np.arange(len(centroids) + 1))
+
+    @classmethod
+    def fit(cls, embeddings, n_lists=None, random_state=0):
+        n_rows = embeddings.shape[0]
+        if n_lists is None:
+            n_lists = int(np.sqrt(n_rows))
+        n_lists = max(1, min(n_lists, n_rows))
+        rng = np.random.default_rng(random_state)
+        sample = embeddings
+        if n_rows > KMEANS_SAMPLE:
+            sample = embeddings[np.sort(rng.choice(n_rows, KMEANS_SAMPLE,
+                                                   replace=False))]
+        kmeans = MiniBatchKMeans(n_clusters=n_lists, n_init=3,
+                                 batch_size=4096,
+                                 random_state=random_state).fit(sample)
+        centroids = normalize(kmeans.cluster_centers_.astype(np.float32))
+        assignments = np.empty(n_rows, dtype=np.int32)
+        step = max(1, BLOCK_CELLS // n_lists)
+        for start in range(0, n_rows, step):
+            block = embeddings[start:start + step] @ centroids.T
+            assignments[start:start + step] = block.argmax(axis=1)
+        return cls(centroids, assignments)
+
+    def __len__(self):
+        return len(self.centroids)
+
+    def members(self, lst):
+        """Rows of list ``lst``, in ascending row order"""
+        return self.order[self.bounds[lst]:self.bounds[lst + 1]]
+
+    def nearest_lists(self, embeddings, nprobe):
+        """The ``nprobe`` lists whose centroids are closest to each row"""
+        nprobe = min(nprobe, len(self))
+        probes = np.empty((embeddings.shape[0], nprobe), dtype=np.int32)
+        step = max(1, BLOCK_CELLS // len(self))
+        for start in range(0, embeddings.shape[0], step):
+            block = embeddings[start:start + step] @ self.centroids.T
+            probes[start:start + step] = top_k(block, nprobe)[0]
+        return probes
+
+
+def build_ann_neighbor_index(desc_matrix, k=DEFAULT_K, dim=DEFAULT_DIM,
+                             n_lists=None, nprobe=DEFAULT_NPROBE,
+                             random_state=0):
+    """Build an approximate NeighborIndex from a TF-IDF description matrix.
+
+    Returns the index and the IVFIndex used to build it.
+    """
+    desc_matrix = normalize(desc_matrix).tocsr()
+    n_books = desc_matrix.shape[0]
+    k = min(k, n_books)
+    embeddings = embed(desc_matrix, dim, random_state)
+    ivf = IVFIndex.fit(embeddings, n_lists, random_state)
+    probes = ivf.nearest_lists(embeddings, nprobe)
+
+    # scan list by list: every list is compared with all the rows probing
+    # it and merged into their running top-k
+    probing = np.argsort(probes.ravel(), kind='stable')
+    probing_rows = probing // probes.shape[1]
+    bounds = np.searchsorted(probes.ravel()[probing],
+                             np.arange(len(ivf) + 1))
+    indices = np.full((n_books, k), -1, dtype=np.int64)
+    scores = np.full((n_books, k), -np.inf)
+    for lst in range(len(ivf)):
+        members = ivf.members(lst)
+        rows = probing_rows[bounds[lst]:bounds[lst + 1]]
+        if not len(members) or not len(rows):
+            continue
+        member_matrix = desc_matrix[members].T.tocsc()
+        step = max(1, BLOCK_CELLS // len(members))
+        for start in range(0, len(rows), step):
+            block_rows = rows[start:start + step]
+            block = (desc_matrix[block_rows] @ member_matrix).toarray()
+            cols, values = top_k(block, min(k, len(members)))
+            indices[block_rows], scores[block_rows] = merge_neighbors(
+                indices[block_rows], scores[block_rows], members[cols],
+                values, k)
+
+    # rows whose probed lists hold fewer than k books are queried exactly
+    short = np.flatnonzero((indices < 0).any(axis=1))
+    step = max(1, BLOCK_CELLS // n_books)
+    for start in range(0, len(short), step):
+        block_rows = short[start:start + step]
+        indices[block_rows], scores[block_rows] = query_rows(
+            desc_matrix, block_rows, k)
+
+    sim_index = NeighborIndex(indices.astype(np.int32),
+                              scores.astype(np.float32), desc_matrix)
+    return sim_index, ivf
+
+
+def recall_at_k(sim_index, k=20, sample=1000, random_state=0):
+    """Share of the exact top-``k`` recommendations found by ``sim_index``.
+
+    Measured on ``sample`` random rows against the exact similarities from
+    ``sim_index.desc_matrix``, leaving the query book itself out of both
+    lists since it is never recommended and always found. A returned
+    neighbor counts as a hit when it scores at least as high as the exact
+    ``k``-th neighbor, so books tied at the cut-off are not counted as
+    misses.
+    """
+    desc_matrix = sim_index.desc_matrix
+    n_books = desc_matrix.shape[0]
+    k = min(k, n_books - 1, sim_index.k - 1)
+    rng = np.random.default_rng(random_state)
+    rows = np.sort(rng.choice(n_books, min(sample, n_books), replace=False))
+
+    hits = 0
+    step = max(1, BLOCK_CELLS // n_books)
+    for start in range(0, len(rows), step):
+        block_rows = rows[start:start + step]
+        block = (desc_matrix[block_rows] @ desc_matrix.T).toarray()
+        block[np.arange(len(block_rows)), block_rows] = -np.inf
+        _, exact = top_k(block, k)
+        candidates = np.asarray(sim_index.indices[block_rows, :k + 1],
+                                dtype=np.intp)
+        # drop the query book, or the last candidate where it is missing
+        order = np.argsort(candidates == block_rows[:, None], axis=1,
+                           kind='stable')
+        candidates = np.take_along_axis(candidates, order, axis=1)[:, :k]
+        found = np.take_along_axis(block, candidates, axis=1)
+        # exact ties may differ in the last bits with summation order
+        hits += (found >= exact[:, -1:] - 1e-6).sum()
+    return hits / (len(rows) * k)
@@ -0,0 +1,162 @@
+"""Availability and loans, cached between page reruns.
+
+Search results and My Books used to read inventory and circulation from the
+database on every rerun. ``book_availability`` and ``user_loans`` answer
+from process-wide caches keyed by book id and user id instead, reading only
+the keys they are missing with one ``IN`` query.
+
+The write paths in ``library_sim.circulation`` call ``changed`` as soon as
+a checkout or return has committed, which drops the affected books and
+reader, so this process never shows a count older than its own last write.
+A read that overlaps such an invalidation returns what it read but does not
+store it, so it cannot put back a value from before the write. Entries also
+expire after ``CACHE_TTL`` seconds, which bounds how long writes made by
+other processes (another server, an admin editing the tables) can go
+unseen.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from library_sim import db, tracing
+
+# seconds before an entry is read from the database again
+CACHE_TTL = 60
+AVAILABILITY_CACHE_SIZE = 100000
+LOANS_CACHE_SIZE = 10000
+# ids per IN query
+CHUNK_SIZE = 1000
+
+AVAILABILITY_QUERY = """SELECT inventory.book_id,
+                        inventory.total_copies, inventory.available
+                        FROM inventory
+                        WHERE inventory.book_id IN ({placeholders});"""
+LOANS_QUERY = """SELECT circulation.user_id, circulation.book_id
+                 FROM circulation
+                 WHERE circulation.user_id IN ({placeholders})
+                 ORDER BY circulation.cir_key;"""
+
+
+class ReadThroughCache:
+    """Bounded LRU cache filled by ``load(keys) -> {key: value}``.
+
+    Keys ``load`` does not return are cached as missing too. ``ttl=None``
+    keeps entries until they are invalidated or evicted.
+    """
+
+    def __init__(self, load, max_size, ttl=None):
+        self.load = load
+        self.max_size = max_size
+        self.ttl = ttl
+        self._items = OrderedDict()
+        self._epoch = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._items)
+
+    def get_many(self, keys):
+        """``{key: value}`` for every key of ``keys`` that exists"""
+        found = {}
+        missing = []
+        now = time.monotonic()
+        with self._lock:
+            for key in dict.fromkeys(keys):
+                item = self._items.get(key)
+                if item is None or (self.ttl is not None
+                                    and now - item[1] > self.ttl):
+                    missing.append(key)
+                    continue
+                self._items.move_to_end(key)
+                if item[0] is not None:
+                    found[key] = item[0]
+            epoch = self._epoch
+        if not missing:
+            return found
+
+        loaded = self.load(missing)
+        found.update(loaded)
+        with self._lock:
+            # an invalidation ran while loading; what was read may predate it
+            if epoch == self._epoch:
+                for key in missing:
+                    self._items[key] = (loaded.get(key), now)
+                    self._items.move_to_end(key)
+                while len(self._items) > self.max_size:
+                    self._items.popitem(last=False)
+        return found
+
+    def invalidate(self, keys):
+        with self._lock:
+            self._epoch += 1
+            for key in keys:
+                self._items.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._epoch += 1
+            self._items.clear()
+
+
+def _chunks(values):
+    values = list(values)
+    for start in range(0, len(values), CHUNK_SIZE):
+        yield values[start:start + CHUNK_SIZE]
+
+
+@tracing.traced('availability.load')
+def load_availability(book_ids):
+    """``{book_id: (total_copies, available)}`` read from inventory"""
+    counts = {}
+    for chunk in _chunks(book_ids):
+        placeholders = ', '.join(['%s'] * len(chunk))
+        with db.cursor() as cur:
+            cur.execute(AVAILABILITY_QUERY.format(placeholders=placeholders),
+                        tuple(chunk))
+            for book_id, total_copies, available in cur.fetchall():
+                counts[book_id] = (total_copies, available)
+    return counts
+
+
+@tracing.traced('availability.load_loans')
+def load_loans(user_ids):
+    """``{user_id: (book_id, ...)}`` in checkout order"""
+    loans = {user_id: [] for user_id in user_ids}
+    for chunk in _chunks(user_ids):
+        placeholders = ', '.join(['%s'] * len(chunk))
+        with db.cursor() as cur:
+            cur.execute(LOANS_QUERY.format(placeholders=placeholders),
+                        tuple(chunk))
+            for user_id, book_id in cur.fetchall():
+                loans[user_id].append(book_id)
+    return {user_id: tuple(book_ids) for user_id, book_ids in loans.items()}
+
+
+_availability = ReadThroughCache(load_availability, AVAILABILITY_CACHE_SIZE,
+                                 CACHE_TTL)
+_loans = ReadThroughCache(load_loans, LOANS_CACHE_SIZE, CACHE_TTL)
+
+
+def book_availability(book_ids):
+    """``{book_id: (total_copies, available)}`` of the books of
+    ``book_ids`` that are in the inventory"""
+    return _availability.get_many(book_ids)
+
+
+def user_loans(user_id):
+    """Ids of the books ``user_id`` has checked out, in checkout order; an
+    id repeats for every copy"""
+    return _loans.get_many([user_id]).get(user_id, ())
+
+
+def changed(user_id, book_ids):
+    """Forget what is cached about ``book_ids`` and the loans of
+    ``user_id``; called after every checkout and return"""
+    _availability.invalidate(book_ids)
+    _loans.invalidate([user_id])
+
+
+def clear():
+    """Drop every cached count and loan list"""
+    _availability.clear()
+    _loans.clear()
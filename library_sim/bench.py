@@ -0,0 +1,256 @@
+"""Benchmarks of the app's data paths on synthetic catalogs.
+
+    python -m library_sim.bench [--scales 1000 10000 100000]
+                                [--queries 200] [--workers 4]
+                                [--out results.json]
+    python -m library_sim.bench --compare OLD.json NEW.json
+
+For every scale a synthetic library (``library_sim.synthetic``) is written
+to a SQLite file and served through the connection pool with the
+``sqlite_db`` stand-in, then each operation is timed over ``--queries``
+random calls. The results are written as JSON, tagged with the git commit,
+so runs from two commits can be compared with ``--compare``.
+
+The index is built the way ``library_sim.build_index`` builds it: chunked
+TF-IDF counts and exact neighbor lists on ``--workers`` processes.
+Catalogs larger than ``--exact-max`` books get the approximate neighbor
+index; the exact build is quadratic and would dominate the run.
+``--data-dir`` keeps the generated databases for the next run.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from library_sim import circulation, db, migrate, sqlite_db, synthetic
+from library_sim.ann import build_ann_neighbor_index
+from library_sim.catalog import CHUNK_ROWS, Catalog, fetch_metadata
+from library_sim.config import ROOT
+from library_sim.engine import RecEngine
+from library_sim.neighbors import build_neighbor_index
+from library_sim.search import SearchIndex, fetch_books, fetch_search_rows
+from library_sim.tfidf import ChunkedTfidf
+
+DEFAULT_SCALES = [1000, 10000, 100000]
+EXACT_MAX = 50000
+BENCH_USER = 'bench-user'
+
+
+def timings(fn, calls):
+    """Run ``fn(*args)`` for every args tuple in ``calls``; per-call stats
+    in milliseconds"""
+    elapsed = []
+    for args in calls:
+        start = time.perf_counter()
+        fn(*args)
+        elapsed.append((time.perf_counter() - start) * 1000)
+    elapsed = np.array(elapsed)
+    return {'calls': len(elapsed),
+            'total_s': round(elapsed.sum() / 1000, 4),
+            'mean_ms': round(elapsed.mean(), 4),
+            'p50_ms': round(float(np.percentile(elapsed, 50)), 4),
+            'p95_ms': round(float(np.percentile(elapsed, 95)), 4),
+            'max_ms': round(elapsed.max(), 4)}
+
+
+def timed_once(fn):
+    """``(result, stats)`` of a single call of ``fn()``"""
+    result = []
+    stats = timings(lambda: result.append(fn()), [()])
+    return result[0], stats
+
+
+def database_path(data_dir, n_books, seed):
+    path = os.path.join(data_dir, f'synthetic-{n_books}-{seed}.db')
+    if not os.path.exists(path):
+        start = time.perf_counter()
+        synthetic.create_database(path + '.tmp', n_books, seed=seed)
+        os.replace(path + '.tmp', path)
+        print(f'generated {n_books} books '
+              f'({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+    else:
+        # a kept database may predate the current schema
+        connection = sqlite_db.connect(path)
+        try:
+            migrate.migrate(connection)
+        finally:
+            connection.close()
+    return path
+
+
+def run_scale(path, n_books, queries, exact_max, seed, workers=1):
+    """Time every operation on one database; list of result dicts"""
+    db.set_pool(db.ConnectionPool(lambda: sqlite_db.connect(path)))
+    rng = random.Random(seed)
+    results = {}
+
+    table, results['get_metadata'] = timed_once(fetch_metadata)
+
+    def build_index():
+        # the same chunked, parallel build as library_sim.build_index
+        tfidf = ChunkedTfidf(workers=workers)
+        for start in range(0, len(table), CHUNK_ROWS):
+            tfidf.add(table['desc'].iloc[start:start + CHUNK_ROWS])
+        _, desc_matrix = tfidf.finish()
+        if n_books > exact_max:
+            return build_ann_neighbor_index(desc_matrix)[0]
+        return build_neighbor_index(desc_matrix, workers=workers)
+
+    sim_index, results['desc_sim_matrix'] = timed_once(build_index)
+
+    def init_engine():
+        return RecEngine(Catalog.from_table(table), sim_index)
+
+    engine, results['engine_init'] = timed_once(init_engine)
+
+    book_ids = table['unique_id'].tolist()
+    results['book_rec'] = timings(
+        engine.book_rec, [(rng.choice(book_ids),) for _ in range(queries)])
+    results['book_rec_filtered'] = timings(
+        lambda book_id, genre: engine.book_rec(book_id, genres=genre,
+                                               overlap=1),
+        [(rng.choice(book_ids), rng.choice(synthetic.GENRES))
+         for _ in range(queries)])
+    results['book_recs_multiple'] = timings(
+        engine.book_recs_multiple,
+        [(rng.sample(book_ids, 5),) for _ in range(queries)])
+    results['profile_recs'] = timings(
+        engine.profile_recs,
+        [(rng.sample(book_ids, 20),) for _ in range(queries)])
+
+    def build_search_index():
+        search_index = SearchIndex()
+        search_index.sync(fetch_search_rows())
+        return search_index
+
+    search_index, results['search_index_build'] = timed_once(
+        build_search_index)
+    titles = table['title'].tolist()
+
+    def search_books(term, kind):
+        book_ids, _ = search_index.search_page(term, kind, limit=5)
+        return fetch_books(book_ids)
+
+    terms = []
+    for _ in range(queries):
+        word = rng.choice(rng.choice(titles).split())
+        terms.append((word[:rng.randint(2, len(word))], 'title'))
+    results['search_books'] = timings(search_books, terms)
+
+    checkout_ids = [(BENCH_USER, rng.choice(book_ids))
+                    for _ in range(queries)]
+    results['user_book_checkout'] = timings(circulation.checkout,
+                                            checkout_ids)
+    results['return_book'] = timings(circulation.return_book, checkout_ids)
+    batches = [(BENCH_USER, rng.sample(book_ids, 5))
+               for _ in range(queries)]
+    results['checkout_many'] = timings(circulation.checkout_many, batches)
+    results['return_many'] = timings(circulation.return_many, batches)
+
+    return [dict(scale=n_books, operation=operation, **stats)
+            for operation, stats in results.items()]
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(scales, queries, exact_max=EXACT_MAX, data_dir=None, seed=0,
+        workers=1):
+    keep = data_dir is not None
+    if not keep:
+        data_dir = tempfile.mkdtemp()
+    os.makedirs(data_dir, exist_ok=True)
+    report = {'commit': git_commit(),
+              'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+              'python': platform.python_version(),
+              'platform': platform.platform(),
+              'settings': {'scales': scales, 'queries': queries,
+                           'exact_max': exact_max, 'seed': seed,
+                           'workers': workers},
+              'results': []}
+    try:
+        for n_books in scales:
+            path = database_path(data_dir, n_books, seed)
+            for result in run_scale(path, n_books, queries, exact_max,
+                                    seed, workers):
+                print(f"{result['scale']:>9} {result['operation']:<20} "
+                      f"p50 {result['p50_ms']:10.3f}ms "
+                      f"p95 {result['p95_ms']:10.3f}ms", file=sys.stderr)
+                report['results'].append(result)
+    finally:
+        db.set_pool(None)
+        if not keep:
+            shutil.rmtree(data_dir, ignore_errors=True)
+    return report
+
+
+def compare(old_path, new_path):
+    """Print the p50 and p95 change of every operation between two runs"""
+    with open(old_path) as old_file, open(new_path) as new_file:
+        old, new = json.load(old_file), json.load(new_file)
+    old_results = {(result['scale'], result['operation']): result
+                   for result in old['results']}
+    print(f"{'scale':>9} {'operation':<20} {'p50':>10} {'p95':>10}")
+    for result in new['results']:
+        before = old_results.get((result['scale'], result['operation']))
+        if before is None:
+            continue
+        changes = [result[stat] / before[stat] if before[stat] else np.nan
+                   for stat in ('p50_ms', 'p95_ms')]
+        print(f"{result['scale']:>9} {result['operation']:<20} "
+              + ' '.join(f'{change:9.2f}x' for change in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scales', type=int, nargs='+',
+                        default=DEFAULT_SCALES,
+                        help='catalog sizes to benchmark '
+                             '(default: %(default)s)')
+    parser.add_argument('--queries', type=int, default=200,
+                        help='timed calls per operation '
+                             '(default: %(default)s)')
+    parser.add_argument('--exact-max', type=int, default=EXACT_MAX,
+                        help='largest catalog given the exact neighbor '
+                             'index (default: %(default)s)')
+    parser.add_argument('--data-dir',
+                        help='keep generated databases here for reuse')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes for the index build '
+                             '(default: %(default)s)')
+    parser.add_argument('--out', help='write the JSON results here '
+                                      '(default: stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two result files instead')
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    report = run(args.scales, args.queries, args.exact_max, args.data_dir,
+                 args.seed, args.workers)
+    if args.out:
+        with open(args.out, 'w') as out_file:
+            json.dump(report, out_file, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == '__main__':
+    main()
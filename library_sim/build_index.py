@@ -0,0 +1,178 @@
+"""Build the recommendation index offline.
+
+    python -m library_sim.build_index [--k 21] [--workers 8]
+    python -m library_sim.build_index --incremental
+    python -m library_sim.build_index --ann [--nprobe 8] [--dim 128]
+
+Reads the ``metadata`` table, fits the TF-IDF vectorizer, builds the
+neighbor index and publishes it under ``index/`` so the Streamlit pages can
+memory-map it at startup instead of rebuilding it in every process.
+
+With ``--incremental`` only books added or changed since the published
+build are transformed and merged into it (see ``library_sim.incremental``);
+it falls back to a full build when there is nothing to update from or the
+vocabulary has drifted too far. Running servers pick up the new build
+within ``engine.RELOAD_CHECK_INTERVAL`` seconds.
+
+With ``--ann`` the neighbor lists are built approximately (see
+``library_sim.ann``), which scales to catalogs with millions of books; the
+recall@20 of its recommendations (the neighbors besides the book itself) is
+measured on a sample of books and printed.
+Incremental updates of an approximate build keep its settings.
+
+``--workers`` (default: every core) tokenizes the descriptions and computes
+the exact neighbor lists in that many processes.
+"""
+import argparse
+import os
+import time
+
+import numpy as np
+
+from library_sim import ann, incremental, index_store
+from library_sim.catalog import CHUNK_ROWS, fetch_metadata
+from library_sim.config import INDEX_DIR
+from library_sim.neighbors import DEFAULT_K, build_neighbor_index
+from library_sim.tfidf import ChunkedTfidf
+
+
+def fetch_catalog(**kwargs):
+    start = time.perf_counter()
+    table = fetch_metadata(**kwargs)
+    print(f'fetched {len(table)} books '
+          f'({time.perf_counter() - start:.1f}s)')
+    return table
+
+
+def build(k=DEFAULT_K, root=INDEX_DIR, table=None, ann_settings=None,
+          workers=1):
+    """Full build; ``ann_settings`` (``dim``, ``n_lists``, ``nprobe``,
+    ``recall_sample``) selects the approximate index"""
+    start = time.perf_counter()
+    tfidf = ChunkedTfidf(workers=workers)
+    hashes = []
+
+    def add_descs(descs):
+        tfidf.add(descs)
+        hashes.append(incremental.desc_hashes(descs))
+
+    # descriptions are only needed for the TF-IDF counts and the hashes, so
+    # when reading the catalog they are consumed chunk by chunk and dropped
+    if table is None:
+        table = fetch_catalog(columns=['unique_id'],
+                              on_chunk=lambda chunk: add_descs(chunk['desc']))
+    else:
+        for chunk_start in range(0, len(table), CHUNK_ROWS):
+            add_descs(table['desc'].iloc[chunk_start:
+                                         chunk_start + CHUNK_ROWS])
+    tfid, desc_matrix = tfidf.finish()
+    hashes = np.concatenate(hashes) if hashes else np.empty(0, np.uint64)
+    if ann_settings is None:
+        sim_index = build_neighbor_index(desc_matrix, k=k, workers=workers)
+        print(f'built neighbor index ({time.perf_counter() - start:.1f}s)')
+    else:
+        ann_settings = dict(ann_settings)
+        sim_index, ivf = ann.build_ann_neighbor_index(
+            desc_matrix, k=k, dim=ann_settings['dim'],
+            n_lists=ann_settings['n_lists'], nprobe=ann_settings['nprobe'])
+        print(f'built approximate neighbor index with {len(ivf)} lists '
+              f'({time.perf_counter() - start:.1f}s)')
+        # recall of the recommendations, the neighbors besides the book
+        recs = sim_index.k - 1
+        recall = ann.recall_at_k(sim_index, recs,
+                                 sample=ann_settings['recall_sample'])
+        ann_settings[f'recall_at_{recs}'] = round(recall, 4)
+        print(f'recall@{recs} {recall:.3f} on '
+              f"{min(ann_settings['recall_sample'], len(sim_index))} books "
+              f'({time.perf_counter() - start:.1f}s)')
+
+    build_dir = index_store.new_build_dir(root)
+    index_store.save_build(build_dir, table['unique_id'].to_numpy(), tfid,
+                           sim_index, hashes, ann=ann_settings)
+    index_store.publish_build(build_dir, root)
+    print(f'published {build_dir}')
+    return build_dir
+
+
+def update(k=DEFAULT_K, root=INDEX_DIR,
+           max_oov_ratio=incremental.MAX_OOV_RATIO,
+           max_changed_ratio=incremental.MAX_CHANGED_RATIO, workers=1):
+    """Update the published build in place of a full build where possible;
+    ``workers`` is used by the full build it may fall back to"""
+    current = index_store.current_build_dir(root)
+    if current is None:
+        print('no published build to update, running a full build')
+        return build(k, root, workers=workers)
+
+    start = time.perf_counter()
+    table = fetch_catalog()
+    ann_settings = index_store.load_manifest(current).get('ann')
+    try:
+        result = incremental.update_index(current, table, k,
+                                          max_oov_ratio, max_changed_ratio)
+    except incremental.RefitNeeded as err:
+        print(f'{err}, running a full build')
+        return build(k, root, table, ann_settings, workers)
+    if result is None:
+        print(f'{current} is up to date')
+        return current
+
+    vectorizer, sim_index, hashes, fit_stats = result
+    print(f"updated {fit_stats['rows_since_fit']} rows since the last full "
+          f"fit, recomputed {fit_stats['recomputed_rows']} neighbor lists "
+          f'({time.perf_counter() - start:.1f}s)')
+    build_dir = index_store.new_build_dir(root)
+    index_store.save_build(build_dir, table['unique_id'].to_numpy(),
+                           vectorizer, sim_index, hashes, fit_stats,
+                           ann=ann_settings)
+    index_store.publish_build(build_dir, root)
+    print(f'published {build_dir}')
+    return build_dir
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--k', type=int, default=DEFAULT_K,
+                        help='neighbors kept per book, itself included '
+                             '(default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+                        help='processes for tokenizing and exact neighbor '
+                             'lists (default: one per core)')
+    parser.add_argument('--out', default=INDEX_DIR,
+                        help='index root directory (default: ./index)')
+    parser.add_argument('--incremental', action='store_true',
+                        help='update the published build with new and '
+                             'changed books')
+    parser.add_argument('--max-oov', type=float,
+                        default=incremental.MAX_OOV_RATIO,
+                        help='share of out-of-vocabulary tokens that forces '
+                             'a full build (default: %(default)s)')
+    parser.add_argument('--ann', action='store_true',
+                        help='build approximate neighbor lists')
+    parser.add_argument('--nprobe', type=int, default=ann.DEFAULT_NPROBE,
+                        help='lists searched per book; higher is slower '
+                             'with better recall (default: %(default)s)')
+    parser.add_argument('--lists', type=int,
+                        help='k-means lists (default: sqrt of the catalog '
+                             'size)')
+    parser.add_argument('--dim', type=int, default=ann.DEFAULT_DIM,
+                        help='SVD embedding size (default: %(default)s)')
+    parser.add_argument('--recall-sample', type=int, default=1000,
+                        help='books used to measure recall '
+                             '(default: %(default)s)')
+    args = parser.parse_args()
+    if args.incremental:
+        update(k=args.k, root=args.out, max_oov_ratio=args.max_oov,
+               workers=args.workers)
+    else:
+        ann_settings = None
+        if args.ann:
+            ann_settings = {'dim': args.dim, 'n_lists': args.lists,
+                            'nprobe': args.nprobe,
+                            'recall_sample': args.recall_sample}
+        build(k=args.k, root=args.out, ann_settings=ann_settings,
+              workers=args.workers)
+
+
+if __name__ == '__main__':
+    main()
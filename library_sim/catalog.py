@@ -0,0 +1,350 @@
+"""The catalog: reading ``metadata`` and its compact in-memory form.
+
+``fetch_metadata`` reads the table in chunks. ``Catalog`` is what a server
+process keeps of it: an immutable, preprocessed copy built once, holding
+titles and cover links packed into UTF-8 buffers, authors as a categorical,
+genres as integer codes, a dense ``unique_id`` -> row array, hash lookups
+from author and title to their rows, and no descriptions; those are read
+from the database for the rows actually displayed, cleaned for display once
+and kept in a small LRU cache.
+"""
+import sys
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from library_sim import db
+from library_sim.genres import GenreBits
+from library_sim.render import clean_description
+
+# catalog rows are ordered by id so the rows of a published index line up
+# with the catalog without storing a separate mapping
+METADATA_QUERY = """SELECT metadata.title, metadata.desc,
+                    metadata.author, metadata.genre, metadata.unique_id,
+                    metadata.cover_link
+                    FROM metadata
+                    ORDER BY metadata.unique_id;"""
+COUNT_QUERY = """SELECT COUNT(*) FROM metadata;"""
+DESCRIPTIONS_QUERY = """SELECT metadata.unique_id, metadata.desc
+                        FROM metadata
+                        WHERE metadata.unique_id IN ({placeholders});"""
+METADATA_COLUMNS = ['title', 'desc', 'author', 'genre', 'unique_id',
+                    'cover_link']
+COLUMN_DTYPES = {'unique_id': np.int64}
+# rows read from the cursor at a time
+CHUNK_ROWS = 10000
+# the columns a Catalog keeps; descriptions are read on demand
+CATALOG_COLUMNS = ['title', 'author', 'genre', 'unique_id', 'cover_link']
+DESC_CACHE_SIZE = 2048
+# a dense id -> row array is used while ids are at most this sparse
+MAX_ID_SPREAD = 4
+
+
+def count_metadata():
+    with db.cursor() as cur:
+        cur.execute(COUNT_QUERY)
+        return cur.fetchall()[0][0]
+
+
+def stream_metadata(chunk_rows=CHUNK_ROWS):
+    """The catalog in id order, ``chunk_rows`` rows at a time.
+
+    Yields one dict of column arrays per chunk; the row tuples of a chunk
+    are dropped as soon as it has been split into columns.
+    """
+    with db.cursor() as cur:
+        cur.execute(METADATA_QUERY)
+        while True:
+            rows = cur.fetchmany(chunk_rows)
+            if not rows:
+                return
+            columns = list(zip(*rows))
+            del rows
+            yield {name: np.array(values,
+                                  dtype=COLUMN_DTYPES.get(name, object))
+                   for name, values in zip(METADATA_COLUMNS, columns)}
+
+
+def fetch_metadata(columns=METADATA_COLUMNS, on_chunk=None,
+                   chunk_rows=CHUNK_ROWS):
+    """The catalog as a DataFrame of ``columns``, read in chunks.
+
+    Every chunk is copied straight into arrays preallocated for the whole
+    table, so peak memory is the kept columns plus one chunk of rows rather
+    than a list of every row tuple next to the DataFrame built from it.
+    ``on_chunk(chunk)`` sees every chunk with all the columns, including
+    the ones not kept (e.g. to feed descriptions to ``ChunkedTfidf``).
+    """
+    n_rows = count_metadata()
+    buffers = {name: np.empty(n_rows, dtype=COLUMN_DTYPES.get(name, object))
+               for name in columns}
+    filled = 0
+    for chunk in stream_metadata(chunk_rows):
+        size = len(chunk['unique_id'])
+        if filled + size > n_rows:
+            # rows were added since they were counted
+            n_rows = filled + size
+            for name in columns:
+                buffers[name] = np.resize(buffers[name], n_rows)
+        for name in columns:
+            buffers[name][filled:filled + size] = chunk[name]
+        if on_chunk is not None:
+            on_chunk(chunk)
+        filled += size
+
+    return pd.DataFrame({name: buffers[name][:filled] for name in columns},
+                        columns=columns)
+
+
+def parse_genres(genre_column):
+    """Stringified genre lists ("['Fantasy', 'Fiction']") as Python lists"""
+    genre_column = genre_column.str.replace("'", "", regex=False)
+    genre_column = genre_column.str.replace(", ", ",", regex=True)
+    return genre_column.apply(lambda x: x[1:-1].split(','))
+
+
+def parse_genre_codes(genre_column):
+    """Integer genre codes of every row: ``(vocabulary, codes, offsets)``.
+
+    Row ``i`` has the genres ``vocabulary[codes[offsets[i]:offsets[i +
+    1]]]`` in their listed order. Each distinct genre string is parsed
+    once, however many books share it.
+    """
+    string_codes, strings = pd.factorize(pd.Series(genre_column))
+    if (string_codes < 0).any():
+        raise ValueError('missing genre list')
+    genre_lists = parse_genres(pd.Series(strings, dtype=object))
+    vocabulary = sorted({genre for genres in genre_lists for genre in genres})
+    genre_code = {genre: code for code, genre in enumerate(vocabulary)}
+    string_genres = np.array([genre_code[genre] for genres in genre_lists
+                              for genre in genres], dtype=np.int16)
+    string_offsets = np.zeros(len(genre_lists) + 1, dtype=np.int64)
+    np.cumsum([len(genres) for genres in genre_lists],
+              out=string_offsets[1:])
+
+    lengths = np.diff(string_offsets)[string_codes]
+    offsets = np.zeros(len(string_codes) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    # position of every output code in string_genres
+    starts = string_offsets[string_codes] - offsets[:-1]
+    codes = string_genres[np.repeat(starts, lengths)
+                          + np.arange(offsets[-1])]
+    return np.array(vocabulary, dtype=object), codes, offsets
+
+
+def group_rows(codes, n_groups):
+    """Rows grouped by code: ``(rows, offsets)``, group ``g`` being
+    ``rows[offsets[g]:offsets[g + 1]]`` in row order. Rows with a missing
+    value (code -1) are in no group."""
+    rows = np.argsort(codes, kind='stable').astype(np.int32)
+    present = codes >= 0
+    rows = rows[len(codes) - present.sum():]
+    offsets = np.zeros(n_groups + 1, dtype=np.int64)
+    np.cumsum(np.bincount(codes[present], minlength=n_groups),
+              out=offsets[1:])
+    return rows, offsets
+
+
+def fetch_descriptions(book_ids):
+    """``{unique_id: desc}`` of ``book_ids``"""
+    book_ids = list(book_ids)
+    if not book_ids:
+        return {}
+    placeholders = ', '.join(['%s'] * len(book_ids))
+    with db.cursor() as cur:
+        cur.execute(DESCRIPTIONS_QUERY.format(placeholders=placeholders),
+                    tuple(book_ids))
+        return dict(cur.fetchall())
+
+
+class StringColumn:
+    """Strings packed into one UTF-8 buffer plus offsets.
+
+    A few bytes of overhead per value instead of a Python object each;
+    values are decoded when read.
+    """
+
+    def __init__(self, values):
+        encoded = [b'' if value is None else str(value).encode()
+                   for value in values]
+        self.offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(value) for value in encoded], out=self.offsets[1:])
+        self.data = b''.join(encoded)
+        nulls = np.array([value is None for value in values], dtype=bool)
+        self.nulls = nulls if nulls.any() else None
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, row):
+        if self.nulls is not None and self.nulls[row]:
+            return None
+        return self.data[self.offsets[row]:self.offsets[row + 1]].decode()
+
+    def take(self, rows):
+        """Object array of the values at ``rows``"""
+        return np.array([self[row] for row in rows], dtype=object)
+
+    @property
+    def nbytes(self):
+        nulls = 0 if self.nulls is None else self.nulls.nbytes
+        return len(self.data) + self.offsets.nbytes + nulls
+
+
+class Catalog:
+    """Immutable, compact catalog, built once per process.
+
+    Rows are in ``unique_id`` order, so they line up with a published
+    neighbor index. Reads never modify the catalog apart from the
+    description cache, so one instance can serve every session thread.
+    """
+
+    def __init__(self, ids, titles, authors, genres, cover_links):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.titles = StringColumn(titles)
+        self.authors = pd.Categorical(authors)
+        # the categories are the sorted unique authors and hash their
+        # lookups; titles get the same treatment
+        title_codes, titles_sorted = pd.factorize(
+            pd.Series(titles, dtype=object), sort=True)
+        self.title_index = pd.Index(titles_sorted, dtype=object)
+        self._title_rows = group_rows(title_codes, len(self.title_index))
+        self._author_rows = group_rows(self.authors.codes,
+                                       len(self.authors.categories))
+        # sorted unique values for select boxes
+        self.author_list = self.authors.categories.tolist()
+        self.title_list = self.title_index.tolist()
+        self.genre_vocabulary, self.genre_codes, self.genre_offsets = (
+            parse_genre_codes(genres))
+        self.genre_bits = GenreBits.from_codes(
+            list(self.genre_vocabulary), self.genre_codes, self.genre_offsets)
+        self.cover_links = StringColumn(cover_links)
+
+        self._id_rows = None
+        if len(self.ids) and (self.ids[0] >= 0 and self.ids[-1]
+                              < MAX_ID_SPREAD * len(self.ids) + 1024):
+            self._id_rows = np.full(self.ids[-1] + 1, -1, dtype=np.int32)
+            self._id_rows[self.ids] = np.arange(len(self.ids))
+        self._descs = OrderedDict()
+        self._descs_lock = threading.Lock()
+
+    @classmethod
+    def from_table(cls, table):
+        """Catalog of a ``fetch_metadata`` DataFrame sorted by id"""
+        return cls(table['unique_id'].to_numpy(), table['title'].to_numpy(),
+                   table['author'].to_numpy(), table['genre'].to_numpy(),
+                   table['cover_link'].to_numpy())
+
+    @classmethod
+    def load(cls, chunk_rows=CHUNK_ROWS):
+        return cls.from_table(fetch_metadata(columns=CATALOG_COLUMNS,
+                                             chunk_rows=chunk_rows))
+
+    def __len__(self):
+        return len(self.ids)
+
+    @property
+    def author_codes(self):
+        return self.authors.codes
+
+    def _find_rows(self, book_ids):
+        """Rows of ``book_ids``, -1 for ids not in the catalog"""
+        if self._id_rows is not None:
+            inside = (book_ids >= 0) & (book_ids < len(self._id_rows))
+            rows = np.full(len(book_ids), -1, dtype=np.int64)
+            rows[inside] = self._id_rows[book_ids[inside]]
+        else:
+            rows = np.searchsorted(self.ids, book_ids)
+            found = rows < len(self.ids)
+            found[found] = self.ids[rows[found]] == book_ids[found]
+            rows[~found] = -1
+        return rows
+
+    def rows(self, book_ids):
+        """Rows of ``book_ids``; KeyError if one is not in the catalog"""
+        book_ids = np.asarray(book_ids, dtype=np.int64).ravel()
+        rows = self._find_rows(book_ids)
+        if (rows < 0).any():
+            raise KeyError(book_ids[rows < 0].tolist())
+        return rows
+
+    def contains(self, book_ids):
+        """Which of ``book_ids`` are in the catalog"""
+        return self._find_rows(
+            np.asarray(book_ids, dtype=np.int64).ravel()) >= 0
+
+    def row(self, book_id):
+        return int(self.rows([book_id])[0])
+
+    @staticmethod
+    def _lookup(index, grouped, value):
+        try:
+            code = index.get_loc(value)
+        except KeyError:
+            return np.empty(0, dtype=np.int32)
+        rows, offsets = grouped
+        return rows[offsets[code]:offsets[code + 1]]
+
+    def author_rows(self, author):
+        """Rows of the books by ``author``, in id order"""
+        return self._lookup(self.authors.categories, self._author_rows,
+                            author)
+
+    def title_rows(self, title):
+        """Rows of the books titled ``title``, in id order"""
+        return self._lookup(self.title_index, self._title_rows, title)
+
+    def genres(self, row):
+        """Genre list of one row, as in the source data"""
+        start, stop = self.genre_offsets[row], self.genre_offsets[row + 1]
+        return list(self.genre_vocabulary[self.genre_codes[start:stop]])
+
+    def descriptions(self, rows):
+        """Display-ready descriptions of ``rows``, read from the database if
+        not cached"""
+        book_ids = self.ids[np.asarray(rows, dtype=np.int64)].tolist()
+        with self._descs_lock:
+            missing = [book_id for book_id in book_ids
+                       if book_id not in self._descs]
+        if missing:
+            fetched = fetch_descriptions(set(missing))
+            with self._descs_lock:
+                self._descs.update((book_id, clean_description(desc))
+                                   for book_id, desc in fetched.items())
+                while len(self._descs) > max(DESC_CACHE_SIZE, len(book_ids)):
+                    self._descs.popitem(last=False)
+        with self._descs_lock:
+            descs = []
+            for book_id in book_ids:
+                if book_id in self._descs:
+                    self._descs.move_to_end(book_id)
+                descs.append(self._descs.get(book_id))
+        return descs
+
+    def table(self, rows, descriptions=True):
+        """DataFrame of ``rows`` with the ``fetch_metadata`` columns and
+        parsed genre lists; ``descriptions=False`` leaves out ``desc``"""
+        rows = np.asarray(rows, dtype=np.int64)
+        columns = {'title': self.titles.take(rows)}
+        if descriptions:
+            columns['desc'] = self.descriptions(rows)
+        columns['author'] = np.asarray(self.authors.take(rows), dtype=object)
+        columns['genre'] = [self.genres(row) for row in rows]
+        columns['unique_id'] = self.ids[rows]
+        columns['cover_link'] = self.cover_links.take(rows)
+        return pd.DataFrame(columns, columns=list(columns))
+
+    def memory_usage(self):
+        """Approximate resident size in bytes"""
+        categories = sum(sys.getsizeof(author)
+                         for author in self.authors.categories)
+        categories += sum(sys.getsizeof(title) for title in self.title_index)
+        arrays = [self.ids, self.authors.codes, self.genre_codes,
+                  self.genre_offsets, self.genre_bits.masks,
+                  *self._title_rows, *self._author_rows]
+        if self._id_rows is not None:
+            arrays.append(self._id_rows)
+        return (sum(array.nbytes for array in arrays) + categories
+                + self.titles.nbytes + self.cover_links.nbytes)
@@ -0,0 +1,97 @@
+"""Concurrency check for ``circulation.checkout`` against MySQL.
+
+    python -m library_sim.checkout_stress BOOK_ID [--user USER_ID]
+                                          [--attempts 500] [--workers 32]
+
+Fires ``--attempts`` checkouts of ``BOOK_ID`` from ``--workers`` threads at
+once against the configured database, undoes its checkouts after and exits
+non-zero unless exactly as many succeed as there were copies available,
+``available`` ends at zero-or-more and matches the number of circulation
+rows written. The same check against SQLite runs with the test suite
+(``tests/test_circulation.py``).
+"""
+import argparse
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from library_sim import circulation, db
+
+STRESS_USER_ID = 'checkout-stress'
+
+
+def inventory_state(book_id, user_id):
+    with db.cursor() as cur:
+        cur.execute("""SELECT available FROM inventory
+                    WHERE book_id = %s;""", (book_id,))
+        available = cur.fetchall()[0][0]
+        cur.execute("""SELECT COUNT(*) FROM circulation
+                    WHERE book_id = %s AND user_id = %s;""",
+                    (book_id, user_id))
+        checked_out = cur.fetchall()[0][0]
+    return available, checked_out
+
+
+def run(book_id, user_id, attempts, workers):
+    available_before, checked_out_before = inventory_state(book_id, user_id)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        results = list(executor.map(
+            lambda _: circulation.checkout(user_id, book_id),
+            range(attempts)))
+    elapsed = time.perf_counter() - start
+
+    available_after, checked_out_after = inventory_state(book_id, user_id)
+    successes = sum(results)
+    print(f'{attempts} checkouts from {workers} threads in {elapsed:.2f}s: '
+          f'{successes} succeeded, available {available_before} -> '
+          f'{available_after}')
+
+    failures = []
+    if successes != min(attempts, available_before):
+        failures.append(f'expected {min(attempts, available_before)} '
+                        f'successful checkouts, got {successes}')
+    if available_after < 0:
+        failures.append(f'available went negative ({available_after})')
+    if available_before - available_after != successes:
+        failures.append('available did not drop by the number of '
+                        'successful checkouts')
+    if checked_out_after - checked_out_before != successes:
+        failures.append('circulation rows do not match successful '
+                        'checkouts')
+    return successes, failures
+
+
+def undo_checkouts(book_id, user_id, count):
+    with db.cursor() as cur:
+        cur.execute("""DELETE FROM circulation
+                    WHERE book_id = %s AND user_id = %s;""",
+                    (book_id, user_id))
+        cur.execute("""UPDATE inventory SET available = available + %s
+                    WHERE book_id = %s;""", (count, book_id))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('book_id', type=int, metavar='BOOK_ID',
+                        help='book to check out; its checkouts are undone '
+                             'after')
+    parser.add_argument('--attempts', type=int, default=500)
+    parser.add_argument('--workers', type=int, default=32)
+    parser.add_argument('--user', default=STRESS_USER_ID,
+                        help='user the checkouts are made for')
+    args = parser.parse_args()
+
+    db.set_pool(db.ConnectionPool(db.mysql_connect, size=args.workers))
+    successes, failures = run(args.book_id, args.user, args.attempts,
+                              args.workers)
+    undo_checkouts(args.book_id, args.user, successes)
+
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
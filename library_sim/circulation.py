@@ -0,0 +1,203 @@
+import re
+
+import mysql.connector
+
+from library_sim import availability, db
+
+TAKE_COPY = """UPDATE inventory
+               SET available = available - 1
+               WHERE book_id = %s AND available > 0;"""
+ADD_LOAN = """INSERT INTO circulation (user_id, book_id)
+              VALUES (%s, %s);"""
+# {cases} is one "WHEN %s THEN %s" per book
+ADJUST_AVAILABLE = """UPDATE inventory
+                      SET available = available + CASE book_id {cases} END
+                      WHERE book_id IN ({placeholders});"""
+LOCK_AVAILABLE = """SELECT book_id, available FROM inventory
+                    WHERE book_id IN ({placeholders})
+                    FOR UPDATE;"""
+LOCK_COPIES = """SELECT book_id, total_copies, available
+                 FROM inventory
+                 WHERE book_id IN ({placeholders})
+                 FOR UPDATE;"""
+LOCK_LOANS = """SELECT cir_key, book_id FROM circulation
+                WHERE user_id = %s
+                AND book_id IN ({placeholders})
+                ORDER BY cir_key
+                FOR UPDATE;"""
+CLOSE_LOANS = """DELETE FROM circulation
+                 WHERE cir_key IN ({placeholders})
+                 AND user_id = %s;"""
+
+
+def checkout(user_id, book_id):
+    """Check one copy of ``book_id`` out to ``user_id``.
+
+    Returns False when the book does not exist or no copy is available. The
+    availability check and the decrement are a single conditional UPDATE,
+    so concurrent checkouts can never hand out more copies than there are,
+    and the circulation row is written in the same transaction: two round
+    trips in total.
+    """
+    try:
+        with db.cursor() as cur:
+            cur.execute(TAKE_COPY, (book_id,))
+            if cur.rowcount != 1:
+                return False
+            cur.execute(ADD_LOAN, (user_id, book_id))
+            return True
+    except mysql.connector.Error as err:
+        print("{}".format(err))
+        return False
+    finally:
+        # after the commit; a refused checkout also means the cached count
+        # was out of date
+        availability.changed(user_id, _valid_ids([book_id])[1])
+
+
+OK = 'ok'
+INVALID_ID = 'invalid id'
+NOT_FOUND = 'not found'
+NOT_AVAILABLE = 'not available'
+NOT_CHECKED_OUT = 'not checked out'
+
+
+def parse_book_ids(text):
+    """Book ids typed or pasted as one string, split on commas/whitespace"""
+    return [part for part in re.split(r'[\s,;]+', text or '') if part]
+
+
+def _valid_ids(book_ids):
+    """``(book_id, int id or None)`` pairs plus the distinct valid ids"""
+    parsed = []
+    for book_id in book_ids:
+        # int() would take True as 1 and truncate 1.9 to 1
+        if isinstance(book_id, bool) or (isinstance(book_id, float)
+                                         and not book_id.is_integer()):
+            parsed.append((book_id, None))
+            continue
+        try:
+            parsed.append((book_id, int(book_id)))
+        except (TypeError, ValueError):
+            parsed.append((book_id, None))
+    distinct = sorted({value for _, value in parsed if value is not None})
+    return parsed, distinct
+
+
+def _in_list(values):
+    return ', '.join(['%s'] * len(values))
+
+
+def _adjust_available(cur, changes):
+    """Add ``changes[book_id]`` to the available count of each book, in one
+    statement"""
+    cases = ' '.join(['WHEN %s THEN %s'] * len(changes))
+    params = [value for item in changes.items() for value in item]
+    cur.execute(ADJUST_AVAILABLE.format(cases=cases,
+                                        placeholders=_in_list(changes)),
+                tuple(params) + tuple(changes))
+
+
+def checkout_many(user_id, book_ids):
+    """Check a stack of books out to ``user_id`` in one transaction.
+
+    ``book_ids`` may repeat an id to take several copies. Returns
+    ``(book_id, status)`` for every requested id, in order; ``status`` is
+    ``OK`` or the reason that copy could not be checked out. The inventory
+    rows are locked while the batch is validated, then updated with one
+    UPDATE and the circulation rows written with one multi-row INSERT.
+    """
+    parsed, distinct = _valid_ids(book_ids)
+    if not distinct:
+        return [(book_id, INVALID_ID) for book_id, _ in parsed]
+
+    try:
+        with db.cursor() as cur:
+            cur.execute(LOCK_AVAILABLE.format(
+                placeholders=_in_list(distinct)), tuple(distinct))
+            available = dict(cur.fetchall())
+
+            results = []
+            taken = {}
+            for book_id, value in parsed:
+                if value is None:
+                    results.append((book_id, INVALID_ID))
+                elif value not in available:
+                    results.append((book_id, NOT_FOUND))
+                elif available[value] - taken.get(value, 0) <= 0:
+                    results.append((book_id, NOT_AVAILABLE))
+                else:
+                    taken[value] = taken.get(value, 0) + 1
+                    results.append((book_id, OK))
+
+            if taken:
+                _adjust_available(cur, {value: -count
+                                        for value, count in taken.items()})
+                cur.executemany(ADD_LOAN,
+                                [(user_id, value)
+                                 for (_, value), (_, status)
+                                 in zip(parsed, results) if status == OK])
+            return results
+    except mysql.connector.Error as err:
+        print("{}".format(err))
+        return [(book_id, str(err)) for book_id, _ in parsed]
+    finally:
+        availability.changed(user_id, distinct)
+
+
+def return_many(user_id, book_ids):
+    """Return a stack of books for ``user_id`` in one transaction.
+
+    Returns ``(book_id, status)`` for every requested id, in order. Each
+    requested copy closes the user's oldest open circulation row for that
+    book; all of them are deleted with one DELETE and the inventory updated
+    with one UPDATE.
+    """
+    parsed, distinct = _valid_ids(book_ids)
+    if not distinct:
+        return [(book_id, INVALID_ID) for book_id, _ in parsed]
+
+    try:
+        with db.cursor() as cur:
+            cur.execute(LOCK_COPIES.format(
+                placeholders=_in_list(distinct)), tuple(distinct))
+            room = {book_id: total - available
+                    for book_id, total, available in cur.fetchall()}
+            cur.execute(LOCK_LOANS.format(
+                placeholders=_in_list(distinct)), (user_id,) + tuple(distinct))
+            open_keys = {}
+            for cir_key, book_id in cur.fetchall():
+                open_keys.setdefault(book_id, []).append(cir_key)
+
+            results = []
+            returned = {}
+            closed_keys = []
+            for book_id, value in parsed:
+                if value is None:
+                    results.append((book_id, INVALID_ID))
+                elif value not in room:
+                    results.append((book_id, NOT_FOUND))
+                elif (not open_keys.get(value)
+                      or room[value] - returned.get(value, 0) <= 0):
+                    results.append((book_id, NOT_CHECKED_OUT))
+                else:
+                    closed_keys.append(open_keys[value].pop(0))
+                    returned[value] = returned.get(value, 0) + 1
+                    results.append((book_id, OK))
+
+            if closed_keys:
+                cur.execute(CLOSE_LOANS.format(
+                    placeholders=_in_list(closed_keys)),
+                    tuple(closed_keys) + (user_id,))
+                _adjust_available(cur, returned)
+            return results
+    except mysql.connector.Error as err:
+        print("{}".format(err))
+        return [(book_id, str(err)) for book_id, _ in parsed]
+    finally:
+        availability.changed(user_id, distinct)
+
+
+def return_book(user_id, book_id):
+    """Return one copy of ``book_id``; False if the user does not have it"""
+    return return_many(user_id, [book_id])[0][1] == OK
@@ -0,0 +1,17 @@
+import os
+
+import toml
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SECRETS_PATH = os.path.join(ROOT, '.streamlit', 'secrets.toml')
+INDEX_DIR = os.path.join(ROOT, 'index')
+
+
+def load_secrets(path=SECRETS_PATH):
+    """Read the same secrets file Streamlit exposes as ``st.secrets``"""
+    with open(path, encoding='utf-8') as secrets_file:
+        return toml.load(secrets_file)
+
+
+def db_credentials():
+    return dict(load_secrets()['db_credentials'])
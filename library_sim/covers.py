@@ -0,0 +1,239 @@
+"""Local thumbnails of the cover images.
+
+The result tables used to point every ``<img>`` at the full-size remote
+cover, so browsers downloaded large originals to show them at 130x200.
+``CoverCache`` fetches each cover once, resizes it to the displayed size and
+stores it under ``static/covers/`` named by a hash of the thumbnail's bytes,
+so identical covers share one file. Streamlit serves that directory
+(``enableStaticServing`` in ``.streamlit/config.toml``) under
+``app/static/``, and ``render`` points the tables at the local copy once it
+exists. A cover that is not cached yet is shown from its remote link while
+a small background pool fetches it.
+
+Prefetch the covers of the whole catalog with::
+
+    python -m library_sim.covers [--threads 8] [--limit N] [--sqlite PATH]
+
+Set ``[covers] enabled = false`` in the secrets file (or
+``LIBRARY_SIM_COVERS=0``) to keep linking the remote images.
+"""
+import argparse
+import hashlib
+import io
+import json
+import os
+import sys
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from library_sim import db, sqlite_db
+from library_sim.config import ROOT, load_secrets
+
+COVER_DIR = os.path.join(ROOT, 'static', 'covers')
+# url -> file name, one JSON object per line
+INDEX_FILE = 'index.jsonl'
+STATIC_URL = 'app/static/covers/'
+# width and height html_image displays covers at
+THUMBNAIL_SIZE = (130, 200)
+JPEG_QUALITY = 85
+FETCH_TIMEOUT = 10
+MAX_COVER_BYTES = 10 * 2 ** 20
+DEFAULT_THREADS = 8
+BACKGROUND_THREADS = 2
+
+COVER_LINKS_QUERY = """SELECT metadata.cover_link
+                       FROM metadata
+                       ORDER BY metadata.unique_id;"""
+
+
+def make_thumbnail(data):
+    """JPEG bytes of image ``data`` resized to ``THUMBNAIL_SIZE``"""
+    with Image.open(io.BytesIO(data)) as image:
+        thumbnail = image.convert('RGB').resize(THUMBNAIL_SIZE,
+                                                Image.LANCZOS)
+    out = io.BytesIO()
+    thumbnail.save(out, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    return out.getvalue()
+
+
+def download(link, timeout=FETCH_TIMEOUT):
+    request = urllib.request.Request(
+        link, headers={'User-Agent': 'library_sim-covers'})
+    with urllib.request.urlopen(request, timeout=timeout) as response:
+        data = response.read(MAX_COVER_BYTES + 1)
+    if len(data) > MAX_COVER_BYTES:
+        raise ValueError(f'cover larger than {MAX_COVER_BYTES} bytes')
+    return data
+
+
+class CoverCache:
+    """Thumbnails on local disk, looked up by cover link"""
+
+    def __init__(self, directory=COVER_DIR, url_prefix=STATIC_URL,
+                 background_threads=BACKGROUND_THREADS):
+        self.directory = directory
+        self.url_prefix = url_prefix
+        self.background_threads = background_threads
+        self._lock = threading.Lock()
+        self._files = self._read_index()
+        self._queued = set()
+        self._failed = set()
+        self._executor = None
+
+    def _read_index(self):
+        files = {}
+        try:
+            with open(os.path.join(self.directory, INDEX_FILE),
+                      encoding='utf-8') as index_file:
+                for line in index_file:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by a crash
+                    files[entry['url']] = entry['file']
+        except FileNotFoundError:
+            pass
+        return {url: name for url, name in files.items()
+                if os.path.exists(os.path.join(self.directory, name))}
+
+    def __len__(self):
+        return len(self._files)
+
+    def local_url(self, link):
+        """URL of the cached thumbnail of ``link``, or None"""
+        name = self._files.get(link)
+        return None if name is None else self.url_prefix + name
+
+    def thumbnail_url(self, link):
+        """URL to show for ``link``: the local thumbnail if there is one,
+        otherwise ``link`` itself while the thumbnail is fetched in the
+        background"""
+        if not link:
+            return link
+        local = self.local_url(link)
+        if local is not None:
+            return local
+        with self._lock:
+            if link in self._queued or link in self._failed:
+                return link
+            self._queued.add(link)
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    self.background_threads, thread_name_prefix='covers')
+        self._executor.submit(self.fetch, link)
+        return link
+
+    def fetch(self, link):
+        """Download, resize and store the cover at ``link``; returns the
+        thumbnail's file name, or None if it could not be fetched"""
+        name = self._files.get(link)
+        if name is not None:
+            return name
+        try:
+            thumbnail = make_thumbnail(download(link))
+        except (OSError, ValueError, Image.DecompressionBombError) as err:
+            print("{}: {}".format(link, err))
+            with self._lock:
+                self._failed.add(link)
+                self._queued.discard(link)
+            return None
+
+        name = hashlib.sha256(thumbnail).hexdigest()[:32] + '.jpg'
+        path = os.path.join(self.directory, name)
+        os.makedirs(self.directory, exist_ok=True)
+        if not os.path.exists(path):
+            tmp_path = f'{path}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'wb') as thumbnail_file:
+                thumbnail_file.write(thumbnail)
+            os.replace(tmp_path, path)
+        with self._lock:
+            with open(os.path.join(self.directory, INDEX_FILE), 'a',
+                      encoding='utf-8') as index_file:
+                index_file.write(json.dumps({'url': link, 'file': name})
+                                 + '\n')
+            self._files[link] = name
+            self._queued.discard(link)
+        return name
+
+    def prefetch(self, links, threads=DEFAULT_THREADS):
+        """Fetch every uncached cover of ``links`` with at most ``threads``
+        downloads at a time; returns ``(fetched, failed)`` counts"""
+        links = [link for link in dict.fromkeys(links)
+                 if link and link not in self._files]
+        fetched = failed = 0
+        with ThreadPoolExecutor(threads) as executor:
+            for name in executor.map(self.fetch, links):
+                if name is None:
+                    failed += 1
+                else:
+                    fetched += 1
+        return fetched, failed
+
+
+def settings():
+    """Cover options from ``[covers]`` in the secrets file, env overrides"""
+    try:
+        options = dict(load_secrets().get('covers', {}))
+    except FileNotFoundError:
+        options = {}
+    if 'LIBRARY_SIM_COVERS' in os.environ:
+        options['enabled'] = os.environ['LIBRARY_SIM_COVERS'] not in ('',
+                                                                      '0')
+    return {'enabled': bool(options.get('enabled', True))}
+
+
+_cover_cache = None
+_cover_cache_loaded = False
+_cover_cache_lock = threading.Lock()
+
+
+def get_cover_cache():
+    """The process-wide cover cache, or None when covers are not cached"""
+    global _cover_cache, _cover_cache_loaded
+    if not _cover_cache_loaded:
+        with _cover_cache_lock:
+            if not _cover_cache_loaded:
+                if settings()['enabled']:
+                    _cover_cache = CoverCache()
+                _cover_cache_loaded = True
+    return _cover_cache
+
+
+def cover_links(limit=None):
+    """Distinct cover links of the catalog, in id order"""
+    with db.cursor() as cur:
+        cur.execute(COVER_LINKS_QUERY)
+        links = dict.fromkeys(row[0] for row in cur.fetchall())
+    return list(links)[:limit]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--threads', type=int, default=DEFAULT_THREADS,
+                        help='concurrent downloads (default: %(default)s)')
+    parser.add_argument('--limit', type=int,
+                        help='only the first LIMIT covers of the catalog')
+    parser.add_argument('--out', default=COVER_DIR,
+                        help='thumbnail directory (default: static/covers)')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='read a local SQLite library database instead '
+                        'of MySQL')
+    args = parser.parse_args()
+    if args.sqlite:
+        db.set_pool(db.ConnectionPool(lambda: sqlite_db.connect(args.sqlite)))
+
+    start = time.perf_counter()
+    cache = CoverCache(args.out)
+    links = cover_links(args.limit)
+    fetched, failed = cache.prefetch(links, args.threads)
+    print(f'{len(links)} covers: {fetched} fetched, {failed} failed, '
+          f'{len(links) - fetched - failed} already cached '
+          f'({time.perf_counter() - start:.1f}s)', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,241 @@
+"""Pooled access to the library database.
+
+    from library_sim import db
+
+    with db.cursor() as cur:
+        cur.execute("SELECT ... WHERE book_id = %s;", (book_id,))
+        rows = cur.fetchall()
+
+Every ``with`` block checks a connection out of the process-wide pool, so
+concurrent Streamlit sessions no longer share (and serialize on) a single
+connection and cursor. The block commits when it finishes and rolls back
+when it raises. While tracing is on (``library_sim.tracing``) every
+statement and fetch is recorded as a ``db.*`` span with its row count and
+an estimate of the bytes read.
+"""
+import contextlib
+import functools
+import os
+import queue
+import re
+import threading
+import time
+
+import mysql.connector
+from mysql.connector import errors
+
+from library_sim import tracing
+from library_sim.config import db_credentials, load_secrets
+
+DEFAULT_POOL_SIZE = 8
+DEFAULT_CHECKOUT_TIMEOUT = 30
+# idle connections older than this are pinged before being handed out
+HEALTH_CHECK_AFTER = 30
+STATEMENT_TABLE = re.compile(r'\b(?:FROM|INTO|UPDATE)\s+(?:booksdb\.)?(\w+)',
+                             re.IGNORECASE)
+
+
+class PoolTimeout(errors.PoolError):
+    """No pooled connection became free within the checkout timeout"""
+
+
+@functools.lru_cache(maxsize=256)
+def statement_name(sql):
+    """Span name of a statement: its verb and first table"""
+    words = sql.split(None, 1)
+    verb = words[0].lower() if words else 'sql'
+    table = STATEMENT_TABLE.search(sql)
+    return f'db.{verb} {table.group(1)}' if table else f'db.{verb}'
+
+
+def row_bytes(rows):
+    """Rough size of fetched rows: text length, 8 bytes for anything
+    else"""
+    return sum(len(value) if isinstance(value, (str, bytes)) else 8
+               for row in rows for value in row)
+
+
+class TracedCursor:
+    """Cursor wrapper recording a span per statement and per fetch"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._name = 'db'
+
+    def execute(self, sql, params=()):
+        self._name = statement_name(sql)
+        with tracing.span(self._name) as span:
+            self._cursor.execute(sql, params)
+            if self._cursor.rowcount > 0:
+                span.add(rows=self._cursor.rowcount)
+        return self
+
+    def executemany(self, sql, seq_params):
+        self._name = statement_name(sql)
+        with tracing.span(self._name) as span:
+            self._cursor.executemany(sql, seq_params)
+            if self._cursor.rowcount > 0:
+                span.add(rows=self._cursor.rowcount)
+        return self
+
+    def _fetch(self, fetch, *args):
+        with tracing.span(self._name + ' fetch') as span:
+            rows = fetch(*args)
+            span.add(rows=len(rows), bytes=row_bytes(rows))
+        return rows
+
+    def fetchall(self):
+        return self._fetch(self._cursor.fetchall)
+
+    def fetchmany(self, size=1):
+        return self._fetch(self._cursor.fetchmany, size)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class ConnectionPool:
+    """Blocking pool of at most ``size`` connections made by ``connect``.
+
+    Connections are created lazily, reused most-recently-used first, and
+    pinged (reconnecting if needed) when they have been idle for longer than
+    ``health_check_after`` seconds. Connections that fail mid-query are
+    discarded rather than returned to the pool.
+    """
+
+    def __init__(self, connect, size=DEFAULT_POOL_SIZE,
+                 timeout=DEFAULT_CHECKOUT_TIMEOUT,
+                 health_check_after=HEALTH_CHECK_AFTER):
+        self.size = size
+        self.timeout = timeout
+        self.health_check_after = health_check_after
+        self._connect = connect
+        self._slots = threading.BoundedSemaphore(size)
+        self._idle = queue.LifoQueue()
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise PoolTimeout(f'no database connection free after '
+                              f'{self.timeout}s (pool size {self.size})')
+        try:
+            try:
+                conn, idle_since = self._idle.get_nowait()
+            except queue.Empty:
+                return self._connect()
+            if time.monotonic() - idle_since > self.health_check_after:
+                conn = self._check(conn)
+            return conn
+        except Exception:
+            self._slots.release()
+            raise
+
+    def release(self, conn, discard=False):
+        try:
+            if discard:
+                self._close(conn)
+            else:
+                self._idle.put((conn, time.monotonic()))
+        finally:
+            self._slots.release()
+
+    def _check(self, conn):
+        try:
+            conn.ping(reconnect=True, attempts=2, delay=0)
+            return conn
+        except errors.Error:
+            self._close(conn)
+            return self._connect()
+
+    @staticmethod
+    def _close(conn):
+        try:
+            conn.close()
+        except errors.Error:
+            pass
+
+    @contextlib.contextmanager
+    def connection(self):
+        with tracing.span('db.acquire'):
+            conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except (errors.OperationalError, errors.InterfaceError):
+            discard = True
+            raise
+        finally:
+            self.release(conn, discard)
+
+    @contextlib.contextmanager
+    def cursor(self):
+        """Cursor on a pooled connection, one transaction per block"""
+        with self.connection() as conn:
+            cur = conn.cursor()
+            try:
+                if tracing.enabled():
+                    yield TracedCursor(cur)
+                else:
+                    yield cur
+                with tracing.span('db.commit'):
+                    conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except errors.Error:
+                    pass
+                raise
+            finally:
+                cur.close()
+
+    def close(self):
+        while True:
+            try:
+                conn, _ = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            self._close(conn)
+
+
+def pool_settings():
+    """Pool options from ``[db_pool]`` in the secrets file, env overrides"""
+    settings = dict(load_secrets().get('db_pool', {}))
+    if 'LIBRARY_SIM_DB_POOL_SIZE' in os.environ:
+        settings['size'] = os.environ['LIBRARY_SIM_DB_POOL_SIZE']
+    return {'size': int(settings.get('size', DEFAULT_POOL_SIZE)),
+            'timeout': float(settings.get('timeout',
+                                          DEFAULT_CHECKOUT_TIMEOUT))}
+
+
+def mysql_connect():
+    return mysql.connector.connect(**db_credentials())
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """The process-wide connection pool, created on first use"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(mysql_connect, **pool_settings())
+    return _pool
+
+
+def set_pool(pool):
+    """Use ``pool`` for every ``db.cursor()`` from now on (e.g. a local
+    stand-in database); the previous pool's idle connections are closed"""
+    global _pool
+    with _pool_lock:
+        old_pool, _pool = _pool, pool
+    if old_pool is not None:
+        old_pool.close()
+
+
+def cursor():
+    return get_pool().cursor()
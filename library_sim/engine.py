@@ -0,0 +1,190 @@
+"""Recommendation engine shared by every page of a server process.
+
+The pages call ``get_engine()`` and query the returned object; the compact
+``Catalog`` (with its genre and author codes) and the neighbor index are
+loaded once per process, so warming it up on one page also warms it for the
+others. When a new index build is published the engine is reloaded on the
+next ``get_engine`` call after ``RELOAD_CHECK_INTERVAL`` seconds.
+"""
+import sys
+import threading
+import time
+
+import pandas as pd
+
+from library_sim import render, tracing
+from library_sim.catalog import Catalog, stream_metadata
+from library_sim.filters import genre_filter, rec_filter
+from library_sim.index_store import current_build_dir, load_published_index
+from library_sim.neighbors import build_neighbor_index
+from library_sim.tfidf import ChunkedTfidf
+
+# seconds between checks for a newly published index build
+RELOAD_CHECK_INTERVAL = 60
+
+
+class RecEngine:
+    """Catalog plus neighbor index, with the recommendation queries.
+
+    Instances are read-only once built, so one engine can serve every
+    Streamlit session thread at the same time.
+    """
+
+    def __init__(self, catalog, sim_index, build_dir=None):
+        self.catalog = catalog
+        self.build_dir = build_dir
+        self.sim_index = sim_index
+        self.genre_bits = catalog.genre_bits
+        self.author_codes = catalog.author_codes
+
+    @classmethod
+    @tracing.traced('engine.load')
+    def load(cls):
+        build_dir = current_build_dir()
+        with tracing.span('engine.load_catalog') as span:
+            catalog = Catalog.load()
+            span.add(rows=len(catalog))
+
+        # serve the memory-mapped index from `python -m
+        # library_sim.build_index`, even when the catalog changed since it
+        # was built; fitting here blocks every session behind _engine_lock,
+        # so it only happens when nothing has been published at all
+        with tracing.span('engine.load_index'):
+            sim_index = load_published_index(catalog.ids)
+        if sim_index is None:
+            print('WARNING: no published index build, fitting one in this '
+                  'process; run `python -m library_sim.build_index`',
+                  file=sys.stderr)
+            with tracing.span('engine.fit_index'):
+                # the catalog keeps no descriptions; stream them once
+                tfidf = ChunkedTfidf()
+                for chunk in stream_metadata():
+                    tfidf.add(chunk['desc'])
+                _, desc_matrix = tfidf.finish()
+                sim_index = build_neighbor_index(desc_matrix)
+        with tracing.span('engine.init'):
+            return cls(catalog, sim_index, build_dir)
+
+    def book(self, book_id):
+        """Catalog row of ``book_id`` as a Series"""
+        return self.catalog.table([self.catalog.row(book_id)]).iloc[0]
+
+    def book_by_title(self, title):
+        """Catalog row of the first book titled ``title``"""
+        rows = self.catalog.title_rows(title)
+        if len(rows) == 0:
+            raise KeyError(title)
+        return self.catalog.table(rows[:1]).iloc[0]
+
+    def titles_by_author(self, author):
+        """Books by ``author``, without descriptions"""
+        return self.catalog.table(self.catalog.author_rows(author),
+                                  descriptions=False)
+
+    @tracing.traced('engine.rec_table')
+    def rec_table(self, rows):
+        """Full catalog rows for engine output, in the given order"""
+        table = self.catalog.table(rows)
+        table['query_table_index'] = rows
+        return table
+
+    @tracing.traced('engine.book_rec')
+    def book_rec(self, book_id, genres=None, overlap=0, author=False,
+                 num_=20):
+        """Books most similar to ``book_id``, best match first.
+
+        ``genres`` limits results to books carrying all of them, ``overlap``
+        requires more than that many genres in common with the query book
+        and ``author=False`` leaves out books by the same author.
+        """
+        allowed = rec_filter(self.genre_bits, self.author_codes,
+                             genres=genres, overlap=overlap, author=author)
+        with tracing.span('engine.neighbors', rows=1):
+            rec_rows, _ = self.sim_index.search([self.catalog.row(book_id)],
+                                                num_, allowed)
+        rec_rows = rec_rows[0]
+        return self.rec_table(rec_rows[rec_rows >= 0])
+
+    @tracing.traced('engine.book_recs_multiple')
+    def book_recs_multiple(self, book_ids, genres=None, num_=5):
+        """Top ``num_`` recommendations for each of ``book_ids``, combined"""
+        # every book's neighbors come from one batched, pre-filtered lookup
+        # rather than running book_rec once per book
+        rows = self.catalog.rows(list(book_ids))
+        allowed = rec_filter(self.genre_bits, self.author_codes,
+                             genres=genres, overlap=5, author=False)
+        with tracing.span('engine.neighbors', rows=len(rows)):
+            rec_rows, _ = self.sim_index.search(rows, num_, allowed)
+        rec_rows = rec_rows.ravel()
+
+        df = self.rec_table(rec_rows[rec_rows >= 0])
+        df.drop_duplicates(subset=['unique_id'], inplace=True)
+
+        if len(df['desc']) != 0:
+            return df
+        else:
+            cover = """https://upload.wikimedia.org/wikipedia/commons/4/4d/
+            Cat_November_2010-1a.jpg"""
+            df = pd.DataFrame({'Book ID': 'NA', 'Cover': cover, 'Title': 'NA',
+                               'Author': 'NA', 'Description': 'NA',
+                               'Genres': ['NA']},
+                              index=[0])
+            return df
+
+    @tracing.traced('engine.profile_recs')
+    def profile_recs(self, book_ids, weights=None, genres=None, num_=10):
+        """Books closest to the combined profile of ``book_ids``.
+
+        One query against the index however many books there are (see
+        ``NeighborIndex.search_profile``); ``book_ids`` themselves are never
+        recommended. The ``because_you_liked`` column holds the id of the
+        book in ``book_ids`` each recommendation owes most to.
+        """
+        rows = self.catalog.rows(list(book_ids))
+        allowed = genre_filter(self.genre_bits, genres)
+        with tracing.span('engine.neighbors', rows=len(rows)):
+            rec_rows, _, liked = self.sim_index.search_profile(
+                rows, num_, weights, allowed)
+        table = self.rec_table(rec_rows)
+        table['because_you_liked'] = self.catalog.ids[rows[liked]]
+        return table
+
+
+_engine = None
+_engine_lock = threading.Lock()
+_reload_lock = threading.Lock()
+_checked_at = 0.0
+
+
+def get_engine():
+    """The process-wide engine, loaded on first use.
+
+    At most every ``RELOAD_CHECK_INTERVAL`` seconds one caller checks
+    whether another index build was published and, if so, loads a fresh
+    engine; other callers keep using the current one meanwhile.
+    """
+    global _engine, _checked_at
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = RecEngine.load()
+                _checked_at = time.monotonic()
+
+    stale = time.monotonic() - _checked_at > RELOAD_CHECK_INTERVAL
+    if stale and _reload_lock.acquire(blocking=False):
+        try:
+            _checked_at = time.monotonic()
+            if current_build_dir() != _engine.build_dir:
+                _engine = RecEngine.load()
+                # the new build may come with changed book metadata
+                render.clear()
+        finally:
+            _reload_lock.release()
+    return _engine
+
+
+def reset_engine():
+    """Drop the loaded engine so the next ``get_engine`` reloads it"""
+    global _engine
+    with _engine_lock:
+        _engine = None
@@ -0,0 +1,54 @@
+import numpy as np
+
+from library_sim.genres import contains_all, overlap_count
+
+
+def rec_filter(genre_bits, author_codes, genres=None, overlap=0,
+               author=False):
+    """Candidate filter for ``NeighborIndex.search``.
+
+    Mirrors the options of ``book_rec``: candidates must carry every genre in
+    ``genres``, share more than ``overlap`` genres with the query book and,
+    unless ``author`` is True, be by a different author. The query book
+    itself is never recommended.
+    """
+    if type(genres) == str:
+        genres = [genres]  # this is because of how streamlit works
+
+    required = None
+    if genres:
+        required = genre_bits.encode(genres)
+        if required is None:
+            return lambda query_rows, candidates: np.zeros(
+                np.broadcast(query_rows, candidates).shape, dtype=bool)
+
+    masks = genre_bits.masks
+
+    def allowed(query_rows, candidates):
+        keep = candidates != query_rows
+        if required is not None:
+            keep = keep & contains_all(masks[candidates], required)
+        if overlap != 0:
+            keep = keep & (overlap_count(masks[candidates],
+                                         masks[query_rows]) > overlap)
+        if author is False:
+            keep = keep & (author_codes[candidates]
+                           != author_codes[query_rows])
+        return keep
+
+    return allowed
+
+
+def genre_filter(genre_bits, genres=None):
+    """Candidate filter for ``NeighborIndex.search_profile``: books carrying
+    every genre in ``genres``, or None when there is nothing to filter"""
+    if type(genres) == str:
+        genres = [genres]
+    if not genres:
+        return None
+
+    required = genre_bits.encode(genres)
+    if required is None:
+        return lambda candidates: np.zeros(len(candidates), dtype=bool)
+    masks = genre_bits.masks
+    return lambda candidates: contains_all(masks[candidates], required)
@@ -0,0 +1,72 @@
+import numpy as np
+
+# number of set bits in every possible byte
+POPCOUNT_TABLE = np.array([bin(byte).count('1') for byte in range(256)],
+                          dtype=np.uint8)
+
+
+def popcount(masks):
+    """Number of set bits per mask; masks are uint64 arrays, words last"""
+    masks = np.ascontiguousarray(masks, dtype=np.uint64)
+    as_bytes = masks.view(np.uint8).reshape(masks.shape[:-1] + (-1,))
+    return POPCOUNT_TABLE[as_bytes].sum(axis=-1, dtype=np.int64)
+
+
+def contains_all(masks, required):
+    """True where a mask has every bit of ``required`` set"""
+    return np.all((masks & required) == required, axis=-1)
+
+
+def overlap_count(masks, other):
+    """Number of genres two (broadcastable) mask arrays have in common"""
+    return popcount(masks & other)
+
+
+class GenreBits:
+    """Every book's genres encoded once as a bitmask.
+
+    ``vocabulary`` lists the known genres; genre ``g`` is bit ``g % 64`` of
+    word ``g // 64`` and ``masks`` holds one row of uint64 words per book, so
+    overlap and containment checks become vectorized bit operations instead
+    of per-row Python set intersections.
+    """
+
+    def __init__(self, vocabulary, masks):
+        self.vocabulary = list(vocabulary)
+        self.codes = {genre: code for code, genre in enumerate(vocabulary)}
+        self.masks = masks
+
+    @classmethod
+    def from_lists(cls, genre_lists):
+        vocabulary = sorted({genre for genres in genre_lists
+                             for genre in genres})
+        codes = {genre: code for code, genre in enumerate(vocabulary)}
+        genre_codes = np.array([codes[genre] for genres in genre_lists
+                                for genre in genres], dtype=np.int64)
+        offsets = np.zeros(len(genre_lists) + 1, dtype=np.int64)
+        np.cumsum([len(genres) for genres in genre_lists], out=offsets[1:])
+        return cls.from_codes(vocabulary, genre_codes, offsets)
+
+    @classmethod
+    def from_codes(cls, vocabulary, genre_codes, offsets):
+        """Masks from flat genre codes; book ``i`` has the genres
+        ``genre_codes[offsets[i]:offsets[i + 1]]``"""
+        n_words = max(1, -(-len(vocabulary) // 64))
+        book_rows = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        genre_codes = np.asarray(genre_codes, dtype=np.uint64)
+
+        masks = np.zeros((len(offsets) - 1, n_words), dtype=np.uint64)
+        np.bitwise_or.at(masks,
+                         (book_rows, (genre_codes // 64).astype(np.intp)),
+                         np.left_shift(np.uint64(1), genre_codes % 64))
+        return cls(vocabulary, masks)
+
+    def encode(self, genres):
+        """Mask of ``genres``, or None if one of them is not a known genre"""
+        mask = np.zeros(self.masks.shape[1], dtype=np.uint64)
+        for genre in genres:
+            code = self.codes.get(genre)
+            if code is None:
+                return None
+            mask[code // 64] |= np.uint64(1) << np.uint64(code % 64)
+        return mask
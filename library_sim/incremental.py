@@ -0,0 +1,172 @@
+"""Incremental updates of a published recommendation index.
+
+When books are added to (or edited or removed from) ``metadata``,
+``update_index`` brings the published build up to date without refitting
+the TF-IDF model or recomputing every neighbor list:
+
+* rows are matched to the build by ``unique_id`` and a hash of their
+  description, so only new and changed rows are transformed, with the
+  build's stored vocabulary and idf weights;
+* new and changed rows get exact neighbor lists against the whole catalog;
+* every other list is patched: the new rows' scores against it are merged
+  into its stored top-K, which is exact because a book can only enter a
+  list by outscoring its current last entry;
+* lists that pointed at a changed or removed row are recomputed.
+
+Terms unseen by the original fit are dropped by the transform and the idf
+weights go stale as the catalog grows, so ``update_index`` raises
+``RefitNeeded`` once too many tokens were out of vocabulary or too many rows
+changed since the last full fit, and the caller rebuilds from scratch.
+"""
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+from library_sim import index_store
+from library_sim.neighbors import (BLOCK_CELLS, DEFAULT_K, NeighborIndex,
+                                  merge_neighbors, query_rows)
+
+# refit once this share of the tokens transformed since the last full fit
+# was missing from its vocabulary
+MAX_OOV_RATIO = 0.1
+# ... or once this share of the catalog was added or changed since then
+MAX_CHANGED_RATIO = 0.25
+
+
+class RefitNeeded(Exception):
+    """The build has drifted too far to be updated in place"""
+
+
+def desc_hashes(descs):
+    """64-bit hash of every description, to spot changed rows between
+    builds"""
+    return np.array([int.from_bytes(hashlib.blake2b(
+                         str(desc).encode(), digest_size=8).digest(),
+                     'little') for desc in descs], dtype=np.uint64)
+
+
+def match_rows(old_ids, old_hashes, new_ids, new_hashes):
+    """Old row of every new row whose description is unchanged, else -1"""
+    source = pd.Index(np.asarray(old_ids)).get_indexer(new_ids)
+    kept = source >= 0
+    kept[kept] = old_hashes[source[kept]] == new_hashes[kept]
+    source[~kept] = -1
+    return source
+
+
+def count_oov(vectorizer, descs):
+    """Tokens of ``descs`` in total and missing from the vocabulary"""
+    analyzer = vectorizer.build_analyzer()
+    vocabulary = vectorizer.vocabulary
+    total = oov = 0
+    for desc in descs:
+        tokens = analyzer(desc)
+        total += len(tokens)
+        oov += sum(token not in vocabulary for token in tokens)
+    return total, oov
+
+
+def update_neighbors(old_index, source, desc_matrix, fresh):
+    """Neighbor lists for the new catalog from the old ones.
+
+    ``source`` maps new rows to old rows (-1 for ``fresh`` rows) and
+    ``desc_matrix`` is the new normalized TF-IDF matrix. Returns the new
+    NeighborIndex and the number of lists recomputed from scratch.
+    """
+    n_books = desc_matrix.shape[0]
+    k = old_index.k
+    old_to_new = np.full(len(old_index), -1, dtype=np.int64)
+    kept = np.flatnonzero(source >= 0)
+    old_to_new[source[kept]] = kept
+
+    indices = np.empty((n_books, k), dtype=np.int32)
+    scores = np.empty((n_books, k), dtype=np.float32)
+    stored = old_to_new[np.asarray(old_index.indices)[source[kept]]]
+    indices[kept] = stored
+    scores[kept] = np.asarray(old_index.scores)[source[kept]]
+
+    # lists that lost an entry have to be recomputed in full; the others
+    # only need the fresh rows merged in
+    stale = (stored < 0).any(axis=1)
+    patch = kept[~stale]
+    recompute = np.union1d(fresh, kept[stale])
+
+    fresh_matrix = desc_matrix[fresh]
+    block_size = max(1, BLOCK_CELLS // max(len(fresh), 1))
+    for start in range(0, len(patch) if len(fresh) else 0, block_size):
+        rows = patch[start:start + block_size]
+        cand_scores = (desc_matrix[rows] @ fresh_matrix.T).toarray()
+        indices[rows], scores[rows] = merge_neighbors(
+            indices[rows], scores[rows],
+            np.broadcast_to(fresh, cand_scores.shape),
+            cand_scores.astype(np.float32), k)
+
+    block_size = max(1, BLOCK_CELLS // n_books)
+    for start in range(0, len(recompute), block_size):
+        rows = recompute[start:start + block_size]
+        indices[rows], scores[rows] = query_rows(desc_matrix, rows, k)
+
+    return NeighborIndex(indices, scores, desc_matrix), len(recompute)
+
+
+def update_index(build_dir, table, k=DEFAULT_K,
+                 max_oov_ratio=MAX_OOV_RATIO,
+                 max_changed_ratio=MAX_CHANGED_RATIO):
+    """Bring the build in ``build_dir`` up to date with ``table``.
+
+    ``table`` is the catalog as returned by ``fetch_metadata``. Returns
+    ``(vectorizer, sim_index, hashes, fit_stats)`` ready for
+    ``index_store.save_build``, or None when nothing changed. Raises
+    RefitNeeded when a full build is due instead.
+    """
+    manifest = index_store.load_manifest(build_dir)
+    new_ids = table['unique_id'].to_numpy()
+    if manifest['k'] != min(k, len(new_ids)):
+        raise RefitNeeded(f"build keeps {manifest['k']} neighbors, "
+                          f"{k} requested")
+
+    descs = table['desc'].astype(str).to_numpy()
+    hashes = desc_hashes(descs)
+    source = match_rows(index_store.load_ids(build_dir),
+                        index_store.load_desc_hashes(build_dir),
+                        new_ids, hashes)
+    fresh = np.flatnonzero(source < 0)
+    if not len(fresh) and len(new_ids) == manifest['n_books']:
+        return None
+
+    vectorizer = index_store.load_vectorizer(build_dir)
+    total, oov = count_oov(vectorizer, descs[fresh])
+    fit_stats = {
+        'fit_books': manifest['fit_books'],
+        'rows_since_fit': manifest['rows_since_fit'] + len(fresh),
+        'transformed_tokens': manifest['transformed_tokens'] + total,
+        'oov_tokens': manifest['oov_tokens'] + oov,
+        'updated_from': os.path.basename(os.path.normpath(build_dir)),
+    }
+    oov_ratio = fit_stats['oov_tokens'] / max(
+        fit_stats['transformed_tokens'], 1)
+    if oov_ratio > max_oov_ratio:
+        raise RefitNeeded(f'{oov_ratio:.1%} of new tokens are out of '
+                          f'vocabulary')
+    changed_ratio = fit_stats['rows_since_fit'] / max(
+        fit_stats['fit_books'], 1)
+    if changed_ratio > max_changed_ratio:
+        raise RefitNeeded(f'{changed_ratio:.1%} of the catalog changed '
+                          f'since the last full fit')
+
+    old_index = index_store.load_neighbor_index(build_dir)
+    old_matrix = old_index.desc_matrix
+    fresh_matrix = normalize(vectorizer.transform(descs[fresh]))
+    take = source.copy()
+    take[fresh] = old_matrix.shape[0] + np.arange(len(fresh))
+    desc_matrix = sparse.vstack([old_matrix, fresh_matrix],
+                                format='csr')[take]
+
+    sim_index, recomputed = update_neighbors(old_index, source, desc_matrix,
+                                             fresh)
+    fit_stats['recomputed_rows'] = recomputed
+    return vectorizer, sim_index, hashes, fit_stats
@@ -0,0 +1,193 @@
+"""On-disk layout of the recommendation index.
+
+Every build is written to its own directory under ``index/`` and the name of
+the build the app should serve is kept in ``index/CURRENT``::
+
+    index/
+        CURRENT
+        20230412-101500/
+            manifest.json
+            ids.npy            unique_id of every catalog row
+            desc_hashes.npy    hash of every row's description, used to
+                               find changed rows for incremental updates
+            vocabulary.npy     TF-IDF terms in column order
+            idf.npy            TF-IDF idf weights in column order
+            neighbor_indices.npy
+            neighbor_scores.npy
+            tfidf_data.npy     L2-normalized TF-IDF matrix in CSR form,
+            tfidf_indices.npy  used for exact filtered queries
+            tfidf_indptr.npy
+
+Arrays are plain ``.npy`` files so they can be memory-mapped: every server
+process shares the same pages from the OS cache instead of holding its own
+copy.
+
+Besides the shape of the build, ``manifest.json`` records how far the build
+has drifted from its last full TF-IDF fit (``fit_books``, ``rows_since_fit``,
+``transformed_tokens`` and ``oov_tokens``); see ``library_sim.incremental``.
+Builds made with ``library_sim.ann`` also record their settings and
+measured recall under ``ann``.
+"""
+import json
+import os
+import sys
+import time
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+
+from library_sim.config import INDEX_DIR
+from library_sim.neighbors import NeighborIndex
+
+FORMAT_VERSION = 3
+CURRENT_FILE = 'CURRENT'
+MANIFEST_FILE = 'manifest.json'
+
+
+def new_build_dir(root=INDEX_DIR):
+    build_id = time.strftime('%Y%m%d-%H%M%S')
+    path = os.path.join(root, build_id)
+    suffix = 0
+    while os.path.exists(path):
+        # an incremental update can follow a build within the same second
+        suffix += 1
+        path = os.path.join(root, f'{build_id}-{suffix}')
+    os.makedirs(path)
+    return path
+
+
+def save_build(build_dir, ids, vectorizer, sim_index, desc_hashes,
+               fit_stats=None, ann=None):
+    """Write one index build to ``build_dir``.
+
+    ``fit_stats`` are the drift counters to record in the manifest; a build
+    without them is a full fit of its own catalog. ``ann`` holds the
+    settings and measured recall of an approximate build.
+    """
+    vocabulary = vectorizer.get_feature_names_out()
+    np.save(os.path.join(build_dir, 'ids.npy'), np.asarray(ids))
+    np.save(os.path.join(build_dir, 'desc_hashes.npy'),
+            np.asarray(desc_hashes, dtype=np.uint64))
+    np.save(os.path.join(build_dir, 'vocabulary.npy'),
+            vocabulary.astype(str))
+    np.save(os.path.join(build_dir, 'idf.npy'), vectorizer.idf_)
+    np.save(os.path.join(build_dir, 'neighbor_indices.npy'),
+            sim_index.indices)
+    np.save(os.path.join(build_dir, 'neighbor_scores.npy'), sim_index.scores)
+    desc_matrix = sim_index.desc_matrix
+    for name in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(build_dir, f'tfidf_{name}.npy'),
+                getattr(desc_matrix, name))
+
+    manifest = {'format_version': FORMAT_VERSION,
+                'built_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'n_books': len(sim_index),
+                'k': sim_index.k,
+                'n_terms': len(vocabulary)}
+    if fit_stats is None:
+        fit_stats = {'fit_books': len(sim_index), 'rows_since_fit': 0,
+                     'transformed_tokens': 0, 'oov_tokens': 0}
+    manifest.update(fit_stats)
+    if ann is not None:
+        manifest['ann'] = ann
+    with open(os.path.join(build_dir, MANIFEST_FILE), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    return manifest
+
+
+def publish_build(build_dir, root=INDEX_DIR):
+    """Point ``CURRENT`` at ``build_dir``; readers never see a partial file"""
+    tmp_path = os.path.join(root, CURRENT_FILE + '.tmp')
+    with open(tmp_path, 'w') as current_file:
+        current_file.write(os.path.basename(build_dir))
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILE))
+
+
+def current_build_dir(root=INDEX_DIR):
+    """Directory of the published build, or None if nothing is published"""
+    try:
+        with open(os.path.join(root, CURRENT_FILE)) as current_file:
+            build_id = current_file.read().strip()
+    except FileNotFoundError:
+        return None
+
+    build_dir = os.path.join(root, build_id)
+    try:
+        manifest = load_manifest(build_dir)
+    except FileNotFoundError:
+        return None
+    if manifest.get('format_version') != FORMAT_VERSION:
+        return None
+    return build_dir
+
+
+def load_ids(build_dir):
+    return np.load(os.path.join(build_dir, 'ids.npy'), mmap_mode='r')
+
+
+def load_desc_hashes(build_dir):
+    return np.load(os.path.join(build_dir, 'desc_hashes.npy'))
+
+
+def load_manifest(build_dir):
+    with open(os.path.join(build_dir, MANIFEST_FILE)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def load_desc_matrix(build_dir):
+    manifest = load_manifest(build_dir)
+    parts = [np.load(os.path.join(build_dir, f'tfidf_{name}.npy'),
+                     mmap_mode='r')
+             for name in ('data', 'indices', 'indptr')]
+    return sparse.csr_matrix(tuple(parts), copy=False,
+                             shape=(manifest['n_books'], manifest['n_terms']))
+
+
+def load_neighbor_index(build_dir):
+    indices = np.load(os.path.join(build_dir, 'neighbor_indices.npy'),
+                      mmap_mode='r')
+    scores = np.load(os.path.join(build_dir, 'neighbor_scores.npy'),
+                     mmap_mode='r')
+    return NeighborIndex(indices, scores, load_desc_matrix(build_dir))
+
+
+def load_vectorizer(build_dir):
+    """Rebuild the fitted TfidfVectorizer without refitting it"""
+    vocabulary = np.load(os.path.join(build_dir, 'vocabulary.npy'))
+    vectorizer = TfidfVectorizer(
+        stop_words='english',
+        vocabulary={term: col for col, term in enumerate(vocabulary)})
+    vectorizer.idf_ = np.load(os.path.join(build_dir, 'idf.npy'))
+    return vectorizer
+
+
+def load_published_index(unique_ids, root=INDEX_DIR):
+    """Memory-map the published neighbor index for the catalog.
+
+    ``unique_ids`` are the catalog ids in row order. Returns None when there
+    is no published build. A build made from a different catalog is still
+    served, remapped to the catalog's rows by ``unique_id``: books added
+    since have no neighbors and removed ones are never recommended until
+    the next ``python -m library_sim.build_index --incremental``.
+    """
+    build_dir = current_build_dir(root)
+    if build_dir is None:
+        return None
+    build_ids = load_ids(build_dir)
+    unique_ids = np.asarray(unique_ids)
+    sim_index = load_neighbor_index(build_dir)
+    if np.array_equal(build_ids, unique_ids):
+        return sim_index
+
+    # build ids are in catalog (unique_id) order, so they are sorted
+    source_rows = np.searchsorted(build_ids, unique_ids)
+    source_rows[source_rows == len(build_ids)] = 0
+    found = build_ids[source_rows] == unique_ids
+    source_rows[~found] = -1
+    print(f'WARNING: index build {os.path.basename(build_dir)} is out of '
+          f'date: {int((~found).sum())} books are not in it and '
+          f'{len(build_ids) - int(found.sum())} of its books were removed; '
+          f'serving it anyway until `python -m library_sim.build_index '
+          f'--incremental` runs', file=sys.stderr)
+    return sim_index.remap(source_rows)
@@ -0,0 +1,375 @@
+"""Versioned schema migrations and a query-plan report.
+
+    python -m library_sim.migrate [--sqlite PATH] [--to VERSION]
+    python -m library_sim.migrate --explain [--sqlite PATH]
+
+``migrate(conn)`` brings a MySQL database or a SQLite stand-in
+(``library_sim.sqlite_db``) up to the latest entry of ``MIGRATIONS``: the
+tables with their primary keys, the foreign keys of ``inventory`` and
+``circulation``, the secondary indexes the app's lookups need and, on
+MySQL, a FULLTEXT index on title and author. Applied versions are recorded
+in ``schema_migrations``, so each one runs once. MySQL commits every DDL
+statement on its own, so each MySQL step checks ``information_schema``
+first and a migration that failed halfway can simply be run again. SQLite
+runs a whole migration in one transaction.
+
+``--explain`` prints the ``EXPLAIN`` plan of every query the app issues
+(``app_queries``) and exits non-zero when one that should use an index
+scans a whole table.
+"""
+import argparse
+import sys
+import time
+
+from library_sim import db, sqlite_db
+
+MIGRATIONS_TABLE = {
+    'sqlite': """CREATE TABLE IF NOT EXISTS schema_migrations (
+                 version INTEGER PRIMARY KEY,
+                 description TEXT NOT NULL,
+                 applied_at TEXT NOT NULL);""",
+    'mysql': """CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INT NOT NULL PRIMARY KEY,
+                description VARCHAR(255) NOT NULL,
+                applied_at DATETIME NOT NULL) ENGINE=InnoDB;""",
+}
+
+SQLITE_TABLES = {
+    'metadata': """metadata (unique_id INTEGER PRIMARY KEY,
+                   title TEXT NOT NULL,
+                   author TEXT NOT NULL,
+                   genre TEXT NOT NULL,
+                   "desc" TEXT,
+                   cover_link TEXT)""",
+    'inventory': """inventory (book_id INTEGER PRIMARY KEY{references},
+                    total_copies INTEGER NOT NULL,
+                    available INTEGER NOT NULL)""",
+    'users': """users (user_name TEXT PRIMARY KEY,
+                user_pass TEXT NOT NULL)""",
+    'circulation': """circulation (
+                      cir_key INTEGER PRIMARY KEY AUTOINCREMENT,
+                      user_id TEXT NOT NULL,
+                      book_id INTEGER NOT NULL{references})""",
+}
+SQLITE_REFERENCES = {
+    'inventory': ' REFERENCES metadata (unique_id)',
+    'circulation': ' REFERENCES inventory (book_id)',
+}
+
+MYSQL_TABLES = [
+    """CREATE TABLE IF NOT EXISTS metadata (
+       unique_id INT NOT NULL PRIMARY KEY,
+       title VARCHAR(255) NOT NULL,
+       author VARCHAR(255) NOT NULL,
+       genre TEXT NOT NULL,
+       `desc` TEXT,
+       cover_link VARCHAR(512)) ENGINE=InnoDB;""",
+    """CREATE TABLE IF NOT EXISTS inventory (
+       book_id INT NOT NULL PRIMARY KEY,
+       total_copies INT NOT NULL,
+       available INT NOT NULL) ENGINE=InnoDB;""",
+    """CREATE TABLE IF NOT EXISTS users (
+       user_name VARCHAR(64) NOT NULL PRIMARY KEY,
+       user_pass CHAR(64) NOT NULL) ENGINE=InnoDB;""",
+    """CREATE TABLE IF NOT EXISTS circulation (
+       cir_key INT NOT NULL AUTO_INCREMENT PRIMARY KEY,
+       user_id VARCHAR(64) NOT NULL,
+       book_id INT NOT NULL) ENGINE=InnoDB;""",
+]
+PRIMARY_KEYS = {'metadata': 'unique_id', 'inventory': 'book_id',
+                'users': 'user_name', 'circulation': 'cir_key'}
+# (table, column, parent table, parent column)
+FOREIGN_KEYS = [('inventory', 'book_id', 'metadata', 'unique_id'),
+                ('circulation', 'book_id', 'inventory', 'book_id')]
+# name -> (table, columns); title and author are indexed on a prefix in
+# MySQL so the index also fits a TEXT column
+INDEXES = {
+    'metadata_title': ('metadata', ['title']),
+    'metadata_author': ('metadata', ['author']),
+    'circulation_user_book': ('circulation', ['user_id', 'book_id']),
+    'circulation_book': ('circulation', ['book_id']),
+}
+MYSQL_PREFIX = {'title': 191, 'author': 191}
+# indexes of earlier schemas that newer ones make redundant
+DROPPED_INDEXES = {'circulation_user': 'circulation'}
+
+
+def dialect(conn):
+    return 'sqlite' if isinstance(conn, sqlite_db.Connection) else 'mysql'
+
+
+def sqlite_create_tables(cur):
+    for table, columns in SQLITE_TABLES.items():
+        cur.execute(f"""CREATE TABLE IF NOT EXISTS
+                    {columns.format(references='')};""")
+
+
+def sqlite_add_foreign_keys(cur):
+    """Rebuild the tables that still lack their foreign key; SQLite cannot
+    add one to an existing table"""
+    for table, column, parent, _ in FOREIGN_KEYS:
+        cur.execute(f"""PRAGMA foreign_key_list({table});""")
+        if any(row[2] == parent and row[3] == column
+               for row in cur.fetchall()):
+            continue
+        columns = SQLITE_TABLES[table].format(
+            references=SQLITE_REFERENCES[table])
+        cur.execute(f"""CREATE TABLE {table}_rebuilt
+                    {columns[len(table):]};""")
+        cur.execute(f"""INSERT INTO {table}_rebuilt
+                    SELECT * FROM {table};""")
+        cur.execute(f"""DROP TABLE {table};""")
+        cur.execute(f"""ALTER TABLE {table}_rebuilt RENAME TO {table};""")
+
+
+def sqlite_indexes(cur):
+    for name in DROPPED_INDEXES:
+        cur.execute(f"""DROP INDEX IF EXISTS {name};""")
+    for name, (table, columns) in INDEXES.items():
+        cur.execute(f"""CREATE INDEX IF NOT EXISTS {name}
+                    ON {table} ({', '.join(columns)});""")
+
+
+def mysql_has(cur, view, table, condition, params=()):
+    cur.execute(f"""SELECT COUNT(*) FROM information_schema.{view}
+                WHERE table_schema = DATABASE() AND table_name = %s
+                AND {condition};""", (table,) + tuple(params))
+    return cur.fetchall()[0][0] > 0
+
+
+def mysql_create_tables(cur):
+    for statement in MYSQL_TABLES:
+        cur.execute(statement)
+    # tables that existed before the migrations may lack a primary key
+    for table, column in PRIMARY_KEYS.items():
+        if not mysql_has(cur, 'table_constraints', table,
+                         "constraint_type = 'PRIMARY KEY'"):
+            cur.execute(f"""ALTER TABLE {table}
+                        ADD PRIMARY KEY ({column});""")
+
+
+def mysql_add_foreign_keys(cur):
+    for table, column, parent, parent_column in FOREIGN_KEYS:
+        name = f'{table}_{column}_fk'
+        if not mysql_has(cur, 'table_constraints', table,
+                         "constraint_name = %s", (name,)):
+            cur.execute(f"""ALTER TABLE {table} ADD CONSTRAINT {name}
+                        FOREIGN KEY ({column})
+                        REFERENCES {parent} ({parent_column});""")
+
+
+def mysql_indexes(cur):
+    for name, table in DROPPED_INDEXES.items():
+        if mysql_has(cur, 'statistics', table, "index_name = %s", (name,)):
+            cur.execute(f"""DROP INDEX {name} ON {table};""")
+    for name, (table, columns) in INDEXES.items():
+        if not mysql_has(cur, 'statistics', table, "index_name = %s",
+                         (name,)):
+            parts = [f'{column}({MYSQL_PREFIX[column]})'
+                     if column in MYSQL_PREFIX else column
+                     for column in columns]
+            cur.execute(f"""CREATE INDEX {name}
+                        ON {table} ({', '.join(parts)});""")
+
+
+def mysql_fulltext(cur):
+    if not mysql_has(cur, 'statistics', 'metadata', "index_name = %s",
+                     ('metadata_title_author',)):
+        cur.execute("""ALTER TABLE metadata
+                    ADD FULLTEXT INDEX metadata_title_author
+                    (title, author);""")
+
+
+# (version, description, {dialect: step}); a step takes a cursor. SQLite
+# has no FULLTEXT index (its equivalent is an FTS5 virtual table) and the
+# app's title/author search runs in memory, so version 4 is MySQL-only.
+MIGRATIONS = [
+    (1, 'tables and primary keys',
+     {'sqlite': sqlite_create_tables, 'mysql': mysql_create_tables}),
+    (2, 'foreign keys of inventory and circulation',
+     {'sqlite': sqlite_add_foreign_keys, 'mysql': mysql_add_foreign_keys}),
+    (3, 'title, author and circulation indexes',
+     {'sqlite': sqlite_indexes, 'mysql': mysql_indexes}),
+    (4, 'FULLTEXT index on title and author',
+     {'mysql': mysql_fulltext}),
+]
+
+
+def applied_versions(conn):
+    cur = conn.cursor()
+    try:
+        cur.execute(MIGRATIONS_TABLE[dialect(conn)])
+        cur.execute("""SELECT version FROM schema_migrations;""")
+        versions = {row[0] for row in cur.fetchall()}
+    finally:
+        cur.close()
+    conn.commit()
+    return versions
+
+
+def migrate(conn, target=None):
+    """Apply the migrations after the current version, up to ``target``
+    (default: the latest); returns the versions applied"""
+    kind = dialect(conn)
+    done = applied_versions(conn)
+    applied = []
+    for version, description, steps in MIGRATIONS:
+        if version in done or (target is not None and version > target):
+            continue
+        if kind == 'sqlite':
+            conn.begin_immediate()
+        cur = conn.cursor()
+        try:
+            step = steps.get(kind)
+            if step is not None:
+                step(cur)
+            cur.execute("""INSERT INTO schema_migrations
+                        VALUES (%s, %s, %s);""",
+                        (version, description,
+                         time.strftime('%Y-%m-%d %H:%M:%S')))
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        applied.append(version)
+    return applied
+
+
+def app_queries():
+    """``(name, sql, params, scans)`` for every query the app issues, with
+    sample parameters; ``scans`` is True for queries that read a whole
+    table on purpose.
+
+    The statements are the module constants their callers execute, so the
+    report cannot drift from the code.
+    """
+    from library_sim import availability, catalog, circulation, search, users
+    from library_sim.covers import COVER_LINKS_QUERY
+    from library_sim.precompute import (CIRCULATION_STATE, USER_BOOKS_QUERY,
+                                        USER_FINGERPRINTS)
+
+    ids = (1, 2, 3)
+    in_ids = ', '.join(['%s'] * len(ids))
+    cases = ' '.join(['WHEN %s THEN %s'] * len(ids))
+    return [
+        ('catalog.load', catalog.METADATA_QUERY, (), True),
+        ('catalog.count', catalog.COUNT_QUERY, (), True),
+        ('catalog.descriptions',
+         catalog.DESCRIPTIONS_QUERY.format(placeholders=in_ids), ids, False),
+        ('search.rows', search.SEARCH_ROWS_QUERY, (), True),
+        ('search.metadata',
+         search.METADATA_ROWS_QUERY.format(placeholders=in_ids), ids, False),
+        ('availability.counts',
+         availability.AVAILABILITY_QUERY.format(placeholders=in_ids), ids,
+         False),
+        ('availability.loans',
+         availability.LOANS_QUERY.format(placeholders='%s'), ('user0',),
+         False),
+        ('circulation.checkout', circulation.TAKE_COPY, ids[:1], False),
+        ('circulation.add_loan', circulation.ADD_LOAN, ('user0', 1), False),
+        ('circulation.adjust_available',
+         circulation.ADJUST_AVAILABLE.format(cases=cases,
+                                             placeholders=in_ids),
+         (1, -1, 2, -1, 3, -1) + ids, False),
+        ('circulation.lock_available',
+         circulation.LOCK_AVAILABLE.format(placeholders=in_ids), ids, False),
+        ('circulation.lock_copies',
+         circulation.LOCK_COPIES.format(placeholders=in_ids), ids, False),
+        ('circulation.lock_loans',
+         circulation.LOCK_LOANS.format(placeholders=in_ids),
+         ('user0',) + ids, False),
+        ('circulation.close_loans',
+         circulation.CLOSE_LOANS.format(placeholders=in_ids),
+         ids + ('user0',), False),
+        ('users.create', users.CREATE_USER, ('user0', 'user0'), False),
+        ('users.login', users.LOGIN_QUERY, ('user0', 'user0'), False),
+        ('precompute.state', CIRCULATION_STATE, (), True),
+        ('precompute.fingerprints', USER_FINGERPRINTS, (), True),
+        ('precompute.user_books',
+         USER_BOOKS_QUERY.format(placeholders='%s'), ('user0',), False),
+        ('covers.links', COVER_LINKS_QUERY, (), True),
+    ]
+
+
+def explain(conn, sql, params):
+    """``(plan lines, full scan?)`` of one query"""
+    cur = conn.cursor()
+    try:
+        if dialect(conn) == 'sqlite':
+            cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+            details = [row[3] for row in cur.fetchall()]
+            scans = [detail for detail in details
+                     if detail.startswith('SCAN ')]
+            return details, bool(scans)
+        cur.execute('EXPLAIN ' + sql, params)
+        names = [column[0] for column in cur.description]
+        plan = [dict(zip(names, row)) for row in cur.fetchall()]
+        lines = [f"{step['table']}: type={step['type']} key={step['key']} "
+                 f"rows={step['rows']}" for step in plan]
+        # ALL reads every row, index every entry of an index; the step of
+        # an INSERT ... VALUES reads nothing but is reported as ALL
+        return lines, any(step['type'] in ('ALL', 'index')
+                          and step['select_type'] != 'INSERT'
+                          for step in plan)
+    finally:
+        cur.close()
+        conn.rollback()
+
+
+def explain_report(conn, out=sys.stdout):
+    """Print the plan of every ``app_queries`` query; returns the names of
+    the ones that scan a table they should not"""
+    regressions = []
+    for name, sql, params, scans in app_queries():
+        lines, full_scan = explain(conn, sql, params)
+        if full_scan and not scans:
+            flag = '  FULL SCAN'
+            regressions.append(name)
+        elif full_scan:
+            flag = '  (full scan expected)'
+        else:
+            flag = ''
+        print(f'{name}{flag}', file=out)
+        for line in lines:
+            print(f'    {line}', file=out)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='migrate a local SQLite library database '
+                        'instead of MySQL')
+    parser.add_argument('--to', type=int, metavar='VERSION',
+                        help='stop after this version (default: latest)')
+    parser.add_argument('--explain', action='store_true',
+                        help='report query plans instead of migrating')
+    args = parser.parse_args()
+    if args.sqlite:
+        conn = sqlite_db.connect(args.sqlite)
+    else:
+        conn = db.mysql_connect()
+
+    try:
+        if args.explain:
+            regressions = explain_report(conn)
+            if regressions:
+                print(f"full scans in: {', '.join(regressions)}",
+                      file=sys.stderr)
+                sys.exit(1)
+            return
+        applied = migrate(conn, args.to)
+        current = max(applied_versions(conn), default=0)
+        if applied:
+            print(f"applied {', '.join(map(str, applied))}; "
+                  f"schema at version {current}", file=sys.stderr)
+        else:
+            print(f'schema already at version {current}', file=sys.stderr)
+    finally:
+        conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,318 @@
+import multiprocessing
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sklearn.preprocessing import normalize
+
+# upper bound on the number of similarity cells held in memory at once while
+# building the index (2**24 float64 cells is ~128MB per block)
+BLOCK_CELLS = 2 ** 24
+# neighbors kept per book: the 20 recommendations book_rec shows by default
+# plus the book itself; a filtered query still scans the row when fewer than
+# that many pass (book_rec leaves out same-author books by default)
+DEFAULT_K = 21
+
+
+class NeighborIndex:
+    """Top-K most similar books for every row of the catalog.
+
+    ``indices[i]`` holds the catalog rows closest to row ``i`` (row ``i``
+    itself included) in descending cosine similarity and ``scores[i]`` the
+    matching similarities, so the index takes O(N*K) memory instead of the
+    O(N^2) of a dense similarity matrix.
+
+    ``desc_matrix`` is the L2-normalized TF-IDF matrix the index was built
+    from. It is optional and only needed by ``search`` when a filter leaves
+    too few of the stored neighbors.
+    """
+
+    def __init__(self, indices, scores, desc_matrix=None):
+        self.indices = indices
+        self.scores = scores
+        self.desc_matrix = desc_matrix
+
+    def __len__(self):
+        return self.indices.shape[0]
+
+    @property
+    def k(self):
+        return self.indices.shape[1]
+
+    def neighbors(self, row, k=None):
+        """Catalog rows most similar to ``row``, best match first"""
+        return self.indices[row, :k]
+
+    def neighbor_scores(self, row, k=None):
+        return self.scores[row, :k]
+
+    def remap(self, source_rows):
+        """This index over a catalog whose row ``i`` is row
+        ``source_rows[i]`` of this one.
+
+        Rows of -1 are books the index does not have: they get no neighbors
+        and an empty TF-IDF vector. Neighbors missing from the new catalog
+        are dropped from every list, which is padded with -1 and a score of
+        -inf. Unlike the memory-mapped original the result is held in
+        memory.
+        """
+        source_rows = np.asarray(source_rows, dtype=np.intp)
+        present = np.flatnonzero(source_rows >= 0)
+        kept = source_rows[present]
+        new_rows = np.full(len(self), -1, dtype=np.intp)
+        new_rows[kept] = present
+
+        indices = new_rows[np.asarray(self.indices[kept])]
+        scores = np.array(self.scores[kept], dtype=np.float32)
+        order = np.argsort(indices < 0, axis=1, kind='stable')
+        indices = np.take_along_axis(indices, order, axis=1)
+        scores = np.take_along_axis(scores, order, axis=1)
+        scores[indices < 0] = -np.inf
+
+        out_indices = np.full((len(source_rows), self.k), -1,
+                              dtype=self.indices.dtype)
+        out_scores = np.full((len(source_rows), self.k), -np.inf,
+                             dtype=np.float32)
+        out_indices[present] = indices
+        out_scores[present] = scores
+
+        desc_matrix = None
+        if self.desc_matrix is not None:
+            select = sparse.csr_matrix(
+                (np.ones(len(present)), (present, kept)),
+                shape=(len(source_rows), len(self)))
+            desc_matrix = (select @ self.desc_matrix).tocsr()
+        return NeighborIndex(out_indices, out_scores, desc_matrix)
+
+    def batch(self, rows, k=None):
+        """Neighbors and scores of many rows at once.
+
+        Returns two ``(len(rows), k)`` arrays, one neighbor set per row.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        return self.indices[rows, :k], self.scores[rows, :k]
+
+    def search(self, rows, k, allowed=None):
+        """Top-``k`` neighbors of each of ``rows`` among permitted books.
+
+        ``allowed(query_rows, candidates)`` gets the query rows as a column
+        and an array of candidate rows and returns which candidates may be
+        recommended. The filter is applied before the top-``k`` cut, so a
+        narrow filter still returns ``k`` books whenever that many qualify.
+        Rows with fewer matches are padded with -1 and a score of -inf.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        if allowed is None:
+            return self.batch(rows, k)
+
+        out_indices = np.full((len(rows), k), -1, dtype=np.intp)
+        out_scores = np.full((len(rows), k), -np.inf, dtype=np.float32)
+
+        # the stored lists are a prefix of the full ranking, so when enough
+        # of them pass the filter they already are the exact answer
+        candidates = np.asarray(self.indices[rows])
+        candidate_scores = np.asarray(self.scores[rows])
+        # -1 pads the lists of an index remapped to a changed catalog
+        ok = (candidates >= 0) & allowed(rows[:, None], candidates)
+        complete = ok.sum(axis=1) >= min(k, len(self))
+        # books added after a remapped index was built have no neighbors yet
+        complete |= candidates[:, 0] < 0
+        if self.desc_matrix is None:
+            complete[:] = True
+
+        done = np.flatnonzero(complete)
+        order = np.argsort(~ok[done], axis=1, kind='stable')[:, :k]
+        width = order.shape[1]
+        passed = np.take_along_axis(ok[done], order, axis=1)
+        out_indices[done, :width] = np.where(
+            passed, np.take_along_axis(candidates[done], order, axis=1), -1)
+        out_scores[done, :width] = np.where(
+            passed, np.take_along_axis(candidate_scores[done], order, axis=1),
+            -np.inf)
+
+        missing = np.flatnonzero(~complete)
+        n_books = len(self)
+        block_size = max(1, BLOCK_CELLS // n_books)
+        all_rows = np.arange(n_books)[None, :]
+        for start in range(0, len(missing), block_size):
+            positions = missing[start:start + block_size]
+            block_rows = rows[positions]
+            block = (self.desc_matrix[block_rows]
+                     @ self.desc_matrix.T).toarray()
+            block[~allowed(block_rows[:, None], all_rows)] = -np.inf
+            cols, values = top_k(block, k)
+            width = cols.shape[1]
+            out_indices[positions, :width] = np.where(values > -np.inf,
+                                                      cols, -1)
+            out_scores[positions, :width] = values
+
+        return out_indices, out_scores
+
+    def search_profile(self, rows, k, weights=None, allowed=None):
+        """Top-``k`` books for a reader who liked the books at ``rows``.
+
+        The reader's profile is the weighted sum of the liked books' TF-IDF
+        vectors, L2-normalized, and every book is scored by its cosine
+        similarity to it in one sparse matrix-vector product; the liked
+        books themselves are left out. ``allowed(candidates)`` returns
+        which candidate rows may be recommended.
+
+        Returns ``(indices, scores, liked)`` of at most ``k`` results, where
+        ``liked[j]`` is the position in ``rows`` of the liked book
+        contributing most to result ``j``'s score. Needs ``desc_matrix``.
+        """
+        rows = np.asarray(rows, dtype=np.intp)
+        if weights is None:
+            weights = np.ones(len(rows))
+        weights = np.asarray(weights, dtype=np.float64)
+
+        liked = self.desc_matrix[rows]
+        profile = normalize(sparse.csr_matrix(weights) @ liked)
+        scores = np.asarray((self.desc_matrix @ profile.T).todense()).ravel()
+        scores[rows] = -np.inf
+        if allowed is not None:
+            scores[~allowed(np.arange(len(self)))] = -np.inf
+
+        indices, scores = top_k(scores[None, :], min(k, len(self)))
+        found = scores[0] > -np.inf
+        indices, scores = indices[0, found], scores[0, found]
+        # each liked book's share of every result's (unnormalized) score
+        shares = (liked @ self.desc_matrix[indices].T).toarray()
+        shares *= weights[:, None]
+        return indices, scores, shares.argmax(axis=0)
+
+
+def top_k(block, k):
+    """Column positions and values of the ``k`` largest entries of each row.
+
+    ``block`` is a dense 2-D array. Uses partial selection rather than a full
+    sort, but orders the result exactly like a stable descending sort would:
+    equal values are ranked by the lower column first.
+    """
+    n_rows, n_cols = block.shape
+    if k >= n_cols:
+        cols = np.argsort(-block, axis=1, kind='stable')
+        return cols, np.take_along_axis(block, cols, axis=1)
+
+    part = np.argpartition(-block, k - 1, axis=1)[:, :k]
+    kth = np.take_along_axis(block, part, axis=1).min(axis=1)[:, None]
+    above = block > kth
+    tied = block == kth
+    room = k - above.sum(axis=1, keepdims=True)
+    keep = above | (tied & (np.cumsum(tied, axis=1) <= room))
+    cols = np.nonzero(keep)[1].reshape(n_rows, k)
+
+    values = np.take_along_axis(block, cols, axis=1)
+    order = np.argsort(-values, axis=1, kind='stable')
+    return (np.take_along_axis(cols, order, axis=1),
+            np.take_along_axis(values, order, axis=1))
+
+
+def merge_neighbors(indices, scores, cand_indices, cand_scores, k):
+    """Top-``k`` of stored lists extended with extra candidates.
+
+    All arguments are 2-D with one row per list. Ties are ranked by the
+    lower catalog row, as in a full build.
+    """
+    indices = np.concatenate([indices, cand_indices], axis=1)
+    scores = np.concatenate([scores, cand_scores], axis=1)
+    order = np.lexsort((indices, -scores))[:, :k]
+    return (np.take_along_axis(indices, order, axis=1),
+            np.take_along_axis(scores, order, axis=1))
+
+
+def query_rows(desc_matrix, rows, k=20, transposed=None):
+    """Exact top-``k`` neighbors of several catalog rows in one call.
+
+    ``desc_matrix`` is the L2-normalized CSR description matrix and ``rows``
+    anything that selects its rows. The similarities of all requested rows
+    are computed as one 2-D block and reduced with ``top_k``. Callers
+    querying many blocks pass ``transposed=desc_matrix.T.tocsr()`` so it is
+    not converted again for every block.
+    """
+    if transposed is None:
+        transposed = desc_matrix.T
+    block = (desc_matrix[rows] @ transposed).toarray()
+    return top_k(block, min(k, desc_matrix.shape[0]))
+
+
+def save_csr(directory, name, matrix):
+    for part in ('data', 'indices', 'indptr'):
+        np.save(os.path.join(directory, f'{name}_{part}.npy'),
+                getattr(matrix, part))
+
+
+def load_csr(directory, name, shape):
+    """CSR matrix over memory-mapped ``save_csr`` files"""
+    parts = [np.load(os.path.join(directory, f'{name}_{part}.npy'),
+                     mmap_mode='r')
+             for part in ('data', 'indices', 'indptr')]
+    return sparse.csr_matrix(tuple(parts), shape=shape, copy=False)
+
+
+# (desc_matrix, transposed) of a block worker process
+_worker_matrices = None
+
+
+def init_block_worker(directory, shape):
+    global _worker_matrices
+    _worker_matrices = (load_csr(directory, 'desc', shape),
+                        load_csr(directory, 'desc_t', shape[::-1]))
+
+
+def block_neighbors(start, stop, k):
+    """Worker task: neighbor lists of rows ``start:stop``"""
+    desc_matrix, transposed = _worker_matrices
+    indices, scores = query_rows(desc_matrix, slice(start, stop), k,
+                                 transposed)
+    return start, indices.astype(np.int32), scores.astype(np.float32)
+
+
+def build_neighbor_index(desc_matrix, k=DEFAULT_K, block_size=None,
+                         workers=1):
+    """Build a NeighborIndex from a (sparse) TF-IDF description matrix.
+
+    Similarities are computed ``block_size`` rows at a time, so peak memory is
+    bounded by the block rather than by the full N x N matrix. With
+    ``workers > 1`` the blocks are spread over that many processes, which
+    memory-map one on-disk copy of the matrix instead of each receiving a
+    pickled one; peak memory is then one block per worker.
+    """
+    desc_matrix = normalize(desc_matrix).tocsr()
+    transposed = desc_matrix.T.tocsr()
+    n_books = desc_matrix.shape[0]
+    k = min(k, n_books)
+    if block_size is None:
+        block_size = max(1, BLOCK_CELLS // max(n_books, 1))
+    blocks = [(start, min(start + block_size, n_books))
+              for start in range(0, n_books, block_size)]
+
+    indices = np.empty((n_books, k), dtype=np.int32)
+    scores = np.empty((n_books, k), dtype=np.float32)
+    if workers <= 1 or len(blocks) <= 1:
+        for start, stop in blocks:
+            indices[start:stop], scores[start:stop] = query_rows(
+                desc_matrix, slice(start, stop), k, transposed)
+        return NeighborIndex(indices, scores, desc_matrix)
+
+    directory = tempfile.mkdtemp(prefix='neighbors-')
+    try:
+        save_csr(directory, 'desc', desc_matrix)
+        save_csr(directory, 'desc_t', transposed)
+        del transposed
+        context = multiprocessing.get_context('spawn')
+        with ProcessPoolExecutor(workers, mp_context=context,
+                                 initializer=init_block_worker,
+                                 initargs=(directory,
+                                           desc_matrix.shape)) as pool:
+            for start, block_indices, block_scores in pool.map(
+                    block_neighbors, *zip(*blocks), [k] * len(blocks)):
+                stop = start + len(block_indices)
+                indices[start:stop] = block_indices
+                scores[start:stop] = block_scores
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    return NeighborIndex(indices, scores, desc_matrix)
@@ -0,0 +1,282 @@
+"""Precompute every reader's My Recs in the background.
+
+Run it next to the app::
+
+    python -m library_sim.precompute [--workers 4] [--interval 5] [--once]
+
+It polls ``circulation`` for a cheap fingerprint (row count, highest
+``cir_key`` and sum of book ids, per reader and overall, plus the published
+index build), recomputes the recommendations of readers whose fingerprint
+changed in a pool of worker processes and writes the finished display rows
+to a local SQLite store. The My Recs page then reads one row by user id
+with ``user_recs`` and only computes in-process for readers the worker has
+not seen yet.
+
+The store is ``recs/user_recs.sqlite`` unless ``[precompute] store`` in the
+secrets file or ``LIBRARY_SIM_RECS_STORE`` points elsewhere.
+"""
+import argparse
+import functools
+import json
+import multiprocessing
+import os
+import pathlib
+import sqlite3
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from library_sim import db, sqlite_db
+from library_sim.config import ROOT, load_secrets
+from library_sim.engine import get_engine, reset_engine
+from library_sim.index_store import current_build_dir
+
+RECS_STORE = os.path.join(ROOT, 'recs', 'user_recs.sqlite')
+POLL_INTERVAL = 5
+# readers per task sent to a worker process
+BATCH_USERS = 100
+REC_COUNT = 10
+DISPLAY_COLUMNS = ['Book ID', 'You May Like', 'Cover', 'Description',
+                   'Because You Liked']
+
+STORE_SCHEMA = """CREATE TABLE IF NOT EXISTS user_recs (
+                  user_id TEXT PRIMARY KEY,
+                  fingerprint TEXT NOT NULL,
+                  computed_at REAL NOT NULL,
+                  recs TEXT NOT NULL);"""
+
+CIRCULATION_STATE = """SELECT COUNT(*), MAX(circulation.cir_key),
+                       SUM(circulation.book_id)
+                       FROM circulation;"""
+USER_FINGERPRINTS = """SELECT circulation.user_id, COUNT(*),
+                       MAX(circulation.cir_key), SUM(circulation.book_id)
+                       FROM circulation
+                       GROUP BY circulation.user_id;"""
+USER_BOOKS_QUERY = """SELECT circulation.user_id, circulation.book_id
+                      FROM circulation
+                      WHERE circulation.user_id IN ({placeholders})
+                      ORDER BY circulation.cir_key;"""
+
+
+def settings():
+    """Precompute options from ``[precompute]`` in the secrets file, env
+    overrides"""
+    try:
+        options = dict(load_secrets().get('precompute', {}))
+    except FileNotFoundError:
+        options = {}
+    if 'LIBRARY_SIM_RECS_STORE' in os.environ:
+        options['store'] = os.environ['LIBRARY_SIM_RECS_STORE']
+    return {'store': options.get('store', RECS_STORE)}
+
+
+class RecStore:
+    """Precomputed display rows per reader, in a local SQLite file"""
+
+    def __init__(self, path=None):
+        self.path = path or settings()['store']
+
+    def connect(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)),
+                    exist_ok=True)
+        conn = sqlite3.connect(self.path, timeout=30)
+        conn.execute('PRAGMA journal_mode=WAL;')
+        conn.execute(STORE_SCHEMA)
+        return conn
+
+    def get(self, user_id):
+        """Display rows stored for ``user_id``, or None"""
+        if not os.path.exists(self.path):
+            return None
+        # read on every My Recs rerun: a plain read-only connection, without
+        # the directory and schema setup of connect()
+        conn = sqlite3.connect(
+            pathlib.Path(self.path).absolute().as_uri() + '?mode=ro',
+            uri=True, timeout=30)
+        try:
+            row = conn.execute("""SELECT recs FROM user_recs
+                               WHERE user_id = ?;""", (user_id,)).fetchone()
+        except sqlite3.OperationalError:
+            return None  # the worker has not created the table yet
+        finally:
+            conn.close()
+        return None if row is None else json.loads(row[0])
+
+    def fingerprints(self):
+        conn = self.connect()
+        try:
+            return dict(conn.execute("""SELECT user_id, fingerprint
+                                     FROM user_recs;"""))
+        finally:
+            conn.close()
+
+    def put_many(self, results):
+        """Store ``(user_id, fingerprint, rows)`` results"""
+        now = time.time()
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany("""INSERT OR REPLACE INTO user_recs
+                                 VALUES (?, ?, ?, ?);""",
+                                 [(user_id, fingerprint, now,
+                                   json.dumps(rows))
+                                  for user_id, fingerprint, rows in results])
+        finally:
+            conn.close()
+
+
+def fingerprint(build, count, max_key, book_sum):
+    return f'{build}:{count}:{max_key or 0}:{book_sum or 0}'
+
+
+def build_name(build_dir):
+    return '' if build_dir is None else os.path.basename(build_dir)
+
+
+def circulation_state():
+    """Fingerprint of the whole circulation table and index build"""
+    with db.cursor() as cur:
+        cur.execute(CIRCULATION_STATE)
+        count, max_key, book_sum = cur.fetchall()[0]
+    return fingerprint(build_name(current_build_dir()), count, max_key,
+                       book_sum)
+
+
+def user_fingerprints(build):
+    """``{user_id: fingerprint}`` of every reader with books checked out"""
+    with db.cursor() as cur:
+        cur.execute(USER_FINGERPRINTS)
+        return {user_id: fingerprint(build, count, max_key, book_sum)
+                for user_id, count, max_key, book_sum in cur.fetchall()}
+
+
+def user_books(user_ids):
+    """``{user_id: [book_id, ...]}`` in checkout order"""
+    books = {user_id: [] for user_id in user_ids}
+    user_ids = list(user_ids)
+    for start in range(0, len(user_ids), 1000):
+        chunk = user_ids[start:start + 1000]
+        placeholders = ', '.join(['%s'] * len(chunk))
+        with db.cursor() as cur:
+            cur.execute(USER_BOOKS_QUERY.format(placeholders=placeholders),
+                        tuple(chunk))
+            for user_id, book_id in cur.fetchall():
+                books[user_id].append(book_id)
+    return books
+
+
+def recommend(engine, book_ids, num_=REC_COUNT):
+    """My Recs display rows (``DISPLAY_COLUMNS``) for a reader of
+    ``book_ids``"""
+    book_ids = [book_id for book_id, known
+                in zip(book_ids, engine.catalog.contains(book_ids)) if known]
+    if not book_ids:
+        return []
+    recs = engine.profile_recs(book_ids, num_=num_)
+    liked = engine.catalog.table(
+        engine.catalog.rows(recs['because_you_liked']), descriptions=False)
+    return [[int(book_id), f'{title} by {author}', cover, desc,
+             f'{liked_title} by {liked_author}']
+            for book_id, title, author, cover, desc, liked_title,
+            liked_author in zip(recs['unique_id'], recs['title'],
+                                recs['author'], recs['cover_link'],
+                                recs['desc'], liked['title'],
+                                liked['author'])]
+
+
+def user_recs(user_id):
+    """My Recs display rows of ``user_id``: the precomputed ones, or
+    computed now if the worker has not stored any yet"""
+    rows = RecStore().get(user_id)
+    if rows is None:
+        rows = recommend(get_engine(), user_books([user_id])[user_id])
+    return rows
+
+
+def init_worker(sqlite_path):
+    if sqlite_path is not None:
+        db.set_pool(db.ConnectionPool(
+            functools.partial(sqlite_db.connect, sqlite_path)))
+
+
+def recommend_batch(build, readers):
+    """Worker task: ``(user_id, fingerprint, rows)`` for every ``(user_id,
+    fingerprint, book_ids)``, using index build ``build``"""
+    engine = get_engine()
+    if build_name(engine.build_dir) != build:
+        # published since this worker's engine was loaded
+        reset_engine()
+        engine = get_engine()
+    return [(user_id, user_fingerprint, recommend(engine, book_ids))
+            for user_id, user_fingerprint, book_ids in readers]
+
+
+def refresh(pool, store):
+    """Recompute every reader whose fingerprint changed; returns how many"""
+    build = build_name(current_build_dir())
+    current = user_fingerprints(build)
+    stored = store.fingerprints()
+    empty = fingerprint(build, 0, 0, 0)
+    # readers who returned all their books get an empty list
+    for user_id in stored:
+        current.setdefault(user_id, empty)
+    stale = [user_id for user_id, value in current.items()
+             if stored.get(user_id) != value]
+    if not stale:
+        return 0
+
+    books = user_books(stale)
+    readers = [(user_id, current[user_id], books[user_id])
+               for user_id in stale]
+    tasks = [pool.submit(recommend_batch, build,
+                         readers[start:start + BATCH_USERS])
+             for start in range(0, len(readers), BATCH_USERS)]
+    for task in as_completed(tasks):
+        store.put_many(task.result())
+    return len(stale)
+
+
+def run(workers, interval=POLL_INTERVAL, once=False, store_path=None,
+        sqlite_path=None):
+    init_worker(sqlite_path)
+    store = RecStore(store_path)
+    # workers start from a clean interpreter rather than a fork holding
+    # this process's database connections
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(workers, mp_context=context,
+                             initializer=init_worker,
+                             initargs=(sqlite_path,)) as pool:
+        last_state = None
+        while True:
+            state = circulation_state()
+            if state != last_state:
+                start = time.perf_counter()
+                count = refresh(pool, store)
+                last_state = state
+                if count:
+                    print(f'recomputed {count} readers '
+                          f'({time.perf_counter() - start:.1f}s)',
+                          file=sys.stderr)
+            if once:
+                return
+            time.sleep(interval)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--workers', type=int,
+                        default=min(4, os.cpu_count() or 1))
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL,
+                        help='seconds between circulation polls')
+    parser.add_argument('--once', action='store_true',
+                        help='bring the store up to date and exit')
+    parser.add_argument('--store', help='path of the SQLite results store')
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='read a local SQLite library database (e.g. '
+                        'one from library_sim.synthetic) instead of MySQL')
+    args = parser.parse_args()
+    run(args.workers, args.interval, args.once, args.store, args.sqlite)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+"""HTML rendering of the book tables the pages show, with caches.
+
+``render_table(columns, rows)`` produces the same markup as
+``DataFrame.to_html(escape=False, index=False, justify='center')`` after the
+pages' cover and description formatting, without pandas: each row's
+``<tr>`` is rendered once and kept in an LRU cache under its book id, and
+whole tables are kept in a second LRU cache, so a rerun showing the same
+search results or recommendations does no rendering at all.
+
+Cache entries are keyed by the values they were rendered from, so a book
+whose metadata (or availability) changed simply misses the cache and is
+rendered again; the stale entry ages out of the bounded cache. Cover links
+are swapped for their local thumbnail (``library_sim.covers``) before that,
+so a row is rendered again once its thumbnail has been fetched.
+"""
+import threading
+from collections import OrderedDict
+
+from library_sim import tracing
+from library_sim.covers import get_cover_cache
+
+ROW_CACHE_SIZE = 4096
+TABLE_CACHE_SIZE = 256
+
+TABLE_HEAD = ('<table border="1" class="dataframe">\n  <thead>\n'
+              '    <tr style="text-align: center;">\n')
+TABLE_BODY = '    </tr>\n  </thead>\n  <tbody>\n'
+TABLE_END = '  </tbody>\n</table>'
+
+
+def clean_description(desc):
+    """Description text as displayed: ``###`` breaks become ``<br />`` and
+    other ``#`` marks are dropped"""
+    if desc is None:
+        return None
+    return desc.replace("###", "<br />").replace("#", "")
+
+
+def html_image(image_link):
+    return f"<img align='right' width='130' height='200' src='{image_link}'>"
+
+
+# per-column formatting applied before a value is put in its cell
+FORMATTERS = {'Cover': html_image, 'Description': clean_description}
+
+
+def render_row(columns, values):
+    cells = []
+    for column, value in zip(columns, values):
+        formatter = FORMATTERS.get(column)
+        if formatter is not None:
+            value = formatter(value)
+        cells.append(f'      <td>{value}</td>\n')
+    return '    <tr>\n' + ''.join(cells) + '    </tr>\n'
+
+
+class LRUCache:
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._items.get(key)
+            if value is not None:
+                self._items.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._items[key] = value
+            self._items.move_to_end(key)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+_rows = LRUCache(ROW_CACHE_SIZE)
+_tables = LRUCache(TABLE_CACHE_SIZE)
+
+
+def render_table(columns, rows, key_column='Book ID'):
+    """HTML table of ``rows`` (sequences of values in ``columns`` order).
+
+    Values must be hashable; ``Cover`` holds the image link and
+    ``Description`` the raw or cleaned description text.
+    """
+    columns = tuple(columns)
+    rows = [tuple(row) for row in rows]
+    cover_cache = get_cover_cache()
+    if cover_cache is not None and 'Cover' in columns:
+        at = columns.index('Cover')
+        rows = [row[:at] + (cover_cache.thumbnail_url(row[at]),)
+                + row[at + 1:] for row in rows]
+    table_key = (columns, tuple(rows))
+    with tracing.span('render.table', rows=len(rows)) as span:
+        html = _tables.get(table_key)
+        if html is not None:
+            span.set(cached=True)
+            return html
+
+        key_at = columns.index(key_column)
+        parts = [TABLE_HEAD]
+        parts.extend(f'      <th>{column}</th>\n' for column in columns)
+        parts.append(TABLE_BODY)
+        for row in rows:
+            row_key = (row[key_at], columns)
+            cached = _rows.get(row_key)
+            if cached is None or cached[0] != row:
+                cached = (row, render_row(columns, row))
+                _rows.put(row_key, cached)
+            parts.append(cached[1])
+        parts.append(TABLE_END)
+        html = ''.join(parts)
+        _tables.put(table_key, html)
+        return html
+
+
+def clear():
+    """Drop every cached row and table"""
+    _rows.clear()
+    _tables.clear()
@@ -0,0 +1,307 @@
+"""In-process title/author search.
+
+``SearchIndex`` answers the Home page's "title/author contains ..." searches
+from memory instead of running ``LIKE '%term%'`` scans against the database.
+Titles and authors are normalized (case, accents and punctuation folded) and
+split into tokens; each token is indexed by its 1-, 2- and 3-character grams,
+so a substring lookup only verifies the handful of tokens that share the
+query's grams. ``fetch_books`` then fills in the rows actually displayed:
+their metadata from a cache that is only cleared when a sync sees titles or
+authors change, their availability from ``library_sim.availability``.
+"""
+import bisect
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+
+from library_sim import db, tracing
+from library_sim.availability import ReadThroughCache, book_availability
+
+KINDS = ('title', 'author')
+MAX_GRAM = 3
+# seconds between incremental syncs with the database
+REFRESH_INTERVAL = 60
+RESULT_CACHE_SIZE = 256
+METADATA_CACHE_SIZE = 4096
+SEPARATORS = re.compile(r'[\W_]+')
+
+SEARCH_ROWS_QUERY = """SELECT inventory.book_id, metadata.title,
+                       metadata.author
+                       FROM inventory
+                       JOIN metadata
+                       ON inventory.book_id = metadata.unique_id;"""
+METADATA_ROWS_QUERY = """SELECT metadata.unique_id, metadata.title,
+                         metadata.author, metadata.desc, metadata.cover_link
+                         FROM metadata
+                         WHERE metadata.unique_id IN ({placeholders});"""
+
+
+def normalize(text):
+    """Lower-case ``text`` and fold accents and punctuation to spaces"""
+    text = str(text or '').lower()
+    if not text.isascii():
+        text = unicodedata.normalize('NFKD', text)
+        text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    return SEPARATORS.sub(' ', text).strip()
+
+
+def grams(token):
+    return {token[start:start + size]
+            for size in range(1, MAX_GRAM + 1)
+            for start in range(len(token) - size + 1)}
+
+
+class FieldIndex:
+    """Token and gram postings for one searchable column"""
+
+    def __init__(self):
+        self.text = {}
+        self.postings = defaultdict(set)
+        self.gram_tokens = defaultdict(set)
+        self._sorted_tokens = None
+
+    def add(self, book_id, value):
+        text = normalize(value)
+        self.text[book_id] = text
+        for token in set(text.split()):
+            if token not in self.postings:
+                for gram in grams(token):
+                    self.gram_tokens[gram].add(token)
+                self._sorted_tokens = None
+            self.postings[token].add(book_id)
+
+    def remove(self, book_id):
+        for token in set(self.text.pop(book_id).split()):
+            books = self.postings[token]
+            books.discard(book_id)
+            if not books:
+                del self.postings[token]
+                for gram in grams(token):
+                    self.gram_tokens[gram].discard(token)
+                self._sorted_tokens = None
+
+    def tokens_containing(self, part):
+        if len(part) <= MAX_GRAM:
+            return self.gram_tokens.get(part, ())
+        candidates = None
+        for gram in {part[i:i + MAX_GRAM]
+                     for i in range(len(part) - MAX_GRAM + 1)}:
+            tokens = self.gram_tokens.get(gram, set())
+            candidates = tokens if candidates is None else candidates & tokens
+            if not candidates:
+                return ()
+        return [token for token in candidates if part in token]
+
+    def sorted_tokens(self):
+        if self._sorted_tokens is None:
+            self._sorted_tokens = sorted(self.postings)
+        return self._sorted_tokens
+
+    def tokens_starting(self, part):
+        tokens = self.sorted_tokens()
+        start = bisect.bisect_left(tokens, part)
+        stop = bisect.bisect_left(tokens, part + '\uffff')
+        return tokens[start:stop]
+
+    def tokens_for(self, part, position, n_parts, prefix):
+        """Tokens a query part may match given where it sits in the query.
+
+        In a multi-word substring query the first word has to end a token,
+        the last one has to start one and the ones in between are whole
+        tokens; in a prefix query every word but the last is a whole token.
+        """
+        last = position == n_parts - 1
+        if not last and (prefix or position > 0):
+            return [part] if part in self.postings else []
+        if prefix or (last and n_parts > 1):
+            return self.tokens_starting(part)
+        if n_parts > 1:
+            return [token for token in self.tokens_containing(part)
+                    if token.endswith(part)]
+        return self.tokens_containing(part)
+
+    def search(self, query, prefix=False):
+        parts = query.split()
+        if not parts:
+            return set(self.text)
+
+        candidates = []
+        for position, part in enumerate(parts):
+            books = set()
+            for token in self.tokens_for(part, position, len(parts), prefix):
+                books |= self.postings[token]
+            if not books:
+                return set()
+            candidates.append(books)
+
+        candidates.sort(key=len)
+        matches = candidates[0].intersection(*candidates[1:])
+        if len(parts) > 1:
+            # the words matched one by one; the phrase must be contiguous too
+            text = self.text
+            if prefix:
+                matches = {book_id for book_id in matches
+                           if (' ' + text[book_id]).find(' ' + query) >= 0}
+            else:
+                matches = {book_id for book_id in matches
+                           if query in text[book_id]}
+        return matches
+
+
+class SearchIndex:
+    """Title and author search over every book in the inventory.
+
+    ``search`` returns matching book ids in ascending id order. The index is
+    kept current with ``sync``, which only touches books whose title or
+    author changed since the last sync.
+    """
+
+    def __init__(self):
+        self.fields = {kind: FieldIndex() for kind in KINDS}
+        self.books = {}
+        self.synced_at = None
+        self._results = OrderedDict()
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self.books)
+
+    def add(self, book_id, title, author):
+        with self._lock:
+            if book_id in self.books:
+                self._remove(book_id)
+            self.books[book_id] = (title, author)
+            self.fields['title'].add(book_id, title)
+            self.fields['author'].add(book_id, author)
+            self._results.clear()
+
+    def remove(self, book_id):
+        with self._lock:
+            if book_id in self.books:
+                self._remove(book_id)
+                self._results.clear()
+
+    def _remove(self, book_id):
+        del self.books[book_id]
+        for field in self.fields.values():
+            field.remove(book_id)
+
+    @tracing.traced('search.sync')
+    def sync(self, rows):
+        """Apply ``(book_id, title, author)`` rows; returns books changed"""
+        rows = {row[0]: (row[1], row[2]) for row in rows}
+        changed = 0
+        with self._lock:
+            for book_id in set(self.books) - set(rows):
+                self.remove(book_id)
+                changed += 1
+            for book_id, (title, author) in rows.items():
+                if self.books.get(book_id) != (title, author):
+                    self.add(book_id, title, author)
+                    changed += 1
+            # sort the vocabularies now rather than on the next prefix query
+            for field in self.fields.values():
+                field.sorted_tokens()
+            self.synced_at = time.monotonic()
+        return changed
+
+    @tracing.traced('search.query')
+    def search(self, term, kind='title', prefix=False):
+        """Ids of books whose ``kind`` contains ``term`` (or starts a word
+        with it when ``prefix`` is True)"""
+        query = normalize(term)
+        key = (kind, query, prefix)
+        with self._lock:
+            if key in self._results:
+                self._results.move_to_end(key)
+                return self._results[key]
+            book_ids = sorted(self.fields[kind].search(query, prefix))
+            self._results[key] = book_ids
+            if len(self._results) > RESULT_CACHE_SIZE:
+                self._results.popitem(last=False)
+            return book_ids
+
+    def search_page(self, term, kind='title', offset=0, limit=5,
+                    prefix=False):
+        """One page of ``search`` results plus the total number of matches"""
+        book_ids = self.search(term, kind, prefix)
+        return book_ids[offset:offset + limit], len(book_ids)
+
+
+@tracing.traced('search.fetch_rows')
+def fetch_search_rows():
+    with db.cursor() as cur:
+        cur.execute(SEARCH_ROWS_QUERY)
+        return cur.fetchall()
+
+
+@tracing.traced('search.fetch_metadata')
+def fetch_metadata(book_ids):
+    """``{book_id: (title, author, desc, cover_link)}`` of the books of
+    ``book_ids`` that have metadata"""
+    placeholders = ', '.join(['%s'] * len(book_ids))
+    with db.cursor() as cur:
+        cur.execute(METADATA_ROWS_QUERY.format(placeholders=placeholders),
+                    tuple(book_ids))
+        return {row[0]: row[1:] for row in cur.fetchall()}
+
+
+_metadata = ReadThroughCache(fetch_metadata, METADATA_CACHE_SIZE)
+
+
+def book_metadata(book_ids):
+    """``{book_id: (title, author, desc, cover_link)}``, cached"""
+    return _metadata.get_many(book_ids)
+
+
+@tracing.traced('search.fetch_books')
+def fetch_books(book_ids):
+    """Display rows with live availability, in the order of ``book_ids``"""
+    book_ids = list(book_ids)
+    if not book_ids:
+        return []
+    counts = book_availability(book_ids)
+    metadata = book_metadata(book_ids)
+    rows = []
+    for book_id in book_ids:
+        if book_id not in counts:
+            continue
+        total_copies, available = counts[book_id]
+        title, author, desc, cover_link = metadata.get(book_id,
+                                                       (None,) * 4)
+        rows.append((book_id, title, author, total_copies, available, desc,
+                     cover_link))
+    return rows
+
+
+_search_index = None
+_search_index_lock = threading.Lock()
+_sync_lock = threading.Lock()
+
+
+def get_search_index():
+    """The process-wide search index.
+
+    Built on first use, then synced with the database at most every
+    ``REFRESH_INTERVAL`` seconds by whichever caller notices it is stale;
+    other callers keep searching the current index meanwhile.
+    """
+    global _search_index
+    if _search_index is None:
+        with _search_index_lock:
+            if _search_index is None:
+                search_index = SearchIndex()
+                search_index.sync(fetch_search_rows())
+                _search_index = search_index
+
+    search_index = _search_index
+    stale = time.monotonic() - search_index.synced_at > REFRESH_INTERVAL
+    if stale and _sync_lock.acquire(blocking=False):
+        try:
+            if search_index.sync(fetch_search_rows()):
+                _metadata.clear()
+        finally:
+            _sync_lock.release()
+    return search_index
@@ -0,0 +1,513 @@
+"""HTTP/JSON service for search, recommendations and circulation.
+
+    python -m library_sim.service [--host 127.0.0.1] [--port 8502]
+                                  [--sqlite PATH] [--access-log]
+
+Kiosks, mobile apps and scripts can use the library without a Streamlit
+session. The service answers from the same process-wide state the pages
+use: the engine (``get_engine``), the search index, the availability and
+metadata caches and the connection pool. All of it is loaded before the
+first request is accepted, so a request only pays for its own lookups.
+
+    GET  /health
+    GET  /search?term=dune&kind=title&page=0&page_size=5
+    GET  /books/<book_id>/recs?genres=Fantasy,Magic&overlap=1&author=0&num=20
+    POST /recs        {"book_ids": [...], "mode": "profile" | "each",
+                       "genres": [...], "num": 10}
+    POST /checkout    {"user_id": "...", "book_ids": [...]}
+    POST /return      {"user_id": "...", "book_ids": [...]}
+    GET  /users/<user_id>/books
+    GET  /users/<user_id>/recs
+    POST /batch       {"requests": [{"method": "GET", "path": "/search?..."},
+                                    {"method": "POST", "path": "/checkout",
+                                     "body": {...}}, ...]}
+
+``/batch`` runs up to ``MAX_BATCH`` requests in one round trip and returns
+``{"responses": [{"status": ..., "body": ...}, ...]}`` in the same order.
+Errors are ``{"error": message}`` with a 4xx or 5xx status.
+
+The service listens on localhost unless ``--host`` (or ``[service] host``
+in the secrets file) says otherwise. When ``[service] token`` or
+``LIBRARY_SIM_SERVICE_TOKEN`` is set, every request except ``/health``
+must send ``Authorization: Bearer <token>``. ``ServiceClient`` is a small
+client for Python callers.
+"""
+import argparse
+import hmac
+import json
+import os
+import re
+import sys
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from library_sim import circulation, db, precompute, sqlite_db, tracing
+from library_sim.availability import user_loans
+from library_sim.config import load_secrets
+from library_sim.engine import get_engine
+from library_sim.search import book_metadata, fetch_books, get_search_index
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8502
+MAX_BODY_BYTES = 2 ** 20
+MAX_BATCH = 100
+MAX_PAGE_SIZE = 100
+MAX_RECS = 100
+CLIENT_TIMEOUT = 10
+
+# engine table columns sent for each recommended book
+BOOK_FIELDS = ['unique_id', 'title', 'author', 'genre', 'cover_link', 'desc']
+SEARCH_FIELDS = ['book_id', 'title', 'author', 'total_copies', 'available',
+                 'desc', 'cover_link']
+MY_BOOKS_FIELDS = ['book_id', 'title', 'author', 'desc', 'cover_link']
+USER_REC_FIELDS = ['book_id', 'you_may_like', 'cover_link', 'desc',
+                   'because_you_liked']
+
+
+class ServiceError(Exception):
+    """A request the service refuses, with the HTTP status to answer"""
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def settings():
+    """Service options from ``[service]`` in the secrets file, env
+    overrides"""
+    try:
+        options = dict(load_secrets().get('service', {}))
+    except FileNotFoundError:
+        options = {}
+    if 'LIBRARY_SIM_SERVICE_TOKEN' in os.environ:
+        options['token'] = os.environ['LIBRARY_SIM_SERVICE_TOKEN']
+    return {'host': options.get('host', DEFAULT_HOST),
+            'port': int(options.get('port', DEFAULT_PORT)),
+            'token': options.get('token') or None}
+
+
+def json_default(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def records(table, fields):
+    """``table`` (an engine DataFrame) as a list of dicts of ``fields``"""
+    columns = [table[field].tolist() for field in fields]
+    return [dict(zip(fields, values)) for values in zip(*columns)]
+
+
+def int_param(query, name, default, low=0, high=None):
+    try:
+        value = int(query.get(name, default))
+    except (TypeError, ValueError):
+        raise ServiceError(400, f'{name} must be an integer')
+    if high is None and value < low:
+        raise ServiceError(400, f'{name} must be at least {low}')
+    if value < low or (high is not None and value > high):
+        raise ServiceError(400, f'{name} must be between {low} and {high}')
+    return value
+
+
+def list_param(value):
+    """A list given as JSON or as a comma-separated query string"""
+    if value is None or isinstance(value, list):
+        return value
+    return [part for part in str(value).split(',') if part]
+
+
+def book_ids_param(body):
+    book_ids = body.get('book_ids')
+    if not isinstance(book_ids, list) or not book_ids:
+        raise ServiceError(400, 'book_ids must be a non-empty list')
+    return book_ids
+
+
+def int_ids_param(body):
+    """``book_ids`` of ``body`` as ints, for the engine calls"""
+    book_ids = book_ids_param(body)
+    try:
+        if any(isinstance(book_id, (bool, float)) for book_id in book_ids):
+            raise TypeError
+        return [int(book_id) for book_id in book_ids]
+    except (TypeError, ValueError):
+        raise ServiceError(400, 'book_ids must be integers')
+
+
+def weights_param(body, n_books):
+    weights = body.get('weights')
+    if weights is None:
+        return None
+    if (not isinstance(weights, list) or len(weights) != n_books
+            or not all(isinstance(weight, (int, float))
+                       and not isinstance(weight, bool)
+                       and np.isfinite(weight) for weight in weights)):
+        raise ServiceError(400, 'weights must be a list of numbers, one '
+                           'per book id')
+    return weights
+
+
+def genres_param(value):
+    genres = list_param(value)
+    if genres is not None and not all(isinstance(genre, str)
+                                      for genre in genres):
+        raise ServiceError(400, 'genres must be strings')
+    return genres
+
+
+def user_param(body):
+    user_id = body.get('user_id')
+    if not isinstance(user_id, str) or not user_id:
+        raise ServiceError(400, 'user_id is required')
+    return user_id
+
+
+ROUTES = []
+
+
+def route(method, pattern):
+    """Register ``handler(match, query, body)`` for ``method`` requests whose
+    path matches ``pattern``"""
+    def register(handler):
+        ROUTES.append((method, re.compile(pattern + '$'), handler))
+        return handler
+    return register
+
+
+@route('GET', r'/health')
+def health(match, query, body):
+    return {'status': 'ok', 'books': len(get_engine().catalog)}
+
+
+@route('GET', r'/search')
+def search(match, query, body):
+    kind = query.get('kind', 'title')
+    if kind not in ('title', 'author'):
+        raise ServiceError(400, 'kind must be title or author')
+    page = int_param(query, 'page', 0)
+    page_size = int_param(query, 'page_size', 5, 1, MAX_PAGE_SIZE)
+    book_ids, total = get_search_index().search_page(
+        query.get('term', ''), kind, offset=page * page_size,
+        limit=page_size)
+    return {'total': total,
+            'books': [dict(zip(SEARCH_FIELDS, row))
+                      for row in fetch_books(book_ids)]}
+
+
+@route('GET', r'/books/(\d+)/recs')
+def book_recs(match, query, body):
+    book_id = int(match.group(1))
+    try:
+        table = get_engine().book_rec(
+            book_id, genres=genres_param(query.get('genres')),
+            overlap=int_param(query, 'overlap', 0),
+            author=query.get('author', '0') not in ('', '0', 'false'),
+            num_=int_param(query, 'num', 20, 1, MAX_RECS))
+    except KeyError:
+        raise ServiceError(404, f'no book {book_id}')
+    return {'books': records(table, BOOK_FIELDS)}
+
+
+@route('POST', r'/recs')
+def batch_recs(match, query, body):
+    """Recommendations for several books in one engine call: one profile
+    of all of them (``profile``) or the neighbors of each (``each``)"""
+    book_ids = int_ids_param(body)
+    genres = genres_param(body.get('genres'))
+    mode = body.get('mode', 'profile')
+    engine = get_engine()
+    try:
+        if mode == 'profile':
+            table = engine.profile_recs(
+                book_ids, weights=weights_param(body, len(book_ids)),
+                genres=genres, num_=int_param(body, 'num', 10, 1, MAX_RECS))
+            return {'books': records(table,
+                                     BOOK_FIELDS + ['because_you_liked'])}
+        if mode == 'each':
+            table = engine.book_recs_multiple(
+                book_ids, genres=genres,
+                num_=int_param(body, 'num', 5, 1, MAX_RECS))
+            if 'unique_id' not in table:
+                return {'books': []}  # the page's placeholder row
+            return {'books': records(table, BOOK_FIELDS)}
+    except KeyError as err:
+        raise ServiceError(404, f'no book {err.args[0]}')
+    raise ServiceError(400, 'mode must be profile or each')
+
+
+def circulation_response(results):
+    return {'results': [{'book_id': book_id, 'status': status}
+                        for book_id, status in results],
+            'ok': sum(status == circulation.OK for _, status in results)}
+
+
+@route('POST', r'/checkout')
+def checkout(match, query, body):
+    return circulation_response(circulation.checkout_many(
+        user_param(body), book_ids_param(body)))
+
+
+@route('POST', r'/return')
+def return_books(match, query, body):
+    return circulation_response(circulation.return_many(
+        user_param(body), book_ids_param(body)))
+
+
+@route('GET', r'/users/([^/]+)/books')
+def my_books(match, query, body):
+    book_ids = user_loans(urllib.parse.unquote(match.group(1)))
+    metadata = book_metadata(book_ids)
+    return {'books': [dict(zip(MY_BOOKS_FIELDS,
+                               (book_id,) + metadata.get(book_id,
+                                                         (None,) * 4)))
+                      for book_id in book_ids]}
+
+
+@route('GET', r'/users/([^/]+)/recs')
+def user_recs(match, query, body):
+    rows = precompute.user_recs(urllib.parse.unquote(match.group(1)))
+    return {'books': [dict(zip(USER_REC_FIELDS, row)) for row in rows]}
+
+
+@route('POST', r'/batch')
+def batch(match, query, body):
+    requests = body.get('requests')
+    if not isinstance(requests, list):
+        raise ServiceError(400, 'requests must be a list')
+    if len(requests) > MAX_BATCH:
+        raise ServiceError(400, f'at most {MAX_BATCH} requests per batch')
+    responses = []
+    for request in requests:
+        if not isinstance(request, dict):
+            responses.append({'status': 400,
+                              'body': {'error': 'not a request object'}})
+            continue
+        path = str(request.get('path', ''))
+        if urllib.parse.urlsplit(path).path == '/batch':
+            responses.append({'status': 400,
+                              'body': {'error': 'batches do not nest'}})
+            continue
+        status, payload = dispatch(str(request.get('method', 'GET')).upper(),
+                                   path, request.get('body') or {})
+        responses.append({'status': status, 'body': payload})
+    return {'responses': responses}
+
+
+def dispatch(method, path, body):
+    """``(status, payload)`` of one request; never raises, so one failing
+    request of a batch cannot hide the results of the others"""
+    url = urllib.parse.urlsplit(path)
+    query = {name: values[-1] for name, values
+             in urllib.parse.parse_qs(url.query).items()}
+    allowed = False
+    for route_method, pattern, handler in ROUTES:
+        match = pattern.match(url.path)
+        if match is None:
+            continue
+        if route_method != method:
+            allowed = True
+            continue
+        if not isinstance(body, dict):
+            return 400, {'error': 'body must be a JSON object'}
+        with tracing.span('service.' + handler.__name__):
+            try:
+                return 200, handler(match, query, body)
+            except ServiceError as err:
+                return err.status, {'error': err.message}
+            except db.PoolTimeout as err:
+                return 503, {'error': str(err)}
+            except Exception as err:
+                print("{}: {}".format(path, err), file=sys.stderr)
+                return 500, {'error': 'internal error'}
+    if allowed:
+        return 405, {'error': f'{method} not allowed on {url.path}'}
+    return 404, {'error': f'no route for {url.path}'}
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'library_sim'
+    # set by make_server()
+    token = None
+    access_log = False
+
+    def do_GET(self):
+        self.handle_request('GET')
+
+    def do_POST(self):
+        self.handle_request('POST')
+
+    def handle_request(self, method):
+        try:
+            body = self.read_body() if method == 'POST' else {}
+        except ServiceError as err:
+            self.send_json(err.status, {'error': err.message})
+            return
+        if (self.token is not None and self.path != '/health'
+                and not self.authorized()):
+            self.send_json(401, {'error': 'missing or wrong token'})
+            return
+        self.send_json(*dispatch(method, self.path, body))
+
+    def log_message(self, format, *args):
+        if self.access_log:
+            super().log_message(format, *args)
+
+    def authorized(self):
+        expected = f'Bearer {self.token}'.encode()
+        given = self.headers.get('Authorization', '').encode()
+        return hmac.compare_digest(given, expected)
+
+    def read_body(self):
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+        except ValueError:
+            raise ServiceError(400, 'bad Content-Length')
+        if length > MAX_BODY_BYTES:
+            raise ServiceError(413, f'body over {MAX_BODY_BYTES} bytes')
+        data = self.rfile.read(length)
+        if not data:
+            return {}
+        try:
+            return json.loads(data)
+        except ValueError:
+            raise ServiceError(400, 'body is not valid JSON')
+
+    def send_json(self, status, payload):
+        data = json.dumps(payload, default=json_default).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def warm_up():
+    """Load the engine and search index before taking requests"""
+    start = time.perf_counter()
+    engine = get_engine()
+    search_index = get_search_index()
+    print(f'loaded {len(engine.catalog)} books, {len(search_index)} '
+          f'searchable ({time.perf_counter() - start:.1f}s)',
+          file=sys.stderr)
+
+
+def make_server(host, port, token=None, access_log=False):
+    handler = type('Handler', (Handler,), {'token': token,
+                                           'access_log': access_log})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    return server
+
+
+class ServiceClient:
+    """Client of a running service; methods return the decoded JSON and
+    raise ``ServiceError`` for error responses"""
+
+    def __init__(self, base_url=None, token=None, timeout=CLIENT_TIMEOUT):
+        if base_url is None:
+            options = settings()
+            base_url = f"http://{options['host']}:{options['port']}"
+            token = token or options['token']
+        self.base_url = base_url.rstrip('/')
+        self.token = token
+        self.timeout = timeout
+
+    def request(self, method, path, body=None):
+        data = None if body is None else json.dumps(
+            body, default=json_default).encode()
+        request = urllib.request.Request(self.base_url + path, data=data,
+                                         method=method)
+        request.add_header('Content-Type', 'application/json')
+        if self.token is not None:
+            request.add_header('Authorization', f'Bearer {self.token}')
+        try:
+            with urllib.request.urlopen(request,
+                                        timeout=self.timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as err:
+            try:
+                message = json.loads(err.read())['error']
+            except (ValueError, KeyError, TypeError):
+                message = err.reason
+            raise ServiceError(err.code, message) from None
+
+    def search(self, term, kind='title', page=0, page_size=5):
+        query = urllib.parse.urlencode({'term': term, 'kind': kind,
+                                        'page': page,
+                                        'page_size': page_size})
+        return self.request('GET', f'/search?{query}')
+
+    def book_recs(self, book_id, genres=None, overlap=0, author=False,
+                  num=20):
+        query = urllib.parse.urlencode({'genres': ','.join(genres or []),
+                                        'overlap': overlap,
+                                        'author': int(author), 'num': num})
+        return self.request('GET', f'/books/{int(book_id)}/recs?{query}')
+
+    def recs(self, book_ids, mode='profile', genres=None, num=10):
+        return self.request('POST', '/recs',
+                            {'book_ids': list(book_ids), 'mode': mode,
+                             'genres': genres, 'num': num})
+
+    def checkout(self, user_id, book_ids):
+        return self.request('POST', '/checkout',
+                            {'user_id': user_id, 'book_ids': list(book_ids)})
+
+    def return_books(self, user_id, book_ids):
+        return self.request('POST', '/return',
+                            {'user_id': user_id, 'book_ids': list(book_ids)})
+
+    def my_books(self, user_id):
+        return self.request(
+            'GET', f'/users/{urllib.parse.quote(user_id, safe="")}/books')
+
+    def user_recs(self, user_id):
+        return self.request(
+            'GET', f'/users/{urllib.parse.quote(user_id, safe="")}/recs')
+
+    def batch(self, requests):
+        """``requests`` are ``{"method", "path", "body"}`` dicts"""
+        return self.request('POST', '/batch',
+                            {'requests': list(requests)})['responses']
+
+
+def main():
+    options = settings()
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--host', default=options['host'],
+                        help='address to listen on (default: %(default)s)')
+    parser.add_argument('--port', type=int, default=options['port'])
+    parser.add_argument('--sqlite', metavar='PATH',
+                        help='serve a local SQLite library database (e.g. '
+                        'one from library_sim.synthetic) instead of MySQL')
+    parser.add_argument('--access-log', action='store_true',
+                        help='log every request to stderr')
+    args = parser.parse_args()
+    if args.sqlite:
+        db.set_pool(db.ConnectionPool(lambda: sqlite_db.connect(args.sqlite)))
+
+    warm_up()
+    server = make_server(args.host, args.port, options['token'],
+                         args.access_log)
+    print(f'serving on http://{args.host}:{server.server_port}',
+          file=sys.stderr)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == '__main__':
+    main()
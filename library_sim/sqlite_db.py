@@ -0,0 +1,124 @@
+"""SQLite stand-in for the MySQL database.
+
+``connect(path)`` returns a connection that accepts the MySQL-flavoured SQL
+the app issues (``%s`` placeholders, ``booksdb.`` prefixes, ``SHA2()``,
+``SELECT ... FOR UPDATE``) and raises ``mysql.connector`` errors, so the
+pool and every query path can run against a local file instead of the RDS
+instance::
+
+    from library_sim import db, sqlite_db
+
+    db.set_pool(db.ConnectionPool(lambda: sqlite_db.connect('library.db')))
+"""
+import hashlib
+import re
+import sqlite3
+
+from mysql.connector import errors
+
+FOR_UPDATE = re.compile(r'\s+FOR\s+UPDATE\s*;?\s*$', re.IGNORECASE)
+
+
+def sha2(value, bits):
+    if value is None:
+        return None
+    return hashlib.new(f'sha{bits}', str(value).encode()).hexdigest()
+
+
+def translate(sql):
+    return sql.replace('%s', '?').replace('booksdb.', '')
+
+
+def translate_error(err):
+    if isinstance(err, sqlite3.IntegrityError):
+        return errors.IntegrityError(msg=str(err))
+    if isinstance(err, sqlite3.OperationalError):
+        return errors.OperationalError(msg=str(err))
+    if isinstance(err, sqlite3.ProgrammingError):
+        return errors.ProgrammingError(msg=str(err))
+    return errors.DatabaseError(msg=str(err))
+
+
+class Cursor:
+    def __init__(self, connection):
+        self._connection = connection
+        self._cursor = connection.raw.cursor()
+
+    def execute(self, sql, params=()):
+        sql = translate(sql)
+        if FOR_UPDATE.search(sql):
+            # SQLite has no row locks; take the database write lock instead
+            sql = FOR_UPDATE.sub(';', sql)
+            self._connection.begin_immediate()
+        try:
+            self._cursor.execute(sql, params)
+        except sqlite3.Error as err:
+            raise translate_error(err) from err
+        return self
+
+    def executemany(self, sql, seq_params):
+        try:
+            self._cursor.executemany(translate(sql), seq_params)
+        except sqlite3.Error as err:
+            raise translate_error(err) from err
+        return self
+
+    def fetchone(self):
+        return self._cursor.fetchone()
+
+    def fetchmany(self, size=1):
+        return self._cursor.fetchmany(size)
+
+    def fetchall(self):
+        return self._cursor.fetchall()
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    @property
+    def rowcount(self):
+        return self._cursor.rowcount
+
+    @property
+    def lastrowid(self):
+        return self._cursor.lastrowid
+
+    @property
+    def description(self):
+        return self._cursor.description
+
+    def close(self):
+        self._cursor.close()
+
+
+class Connection:
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return Cursor(self)
+
+    def begin_immediate(self):
+        if not self.raw.in_transaction:
+            self.raw.execute('BEGIN IMMEDIATE')
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def ping(self, reconnect=False, attempts=1, delay=0):
+        self.raw.execute('SELECT 1')
+
+    def close(self):
+        self.raw.close()
+
+
+def connect(path, timeout=30):
+    raw = sqlite3.connect(path, timeout=timeout, check_same_thread=False,
+                          isolation_level='IMMEDIATE')
+    raw.execute('PRAGMA journal_mode=WAL')
+    raw.execute('PRAGMA foreign_keys=ON')
+    raw.create_function('SHA2', 2, sha2)
+    return Connection(raw)
@@ -0,0 +1,120 @@
+"""Synthetic library databases for benchmarks and local development.
+
+``create_database(path, n_books)`` writes a SQLite file with the
+``metadata``, ``inventory``, ``users`` and ``circulation`` tables the app
+reads (created by ``library_sim.migrate``), filled with generated books.
+Descriptions are drawn from topics with their own vocabulary and genres
+follow the topic, so similar books exist and the recommendation paths do
+real work. The same ``seed`` always produces the same database.
+"""
+import numpy as np
+
+from library_sim import migrate, sqlite_db
+
+GENRES = ['Fiction', 'Fantasy', 'Romance', 'Young Adult', 'Mystery',
+          'Classics', 'Historical Fiction', 'Science Fiction', 'Nonfiction',
+          'Thriller', 'Contemporary', 'Horror', 'Paranormal', 'Adventure',
+          'Childrens', 'Humor', 'Biography', 'History', 'Poetry', 'Crime',
+          'Philosophy', 'Adult', 'Drama', 'Magic', 'Dystopia', 'Memoir',
+          'Science', 'Short Stories', 'Graphic Novels', 'Travel']
+ONSETS = ['b', 'c', 'd', 'f', 'g', 'h', 'j', 'k', 'l', 'm', 'n', 'p', 'r',
+          's', 't', 'v', 'w', 'z', 'br', 'ch', 'dr', 'sh', 'st', 'th', 'tr']
+VOWELS = ['a', 'e', 'i', 'o', 'u', 'ai', 'ea', 'ou']
+GENERAL_WORDS = 5000
+TOPIC_WORDS = 60
+DESC_WORDS = 40
+BATCH_SIZE = 10000
+
+
+def make_words(n_words, rng):
+    """``n_words`` distinct pronounceable words"""
+    syllables = np.array([onset + vowel for onset in ONSETS
+                          for vowel in VOWELS])
+    words = set()
+    while len(words) < n_words:
+        n_syllables = rng.integers(2, 5)
+        words.add(''.join(rng.choice(syllables, n_syllables)))
+    return sorted(words)
+
+
+def generate_books(n_books, seed=0):
+    """Rows ``(unique_id, title, author, genre, desc, cover_link)``"""
+    rng = np.random.default_rng(seed)
+    n_topics = max(10, n_books // 200)
+    words = np.array(make_words(GENERAL_WORDS + n_topics * TOPIC_WORDS, rng))
+    general = words[:GENERAL_WORDS]
+    topic_words = words[GENERAL_WORDS:].reshape(n_topics, TOPIC_WORDS)
+    names = [word.capitalize() for word in general[:2000]]
+    authors = [f'{rng.choice(names)} {rng.choice(names)}'
+               for _ in range(max(1, n_books // 8))]
+    topic_genres = [rng.choice(len(GENRES), 6, replace=False)
+                    for _ in range(n_topics)]
+
+    # word frequencies of the general vocabulary fall off like real text
+    general_p = 1.0 / np.arange(1, GENERAL_WORDS + 1)
+    general_p /= general_p.sum()
+
+    topics = rng.integers(0, n_topics, n_books)
+    author_ids = rng.integers(0, len(authors), n_books)
+    for start in range(0, n_books, BATCH_SIZE):
+        stop = min(start + BATCH_SIZE, n_books)
+        size = stop - start
+        from_topic = rng.random((size, DESC_WORDS)) < 0.4
+        desc_words = np.where(
+            from_topic,
+            topic_words[topics[start:stop, None],
+                        rng.integers(0, TOPIC_WORDS, (size, DESC_WORDS))],
+            general[rng.choice(GENERAL_WORDS, (size, DESC_WORDS),
+                               p=general_p)])
+        title_words = general[rng.integers(0, GENERAL_WORDS, (size, 3))]
+        n_genres = rng.integers(1, 5, size)
+        for offset in range(size):
+            book = start + offset
+            genres = [GENRES[i] for i in
+                      topic_genres[topics[book]][:n_genres[offset]]]
+            yield (book + 1,
+                   ' '.join(title_words[offset,
+                                        :1 + offset % 3]).title(),
+                   authors[author_ids[book]],
+                   str(genres),
+                   ' '.join(desc_words[offset]).capitalize() + '.',
+                   f'https://covers.example.com/{book + 1}.jpg')
+
+
+def create_database(path, n_books, n_users=None, n_checkouts=None, seed=0):
+    """Write a synthetic library of ``n_books`` books to ``path``.
+
+    By default there is one user per 20 books and a tenth of the catalog is
+    checked out. Returns the user names.
+    """
+    rng = np.random.default_rng(seed + 1)
+    if n_users is None:
+        n_users = max(10, n_books // 20)
+    if n_checkouts is None:
+        n_checkouts = n_books // 10
+
+    connection = sqlite_db.connect(path)
+    raw = connection.raw
+    migrate.migrate(connection)
+    raw.executemany("""INSERT INTO metadata VALUES (?, ?, ?, ?, ?, ?);""",
+                    generate_books(n_books, seed))
+
+    users = [f'user{i}' for i in range(n_users)]
+    raw.executemany("""INSERT INTO users VALUES (?, SHA2(?, 256));""",
+                    [(user, user) for user in users])
+
+    copies = rng.integers(1, 6, n_books)
+    checked_out = rng.choice(n_books, min(n_checkouts, n_books),
+                             replace=False)
+    available = copies.copy()
+    available[checked_out] -= 1
+    raw.executemany("""INSERT INTO inventory VALUES (?, ?, ?);""",
+                    zip(range(1, n_books + 1), copies.tolist(),
+                        available.tolist()))
+    raw.executemany("""INSERT INTO circulation (user_id, book_id)
+                    VALUES (?, ?);""",
+                    [(users[rng.integers(n_users)], int(book) + 1)
+                     for book in checked_out])
+    connection.commit()
+    connection.close()
+    return users
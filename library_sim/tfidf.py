@@ -0,0 +1,135 @@
+"""TF-IDF fitted one chunk of descriptions at a time.
+
+``TfidfVectorizer.fit_transform`` needs every description in memory at
+once. ``ChunkedTfidf`` tokenizes each chunk as it arrives, keeps only its
+term counts and document frequencies, and computes the idf weights at the
+end, so the caller can drop the raw text of a chunk as soon as it was
+added. The result is the same matrix and vectorizer ``TfidfVectorizer(
+stop_words='english').fit_transform`` would produce for all rows.
+
+With ``workers > 1`` chunks are tokenized in that many processes while the
+caller reads the next chunk; each worker counts its chunk against a
+vocabulary of its own, which is merged into the global one on the way back.
+"""
+import multiprocessing
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy import sparse
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.preprocessing import normalize
+
+
+def count_terms(analyzer, descs):
+    """Term counts of one chunk against a vocabulary of its own:
+    ``(terms, counts)`` with column ``j`` of ``counts`` counting
+    ``terms[j]``"""
+    vocabulary = {}
+    indices = []
+    indptr = [0]
+    for desc in descs:
+        for token in analyzer(str(desc)):
+            column = vocabulary.get(token)
+            if column is None:
+                column = vocabulary[token] = len(vocabulary)
+            indices.append(column)
+        indptr.append(len(indices))
+    indices = np.asarray(indices, dtype=np.int32)
+    counts = sparse.csr_matrix(
+        (np.ones(len(indices), dtype=np.int64), indices,
+         np.asarray(indptr, dtype=np.int64)),
+        shape=(len(indptr) - 1, len(vocabulary)))
+    # merge repeated terms of a document into one count
+    counts.sum_duplicates()
+    return list(vocabulary), counts
+
+
+# analyzer of a tokenizer worker process
+_worker_analyzer = None
+
+
+def init_worker(stop_words):
+    global _worker_analyzer
+    _worker_analyzer = TfidfVectorizer(stop_words=stop_words).build_analyzer()
+
+
+def count_chunk(descs):
+    return count_terms(_worker_analyzer, descs)
+
+
+class ChunkedTfidf:
+    def __init__(self, stop_words='english', workers=1):
+        self.stop_words = stop_words
+        self._analyzer = TfidfVectorizer(
+            stop_words=stop_words).build_analyzer()
+        self._vocabulary = {}
+        self._counts = []
+        self.n_docs = 0
+        self._pool = None
+        self._pending = deque()
+        self._max_pending = 2 * workers
+        if workers > 1:
+            self._pool = ProcessPoolExecutor(
+                workers, mp_context=multiprocessing.get_context('spawn'),
+                initializer=init_worker, initargs=(stop_words,))
+
+    def add(self, descs):
+        """Tokenize and count one chunk of descriptions"""
+        if self._pool is None:
+            self._merge(*count_terms(self._analyzer, descs))
+            return
+        self._pending.append(self._pool.submit(count_chunk, list(descs)))
+        # bound the chunks held in flight
+        while len(self._pending) > self._max_pending:
+            self._merge(*self._pending.popleft().result())
+
+    def _merge(self, terms, counts):
+        vocabulary = self._vocabulary
+        columns = np.array([vocabulary.setdefault(term, len(vocabulary))
+                            for term in terms], dtype=np.int32)
+        self._counts.append(sparse.csr_matrix(
+            (counts.data, columns[counts.indices], counts.indptr),
+            shape=(counts.shape[0], len(vocabulary))))
+        self.n_docs += counts.shape[0]
+
+    def finish(self):
+        """``(vectorizer, tfidf matrix)`` of every added description.
+
+        Columns are ordered by term like ``TfidfVectorizer`` orders them,
+        and the rows are L2-normalized.
+        """
+        while self._pending:
+            self._merge(*self._pending.popleft().result())
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
+        n_terms = len(self._vocabulary)
+        # earlier chunks were counted against a smaller vocabulary
+        counts = sparse.vstack(
+            [sparse.csr_matrix((chunk.data, chunk.indices, chunk.indptr),
+                               shape=(chunk.shape[0], n_terms))
+             for chunk in self._counts],
+            format='csr')
+        self._counts = []
+
+        terms = sorted(self._vocabulary)
+        new_column = np.empty(n_terms, dtype=np.int32)
+        for column, term in enumerate(terms):
+            new_column[self._vocabulary[term]] = column
+        counts.indices = new_column[counts.indices]
+        counts.has_sorted_indices = False
+        counts.sort_indices()
+
+        df = np.bincount(counts.indices, minlength=n_terms)
+        idf = np.log((1 + self.n_docs) / (1 + df)) + 1
+        matrix = counts.astype(np.float64)
+        matrix.data *= idf[matrix.indices]
+        matrix = normalize(matrix, copy=False)
+
+        vectorizer = TfidfVectorizer(
+            stop_words=self.stop_words,
+            vocabulary={term: column for column, term in enumerate(terms)})
+        vectorizer.idf_ = idf
+        return vectorizer, matrix
@@ -0,0 +1,38 @@
+"""Debug sidebar panel showing ``library_sim.tracing`` timings.
+
+Pages take a ``tracing.mark()`` at the top and call ``sidebar_panel(mark)``
+at the bottom. Nothing is drawn unless tracing is on; then a "Show timings"
+checkbox opens the spans of the current run and the latency histograms
+aggregated over the whole process.
+"""
+import threading
+
+import pandas as pd
+import streamlit as st
+
+from library_sim import tracing
+
+
+def sidebar_panel(run_started):
+    tracer = tracing.get_tracer()
+    if tracer is None:
+        return
+    st.sidebar.markdown("---")
+    if not st.sidebar.checkbox('Show timings', key='show_trace_panel'):
+        return
+
+    spans = tracer.spans_since(run_started, threading.get_ident())
+    run_table = pd.DataFrame(spans, columns=['name', 'parent', 'ms', 'rows',
+                                             'bytes'])
+    top_level_ms = run_table.loc[run_table['parent'].isna(), 'ms'].sum()
+    st.sidebar.markdown(f"**This run**: {len(spans)} spans, "
+                        f"{top_level_ms:.1f}ms in top-level spans")
+    st.sidebar.dataframe(run_table)
+
+    summary = pd.DataFrame.from_dict(tracer.summary(), orient='index')
+    if not summary.empty:
+        summary = summary.sort_values('total_ms', ascending=False)
+    st.sidebar.markdown('**All runs**')
+    st.sidebar.dataframe(summary)
+    if st.sidebar.button('Reset timings'):
+        tracer.reset()
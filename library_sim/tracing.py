@@ -0,0 +1,272 @@
+"""Named timing spans for DB calls, engine stages and page rendering.
+
+Code wraps a stage in a span::
+
+    with tracing.span('engine.neighbors') as span:
+        ...
+        span.add(rows=len(rows))
+
+or decorates a function with ``@tracing.traced('engine.book_rec')``. While
+tracing is off ``span()`` returns a shared no-op object, so an instrumented
+call costs one global lookup. While it is on, every finished span is added
+to a latency histogram per name, kept in a short list of recent spans for
+the debug sidebar panel (``library_sim.trace_panel``) and appended in
+batches to a JSON-lines metrics file for offline analysis.
+
+Tracing is off unless ``LIBRARY_SIM_TRACE=1`` is set or the secrets file
+has ``[tracing] enabled = true``; ``metrics_file`` (or
+``LIBRARY_SIM_TRACE_FILE``) moves the metrics file from
+``metrics/trace.jsonl``.
+"""
+import atexit
+import bisect
+import functools
+import json
+import os
+import threading
+import time
+from collections import deque
+
+from library_sim.config import ROOT, load_secrets
+
+METRICS_FILE = os.path.join(ROOT, 'metrics', 'trace.jsonl')
+# histogram bucket upper bounds in ms, doubling from 0.05ms to ~100s
+BUCKETS = [0.05 * 2 ** i for i in range(22)]
+RECENT_SPANS = 500
+# finished spans are written to the metrics file this often, or sooner
+# when this many are waiting
+FLUSH_INTERVAL = 10
+FLUSH_SPANS = 1000
+
+
+class Histogram:
+    """Latency distribution and row/byte totals of one span name"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.rows = 0
+        self.bytes = 0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+
+    def add(self, ms, attrs, error):
+        self.count += 1
+        self.errors += error
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.rows += attrs.get('rows', 0)
+        self.bytes += attrs.get('bytes', 0)
+        self.buckets[bisect.bisect_left(BUCKETS, ms)] += 1
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the ``q``-th percentile"""
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_ms)
+        return self.max_ms
+
+    def summary(self):
+        return {'count': self.count, 'errors': self.errors,
+                'total_ms': round(self.total_ms, 3),
+                'mean_ms': round(self.total_ms / max(self.count, 1), 3),
+                'p50_ms': round(self.percentile(50), 3),
+                'p95_ms': round(self.percentile(95), 3),
+                'max_ms': round(self.max_ms, 3),
+                'rows': self.rows, 'bytes': self.bytes}
+
+
+class Span:
+    __slots__ = ('tracer', 'name', 'attrs', 'parent', 'started_at', 'start')
+
+    def __init__(self, tracer, name, attrs):
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def add(self, **counts):
+        """Add to counters such as ``rows`` and ``bytes``"""
+        for key, value in counts.items():
+            self.attrs[key] = self.attrs.get(key, 0) + value
+
+    def __enter__(self):
+        stack = self.tracer.stack()
+        self.parent = stack[-1].name if stack else None
+        stack.append(self)
+        self.started_at = time.time()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        ms = (time.perf_counter() - self.start) * 1000
+        self.tracer.stack().pop()
+        self.tracer.record(self, ms, exc_type is not None)
+        return False
+
+
+class NoopSpan:
+    """Stands in for a Span while tracing is off"""
+
+    def set(self, **attrs):
+        pass
+
+    def add(self, **counts):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        return False
+
+
+NOOP_SPAN = NoopSpan()
+
+
+class Tracer:
+    def __init__(self, metrics_file=METRICS_FILE):
+        self.metrics_file = metrics_file
+        self.histograms = {}
+        self.recent = deque(maxlen=RECENT_SPANS)
+        self._pending = []
+        self._flushed_at = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def stack(self):
+        try:
+            return self._local.stack
+        except AttributeError:
+            self._local.stack = []
+            return self._local.stack
+
+    def record(self, span, ms, error):
+        record = {'name': span.name, 'parent': span.parent,
+                  'thread': threading.get_ident(),
+                  'start': span.started_at, 'ms': round(ms, 4),
+                  'error': error, **span.attrs}
+        with self._lock:
+            histogram = self.histograms.get(span.name)
+            if histogram is None:
+                histogram = self.histograms[span.name] = Histogram()
+            histogram.add(ms, span.attrs, error)
+            self.recent.append(record)
+            if self.metrics_file:
+                self._pending.append(record)
+            due = (len(self._pending) >= FLUSH_SPANS
+                   or time.monotonic() - self._flushed_at > FLUSH_INTERVAL)
+        if due:
+            self.flush()
+
+    def flush(self):
+        """Append the spans finished since the last flush to the metrics
+        file"""
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._flushed_at = time.monotonic()
+        if not pending:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.metrics_file), exist_ok=True)
+            with open(self.metrics_file, 'a') as metrics_file:
+                for record in pending:
+                    metrics_file.write(json.dumps(record) + '\n')
+        except OSError as err:
+            print("{}".format(err))
+
+    def summary(self):
+        """``{span name: histogram summary}``"""
+        with self._lock:
+            return {name: histogram.summary()
+                    for name, histogram in self.histograms.items()}
+
+    def spans_since(self, started_at, thread=None):
+        """Recent spans started at or after ``started_at`` (a ``time.time()``
+        value), optionally only those of one thread"""
+        with self._lock:
+            return [record for record in self.recent
+                    if record['start'] >= started_at
+                    and (thread is None or record['thread'] == thread)]
+
+    def reset(self):
+        with self._lock:
+            self.histograms.clear()
+            self.recent.clear()
+
+
+_tracer = None
+
+
+def enabled():
+    return _tracer is not None
+
+
+def get_tracer():
+    """The active Tracer, or None while tracing is off"""
+    return _tracer
+
+
+def span(name, **attrs):
+    if _tracer is None:
+        return NOOP_SPAN
+    return Span(_tracer, name, attrs)
+
+
+def traced(name):
+    """Decorator running every call of the function inside a span"""
+    def decorate(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _tracer is None:
+                return fn(*args, **kwargs)
+            with Span(_tracer, name, {}):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorate
+
+
+def mark():
+    """Timestamp to pass to ``spans_since`` to get the spans after it"""
+    return time.time()
+
+
+def enable(metrics_file=METRICS_FILE):
+    global _tracer
+    if _tracer is None:
+        _tracer = Tracer(metrics_file)
+        atexit.register(_tracer.flush)
+    return _tracer
+
+
+def disable():
+    global _tracer
+    tracer, _tracer = _tracer, None
+    if tracer is not None:
+        tracer.flush()
+
+
+def settings():
+    """Tracing options from ``[tracing]`` in the secrets file, env
+    overrides"""
+    try:
+        options = dict(load_secrets().get('tracing', {}))
+    except FileNotFoundError:
+        options = {}
+    if 'LIBRARY_SIM_TRACE' in os.environ:
+        options['enabled'] = os.environ['LIBRARY_SIM_TRACE'] not in ('', '0')
+    if 'LIBRARY_SIM_TRACE_FILE' in os.environ:
+        options['metrics_file'] = os.environ['LIBRARY_SIM_TRACE_FILE']
+    return {'enabled': bool(options.get('enabled', False)),
+            'metrics_file': options.get('metrics_file', METRICS_FILE)}
+
+
+_settings = settings()
+if _settings['enabled']:
+    enable(_settings['metrics_file'])
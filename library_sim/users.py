@@ -0,0 +1,33 @@
+"""Reader accounts: sign-up and login against the ``users`` table."""
+import mysql.connector
+
+from library_sim import db
+
+CREATE_USER = """INSERT INTO users (user_name, user_pass)
+                 VALUES (%s, SHA2(%s, 256));"""
+LOGIN_QUERY = """SELECT user_name FROM users
+                 WHERE user_name = %s
+                 AND user_pass = SHA2(%s, 256)"""
+
+
+def create_user(new_user_name, new_user_pass):
+    try:
+        with db.cursor() as cur:
+            cur.execute(CREATE_USER, (new_user_name, new_user_pass))
+        print("New User Added to Database")
+        return True
+    except mysql.connector.Error as err:
+        print("{}".format(err))
+        return False
+
+
+def login_user(user_name, user_pass):
+    with db.cursor() as cur:
+        cur.execute(LOGIN_QUERY, (user_name, user_pass))
+        results = cur.fetchall()
+    if results and user_name == results[0][0]:
+        print('login success')
+        return results
+    else:
+        print('failure')
+        return results
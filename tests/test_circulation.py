@@ -0,0 +1,101 @@
+"""Concurrent checkouts and returns against the SQLite stand-in."""
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from library_sim import availability, circulation, db, migrate, sqlite_db
+
+BOOK_ID = 1
+COPIES = 50
+ATTEMPTS = 300
+WORKERS = 32
+
+
+@pytest.fixture
+def library(tmp_path):
+    path = str(tmp_path / 'library.db')
+    setup = sqlite_db.connect(path)
+    migrate.migrate(setup)
+    setup.raw.execute("""INSERT INTO metadata (unique_id, title, author,
+                      genre) VALUES (?, 'Test', 'Nobody', '[]');""",
+                      (BOOK_ID,))
+    setup.raw.execute("""INSERT INTO inventory VALUES (?, ?, ?);""",
+                      (BOOK_ID, COPIES, COPIES))
+    setup.commit()
+    setup.close()
+    db.set_pool(db.ConnectionPool(lambda: sqlite_db.connect(path),
+                                  size=WORKERS))
+    yield
+    db.set_pool(None)
+    availability.clear()
+
+
+def inventory_state():
+    with db.cursor() as cur:
+        cur.execute("""SELECT available FROM inventory
+                    WHERE book_id = %s;""", (BOOK_ID,))
+        available = cur.fetchall()[0][0]
+        cur.execute("""SELECT COUNT(*) FROM circulation
+                    WHERE book_id = %s;""", (BOOK_ID,))
+        checked_out = cur.fetchall()[0][0]
+    return available, checked_out
+
+
+def run_threaded(call, attempts):
+    with ThreadPoolExecutor(max_workers=WORKERS) as executor:
+        return list(executor.map(call, range(attempts)))
+
+
+def count_ok(results):
+    return sum(status == circulation.OK
+               for batch in results for _, status in batch)
+
+
+def test_checkout(library):
+    results = run_threaded(
+        lambda i: circulation.checkout(f'user-{i % 10}', BOOK_ID), ATTEMPTS)
+
+    available, checked_out = inventory_state()
+    assert sum(results) == COPIES
+    assert available >= 0
+    assert available == COPIES - sum(results)
+    assert checked_out == sum(results)
+
+
+def test_checkout_many(library):
+    results = run_threaded(
+        lambda i: circulation.checkout_many(f'user-{i % 10}',
+                                            [BOOK_ID, BOOK_ID]),
+        ATTEMPTS // 2)
+
+    available, checked_out = inventory_state()
+    successes = count_ok(results)
+    assert successes == COPIES
+    assert available >= 0
+    assert available == COPIES - successes
+    assert checked_out == successes
+
+
+def test_return_many(library):
+    user_id = 'reader'
+    assert count_ok([circulation.checkout_many(user_id,
+                                               [BOOK_ID] * COPIES)]) == COPIES
+
+    results = run_threaded(
+        lambda _: circulation.return_many(user_id, [BOOK_ID, BOOK_ID]),
+        ATTEMPTS // 2)
+
+    available, checked_out = inventory_state()
+    assert count_ok(results) == COPIES
+    assert available == COPIES
+    assert checked_out == 0
+
+
+def test_checkout_many_rejects_bools_and_fractions(library):
+    results = circulation.checkout_many('reader', [True, 1.9, str(BOOK_ID),
+                                                   float(BOOK_ID)])
+
+    assert [status for _, status in results] == [
+        circulation.INVALID_ID, circulation.INVALID_ID, circulation.OK,
+        circulation.OK]
+    assert inventory_state() == (COPIES - 2, 2)
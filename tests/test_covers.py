@@ -0,0 +1,118 @@
+"""CoverCache against a local HTTP stand-in for the cover host."""
+import hashlib
+import io
+import os
+import threading
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+from PIL import Image
+
+from library_sim import covers
+
+
+def png_bytes(size=(260, 400), color=(200, 30, 30)):
+    out = io.BytesIO()
+    Image.new('RGB', size, color).save(out, 'PNG')
+    return out.getvalue()
+
+
+COVER = png_bytes()
+
+
+@pytest.fixture
+def cover_host():
+    """Base URL of a server with a PNG at /cover.png and /same.png, text at
+    /text and 404 elsewhere; ``.requests`` counts the paths it was asked
+    for"""
+    requests = Counter()
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            requests[self.path] += 1
+            if self.path in ('/cover.png', '/same.png'):
+                body, content_type = COVER, 'image/png'
+            elif self.path == '/text':
+                body, content_type = b'not an image', 'text/plain'
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    host = f'http://127.0.0.1:{server.server_address[1]}'
+    try:
+        yield host, requests
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_thumbnail_size(tmp_path, cover_host):
+    host, _ = cover_host
+    cache = covers.CoverCache(str(tmp_path))
+
+    name = cache.fetch(host + '/cover.png')
+
+    with Image.open(os.path.join(tmp_path, name)) as thumbnail:
+        assert thumbnail.size == covers.THUMBNAIL_SIZE == (130, 200)
+    assert cache.local_url(host + '/cover.png') == covers.STATIC_URL + name
+
+
+def test_duplicates_fetched_once(tmp_path, cover_host):
+    host, requests = cover_host
+    cache = covers.CoverCache(str(tmp_path))
+
+    fetched, failed = cache.prefetch([host + '/cover.png'] * 5
+                                     + [host + '/same.png'])
+
+    assert (fetched, failed) == (2, 0)
+    assert requests == {'/cover.png': 1, '/same.png': 1}
+    # both links hold the same image, stored once under its content hash
+    name = cache.local_url(host + '/cover.png')[len(covers.STATIC_URL):]
+    assert cache.local_url(host + '/same.png').endswith(name)
+    with open(os.path.join(tmp_path, name), 'rb') as thumbnail_file:
+        thumbnail = thumbnail_file.read()
+    assert name == hashlib.sha256(thumbnail).hexdigest()[:32] + '.jpg'
+    assert sorted(os.listdir(tmp_path)) == sorted([covers.INDEX_FILE, name])
+
+    assert cache.prefetch([host + '/cover.png']) == (0, 0)
+    assert requests['/cover.png'] == 1
+
+
+def test_failures_counted(tmp_path, cover_host):
+    host, _ = cover_host
+    cache = covers.CoverCache(str(tmp_path))
+
+    fetched, failed = cache.prefetch([host + '/missing.png', host + '/text',
+                                      host + '/cover.png'])
+
+    assert (fetched, failed) == (1, 2)
+    assert cache.local_url(host + '/missing.png') is None
+    assert cache.local_url(host + '/text') is None
+    assert len(cache) == 1
+
+
+def test_index_reloaded(tmp_path, cover_host):
+    host, requests = cover_host
+    cache = covers.CoverCache(str(tmp_path))
+    cache.prefetch([host + '/cover.png', host + '/same.png'])
+
+    reopened = covers.CoverCache(str(tmp_path))
+
+    assert len(reopened) == 2
+    assert (reopened.local_url(host + '/cover.png')
+            == cache.local_url(host + '/cover.png'))
+    assert reopened.thumbnail_url(host + '/same.png') == cache.local_url(
+        host + '/same.png')
+    assert requests == {'/cover.png': 1, '/same.png': 1}
@@ -0,0 +1,19 @@
+"""The blocked neighbor index against the dense similarity matrix."""
+from scipy import sparse
+from sklearn.metrics.pairwise import cosine_similarity
+
+from library_sim.neighbors import build_neighbor_index
+
+
+def test_same_top_20_as_dense():
+    desc_matrix = sparse.random(300, 80, density=0.2, format='csr',
+                                random_state=0)
+    dense = cosine_similarity(desc_matrix, desc_matrix)
+
+    indices = build_neighbor_index(desc_matrix, block_size=7).indices
+
+    for row in range(desc_matrix.shape[0]):
+        expected = [col for col, _ in sorted(enumerate(dense[row]),
+                                             key=lambda item: item[1],
+                                             reverse=True)[:20]]
+        assert list(indices[row, :20]) == expected